@@ -1,15 +1,37 @@
+import os
+import time
 from typing import Literal
 
+import audio_manager
+import metrics
 import protocol
 from header import HeaderBar
 from sidebar import Sidebar
 from chat_area import ChatArea
 from input_area import InputArea
 import tkinter as tk
+import gui_client
 from gui_client import GuiChatClient
+from voice_stream import VoiceStream
+from ui_dispatch import UiDispatcher
+from message_store import MessageStore
 
 import gui_config
 
+# what the "Server Messages" chat says at each step of the login
+LOGIN_PROGRESS_TEXT = {
+    gui_client.LOGIN_CONNECTING: "Connecting to the server... (Esc to cancel)",
+    gui_client.LOGIN_SECURING: "Securing the connection...",
+    gui_client.LOGIN_SENDING_USERNAME: "Logging in...",
+    gui_client.LOGIN_FAILED: "Could not connect to the server. Please enter your username to try again.",
+    gui_client.LOGIN_TIMED_OUT: "The server did not answer in time. Please enter your username to try again.",
+    gui_client.LOGIN_CANCELLED: "Stopped connecting. Please enter your username.",
+}
+
+# a message of the user's that was written to the server: (time, SENT_MESSAGE, message type, (text, chat)). Put in the
+# client's queue by _show_when_sent, so that it is added to the chat in the UI thread like the received messages.
+SENT_MESSAGE = -2
+
 # documentation of tkinter widgets and stuff: : https://www.tcl-lang.org/man/tcl8.6/TkCmd/contents.htm
 class App:
     def __init__(self):
@@ -17,22 +39,31 @@ class App:
         self.username = None
         self.set_password = False
 
-        # TODO: the following lines are temporary
-        # self.chats = dict() # { chat_name_1: [(user1, type=0, text), (user2, type=1, audio_stuff), ...], ...}
-        self.chats = {
-            "Server Messages": [("Setup", 0, "Please enter your username.")],
-            # "General": [],
-        }
+        # the messages of every chat: [(user1, type=0, text), (user2, type=1, audio_stuff), ...] - the newest ones in
+        # memory, all of them in a file once the user logged in
+        self.chats = MessageStore()
+        self.chats.add_chat("Server Messages")
+        self.chats.append("Server Messages", "Setup", protocol.MESSAGE_TEXT, "Please enter your username.")
         self.active_chat = "Server Messages"
+        self.voice_stream_chat = None # the chat of the voice message that is being streamed while it is recorded
+
+        # the last search of the history: its results (message id, chat, sender, text), newest first, and the shown one
+        self.search_query = None
+        self.search_results = []
+        self.search_index = 0
 
-        self.header = HeaderBar(self.root, '')
-        self.sidebar = Sidebar(self.root, list(self.chats.keys()), self.switch_chat)
-        self.chat_area = ChatArea(self.root)
-        self.input_area = InputArea(self.root, self.send_message_to_server)
+        self.header = HeaderBar(self.root, '', self.search_history)
+        self.sidebar = Sidebar(self.root, self.chats.chat_names(), self.switch_chat)
+        self.chat_area = ChatArea(self.root, load_older=self.chats.older)
+        self.input_area = InputArea(self.root, self.send_message_to_server, self.start_voice_stream)
 
         # networking
         self.client = GuiChatClient()
-        self.root.after(100, self.poll_messages)
+        # the listening thread wakes the UI for every received message, which draws them frame by frame
+        self.dispatcher = UiDispatcher(self.root, self.client.incoming_messages, self.handle_message,
+                                       self.chat_area.start_batch, self.chat_area.end_batch)
+        self.client.on_message = self.dispatcher.wake
+        self.root.bind("<Escape>", lambda event: self.client.cancel_connect())
 
         self._create_component_layout()
         self.switch_chat(self.active_chat)
@@ -54,9 +85,21 @@ class App:
 
 
     def _send_first_message(self, username):
+        # the login runs in the background - its steps arrive as messages (see _on_login_progress)
         self.username = username
         self.client.connect(username)
 
+    def _on_login_progress(self, step: str):
+        """
+        Shows how the login is going. A login that did not finish lets the user enter a username again.
+        :param step: One of gui_client's LOGIN_ steps
+        :return:
+        """
+        if step in (gui_client.LOGIN_FAILED, gui_client.LOGIN_TIMED_OUT, gui_client.LOGIN_CANCELLED):
+            self.username = None
+        if step in LOGIN_PROGRESS_TEXT:
+            self.new_message("Setup", protocol.MESSAGE_TEXT, LOGIN_PROGRESS_TEXT[step], "Server Messages")
+
     def _first_connection_to_server(self):
         """
         Updates everything to match the user's correctly inputted username
@@ -67,8 +110,15 @@ class App:
 
 
         self.header.set_username(self.username)
+
+        # the history of this user, from the last time
+        for chat_name in self.chats.open(os.path.join(gui_config.HISTORY_DIR, f"{self.username}.db")):
+            self.sidebar.add_chat(chat_name)
         self.add_chat("General")
 
+        # the user can record now - the microphone is opened ahead, so recordings start right away
+        self.input_area.audio_manager.warm_up()
+
 
     def switch_chat(self, chat_name: str):
         """
@@ -89,114 +139,166 @@ class App:
         # update sidebar
         self.sidebar.highlight_chat(chat_name)
 
-        # update chat_area
-        self.chat_area.clear()
-        self.chat_area.load_messages(self.chats[chat_name])
+        # update chat_area - a chat that was shown recently is still drawn
+        self.chat_area.show_chat(chat_name, self.chats.recent(chat_name))
 
 
-    def new_message(self, sender: str, message_type: Literal[0, 1], text: str, chat="General"):
+    def search_history(self, query: str):
+        """
+        Shows the newest message that has all the words of the query, in its chat. Searching for the same query again
+        shows the next older one.
+        :param query: The words to find (see MessageStore.search)
+        :return: None
+        """
+        query = query.strip()
+        if query != self.search_query:
+            self.search_query = query
+            self.search_results = self.chats.search(query) if query else []
+            self.search_index = 0
+        elif self.search_results:
+            self.search_index = (self.search_index + 1) % len(self.search_results)
+
+        if not self.search_results:
+            self.header.set_search_results("No results" if query else "")
+            return
+        message_id, chat_name, _, _ = self.search_results[self.search_index]
+        self.header.set_search_results(f"{self.search_index + 1}/{len(self.search_results)}")
+        self.switch_chat(chat_name)
+        if chat_name == self.active_chat:
+            self.chat_area.scroll_to_message(self.chats.count_newer(chat_name, message_id))
+
+
+    def new_message(self, sender: str, message_type: Literal[0, 1], text: str | bytes | VoiceStream, chat="General"):
         """
         Adds the new message. If the correct chat is active, also displays it
         :param sender: The sender of the message.
         :param message_type: The type of the message.
-        :param text: The message chat to be sent.
+        :param text: The message chat to be sent (voice messages: the mp3 bytes, their hex from a v1 server,
+                     or a VoiceStream that is still arriving).
         :param chat: The chat where the message should be added to
         :return:
         """
-        if not text.strip():
+        if isinstance(text, (str, bytes)) and not text.strip():
             return
-        self.chats[chat].append((sender, message_type, text))
-        if self.active_chat == chat:
-            self.chat_area.add_message(sender, message_type, text)
+        self.chats.append(chat, sender, message_type, text)
+        # the chat area only draws it if the chat is shown, or still drawn from when it was
+        self.chat_area.add_message(sender, message_type, text, chat)
 
     def add_chat(self, chat_name: str):
         if chat_name in self.chats:
             return
 
-        self.chats[chat_name] = []
+        self.chats.add_chat(chat_name)
         self.sidebar.add_chat(chat_name)
 
-    def poll_messages(self, keepalive=True):
-        while not self.client.incoming_messages.empty(): # while !q.isEmpty()
-            response_code, message_type, raw_msg  = self.client.incoming_messages.get()
-
-            # TODO: move this somewhere else - it does not belong here!
-            # if the message is private
-            if raw_msg.startswith("[Private Message from "):
-                # Format: [Private Message from <username>]: <msg>
-                try:
-                    prefix, msg_text = raw_msg.split("]:", 1)
-                    sender = prefix.replace("[Private Message from ", "").strip()
-                    msg_text = msg_text.strip()
-
-                    if sender not in self.chats:
-                        self.add_chat(sender)
-
-                    self.new_message(sender, message_type, msg_text, sender)
-
-                except ValueError:
-                    # fallback: treat as general
-                    self.new_message("Server", message_type, raw_msg, "Server Messages")
-
-            # case 2: server message
-            elif raw_msg.startswith("SERVER:"):
-
-                # if not self.set_password and (
-                #         response_code == protocol.RESPONSE_USER_EXISTS or
-                #         response_code == protocol.RESPONSE_USER_DOES_NOT_EXIST):
-                #     _, msg_text = raw_msg.split(": ", 1)
-                #     self.new_message("Server", msg_text, "Server Messages")
-                #     return
-
-                if self.username and not self.set_password and response_code in [protocol.RESPONSE_CORRECT_PASSWORD,
-                                                                                 protocol.RESPONSE_CREATED_USER]:
-                    # the user had logged in successfully
-                    self.set_password = True
-                    self._first_connection_to_server()
-
-                _, msg_text = raw_msg.split(": ", 1)
-                self.new_message("Server", message_type, msg_text, "Server Messages")
-
-
-            # case 3: broadcast (username: msg)
-            else:
-                try:
-                    sender, msg_text = raw_msg.split(":", 1)
-                    sender = sender.strip()
-                    msg_text = msg_text.strip()
+    def handle_message(self, item: tuple):
+        """
+        Shows a message that the client received. Called by the dispatcher, in the UI thread.
+        :param item: (time received, response code, message type, message) from the client's queue
+        :return: None
+        """
+        _, response_code, message_type, raw_msg = item
+        if response_code == gui_client.LOGIN_PROGRESS:
+            self._on_login_progress(raw_msg)
+            return
+        if response_code == SENT_MESSAGE:
+            text, chat = raw_msg
+            self.new_message(self.username, message_type, text, chat)
+            return
 
-                    if "General" not in self.chats:
-                        self.add_chat("General")
+        # protocol v2 voice messages are bytes: a "<sender>: " header followed by the raw mp3
+        audio = None
+        if isinstance(raw_msg, VoiceStream):
+            if response_code == protocol.RESPONSE_VOICE_CHUNK:
+                # the stream's last chunk arrived - its message is already displayed
+                raw_msg.notify_complete()
+                return
+            audio = raw_msg
+            raw_msg = raw_msg.prefix + ": "
+        elif isinstance(raw_msg, bytes):
+            header, _, audio = raw_msg.partition(b": ")
+            raw_msg = header.decode() + ": "
+
+        # TODO: move this somewhere else - it does not belong here!
+        # if the message is private
+        if raw_msg.startswith("[Private Message from "):
+            # Format: [Private Message from <username>]: <msg>
+            try:
+                prefix, msg_text = raw_msg.split("]:", 1)
+                sender = prefix.replace("[Private Message from ", "").strip()
+                msg_text = msg_text.strip() if audio is None else audio
+
+                if sender not in self.chats:
+                    self.add_chat(sender)
+
+                self.new_message(sender, message_type, msg_text, sender)
+
+            except ValueError:
+                # fallback: treat as general
+                self.new_message("Server", message_type, raw_msg, "Server Messages")
+
+        # case 2: server message
+        elif raw_msg.startswith("SERVER:"):
+
+            # if not self.set_password and (
+            #         response_code == protocol.RESPONSE_USER_EXISTS or
+            #         response_code == protocol.RESPONSE_USER_DOES_NOT_EXIST):
+            #     _, msg_text = raw_msg.split(": ", 1)
+            #     self.new_message("Server", msg_text, "Server Messages")
+            #     return
+
+            if self.username and not self.set_password and response_code in [protocol.RESPONSE_CORRECT_PASSWORD,
+                                                                             protocol.RESPONSE_CREATED_USER]:
+                # the user had logged in successfully
+                self.set_password = True
+                self._first_connection_to_server()
+
+            _, msg_text = raw_msg.split(": ", 1)
+            self.new_message("Server", message_type, msg_text, "Server Messages")
+
+
+        # case 3: broadcast (username: msg)
+        else:
+            try:
+                sender, msg_text = raw_msg.split(":", 1)
+                sender = sender.strip()
+                msg_text = msg_text.strip() if audio is None else audio
 
-                    # to enable the user the option of sending this guy a private message
-                    if sender.strip().lower() != "server" and sender not in self.chats:
-                        self.add_chat(sender)
+                if "General" not in self.chats:
+                    self.add_chat("General")
 
-                    # always log broadcast in General
-                    self.new_message(sender, message_type, msg_text, "General")
+                # to enable the user the option of sending this guy a private message
+                if sender.strip().lower() != "server" and sender not in self.chats:
+                    self.add_chat(sender)
 
+                # always log broadcast in General
+                self.new_message(sender, message_type, msg_text, "General")
 
-                except ValueError:
-                    # fallback to General
-                    self.new_message("ERROR", protocol.MESSAGE_TEXT, raw_msg, "General")
 
+            except ValueError:
+                # fallback to General
+                self.new_message("ERROR", protocol.MESSAGE_TEXT, raw_msg, "General")
 
-        # keep polling again
-        if keepalive:
-            self.root.after(100, self.poll_messages)
 
-    def send_message_to_server(self, message_type: Literal[0, 1], text: str):
+    def send_message_to_server(self, message_type: Literal[0, 1], text: str | bytes):
         """
         If the username is not set yet, then it tries to set the username.
         else:
         Sends a message to the server from this active username, also updates the chat.
         :param message_type: The type of the message.
-        :param text: The message chat to be sent.
+        :param text: The message chat to be sent (voice messages: the mp3 bytes).
         :return:
         """
         self.input_area.clear_input()
 
-        text = text.strip()
+        if message_type == protocol.MESSAGE_VOICE and self.voice_stream_chat is not None:
+            # the recording was already sent while it was being recorded
+            chat, self.voice_stream_chat = self.voice_stream_chat, None
+            self.new_message(self.username, message_type, text, chat)
+            return
+
+        if isinstance(text, str):
+            text = text.strip()
         if not text:
             return
 
@@ -216,22 +318,55 @@ class App:
 
             # the user is trying to set a new password
             msg_text = f"/set_password {text}"
-            success = self.client.send_message(protocol.MESSAGE_TEXT, msg_text)
-            if success:
-                self.new_message(self.username, protocol.MESSAGE_TEXT, text, self.active_chat)
+            sent = self.client.send_message(protocol.MESSAGE_TEXT, msg_text)
+            self._show_when_sent(sent, protocol.MESSAGE_TEXT, text, self.active_chat)
 
         elif self.active_chat == "General":
-            success = self.client.send_message(message_type, text)
-            if success:
-                self.new_message(self.username, message_type,text, "General") # updates the gui chat
+            sent = self.client.send_message(message_type, text)
+            self._show_when_sent(sent, message_type, text, "General") # updates the gui chat
 
         else:
-            msg_text = f"/msg {self.active_chat} {text}"
-            success = self.client.send_message(message_type, msg_text)
-            if success:
-                self.new_message(self.username, message_type, text, self.active_chat)
+            sent = self.client.send_message(message_type, text, recipient=self.active_chat)
+            self._show_when_sent(sent, message_type, text, self.active_chat)
+
+    def _show_when_sent(self, sent, message_type: Literal[0, 1], text: str | bytes, chat: str):
+        """
+        Adds a message of the user's to the chat once the client wrote it to the server. A message that could not be
+        sent is not shown.
+        :param sent: What client.send_message returned - a Future of whether it was sent, or None
+        :param message_type: The type of the message.
+        :param text: The message as it should be shown
+        :param chat: The chat to add it to
+        :return: None
+        """
+        if sent is None:
+            return
+
+        def on_done(future):
+            # runs in the client's thread - the UI thread adds the message
+            if future.result():
+                self.client.incoming_messages.put((time.perf_counter(), SENT_MESSAGE, message_type, (text, chat)))
+                self.dispatcher.wake()
+        sent.add_done_callback(on_done)
+
+
+
+    def start_voice_stream(self):
+        """
+        Called when a recording starts. If the server can take voice messages in chunks, the recording is sent
+        to the active chat while it is being recorded.
+        :return: a callback for the recorder's mp3 pieces (mp3_bytes, final), or None to send the recording at the end
+        """
+        if not self.set_password or self.active_chat == "Server Messages":
+            return None
 
+        recipient = None if self.active_chat == "General" else self.active_chat
+        stream_id = self.client.start_voice_stream(recipient)
+        if stream_id is None:
+            return None
 
+        self.voice_stream_chat = self.active_chat
+        return lambda mp3_bytes, final: self.client.send_voice_chunk(stream_id, mp3_bytes, final)
 
     def run(self):
         self.root.mainloop() # a blocking function
@@ -240,9 +375,18 @@ class App:
 
 def main():
     # username = utils.read_string_safe("Enter your name: ")
+    metrics.start_reporting("client", gui_config.METRICS_DIR, port=gui_config.METRICS_PORT)
     app = App()
     app.run()
-    if app.client.sock: app.client.close()
+    app.client.close()
+    app.input_area.audio_manager.close()
+    audio_manager.close_audio()
+    app.chats.close()
+    metrics.stop_reporting()
+
+    latency = app.dispatcher.latency_percentiles()
+    if latency is not None:
+        print(f"[Client] Receive-to-render latency: p50 {latency[0]:.1f} ms, p99 {latency[1]:.1f} ms")
 
 
 if __name__ == '__main__':
@@ -1,132 +1,755 @@
-import os
-import tempfile
+import hashlib
+import io
+import queue
+import struct
 import threading
-import numpy as np
+import time
+from collections import OrderedDict, deque
+from typing import Callable
 import lameenc
-from playsound import playsound
 import pyaudio
+import soundfile
 import sys
-from mutagen.mp3 import MP3
+import metrics
+from voice_processing import VoicePreprocessor
 
 CHUNK = 960
 FORMAT = pyaudio.paInt16 # 16 bit resolution
-CHANNELS = 1 if sys.platform == 'darwin' else 2 # mono
+CHANNELS = 1 if sys.platform == 'darwin' else 2 # what the microphone is opened with - the mp3 is always mono
 RATE = 16000 # sampling rate = 16 kHz
+BIT_RATE = 32 # mp3 bit rate in kbps
+# (up to this many seconds of a recording, mp3 bit rate in kbps) - longer recordings go on at a lower bit rate
+BIT_RATE_PROFILE = ((30, BIT_RATE), (120, 24), (None, 16))
+BIT_RATE_SWITCH_DELAY = 5 # seconds - the bit rate changes at the next pause, or this long after it is due
+INPUT_PRE_ROLL = 0.5 # seconds of audio from before the recording started that it begins with
+KEEP_INPUT_OPEN = True # keep the microphone open between recordings (the pre-roll needs it)
+INPUT_TIMEOUT = 2 # seconds - a microphone that sends nothing for this long has stopped
+STREAM_FLUSH_SIZE = 2048 # while recording, the mp3 is handed out in pieces of about this many bytes (~0.5 sec)
+PLAYBACK_CACHE_SIZE = 32 * 1024 * 1024 # bytes of decoded PCM kept for replays (~17 minutes of 16 kHz mono)
+DURATION_CACHE_SIZE = 4096 # clips whose duration is remembered
+CBR_CHECK_FRAMES = 16 # an mp3 whose first frames all have the same bit rate is taken to be constant bit rate...
+CBR_CHECK_TAIL = 4096 # ...if its last frame (found in this many bytes at its end) has it too
+
+# mp3 frame header tables, indexed by the header's bit fields
+_MPEG1, _MPEG2, _MPEG25 = 3, 2, 0 # version bits (1 is reserved)
+_LAYER1, _LAYER2, _LAYER3 = 3, 2, 1 # layer bits (0 is reserved)
+_SAMPLE_RATES = {_MPEG1: (44100, 48000, 32000), _MPEG2: (22050, 24000, 16000), _MPEG25: (11025, 12000, 8000)}
+_BIT_RATES = { # in kbps, index 0 is "free format", 15 is invalid
+	(_MPEG1, _LAYER1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+	(_MPEG1, _LAYER2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+	(_MPEG1, _LAYER3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+	(_MPEG2, _LAYER1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+	(_MPEG2, _LAYER2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+	(_MPEG2, _LAYER3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_HEADER = struct.Struct(">I")
+
+
+class _InputCapture:
+	"""
+	The chunks that the warm input stream captured since a recording started (the pre-roll first), read like a
+	blocking pyaudio stream.
+	"""
+	def __init__(self, pre_roll):
+		self._chunks = queue.Queue()
+		for chunk in pre_roll:
+			self._chunks.put(chunk)
+
+	def put(self, chunk: bytes):
+		self._chunks.put(chunk)
+
+	def read(self, frames: int, exception_on_overflow=False) -> bytes:
+		"""
+		:return: the next CHUNK - it blocks until the microphone captured it
+		"""
+		try:
+			return self._chunks.get(timeout=INPUT_TIMEOUT)
+		except queue.Empty:
+			raise OSError("the microphone stopped sending audio")
+
+
+class AudioDevices:
+	"""
+	The sound devices of the whole app: PortAudio is initialized once, and the microphone is opened once and kept
+	open between recordings. While nothing is recorded, its last INPUT_PRE_ROLL seconds are kept in a ring buffer,
+	so a recording starts right away - with the words that were said as the button was pressed.
+	"""
+	def __init__(self, pre_roll=INPUT_PRE_ROLL, keep_input_open=KEEP_INPUT_OPEN):
+		"""
+		:param pre_roll: Seconds of audio from before a recording started that it begins with
+		:param keep_input_open: Keep the microphone open between recordings (without it there is no pre-roll)
+		"""
+		self.keep_input_open = keep_input_open
+		self.p = None
+		self.input_stream = None
+		self._lock = threading.Lock() # guards the pre-roll and the capture, which PortAudio's thread fills
+		self._pre_roll = deque(maxlen=int(pre_roll * RATE / CHUNK))
+		self._capture = None # the _InputCapture of the recording, None while nothing is recorded
+
+	def host_api(self) -> pyaudio.PyAudio:
+		"""
+		:return: the host API (initialized on first use)
+		"""
+		with self._lock:
+			if self.p is None:
+				self.p = pyaudio.PyAudio()
+			return self.p
+
+	def warm_up(self):
+		"""
+		Opens the microphone, if it is not open yet, so the next recording starts without waiting for it.
+		:return:
+		"""
+		p = self.host_api()
+		with self._lock:
+			if self.input_stream is not None:
+				return
+			self._pre_roll.clear()
+		# frames come in through the callback, on PortAudio's thread
+		stream = p.open(format=FORMAT, channels=CHANNELS, rate=RATE, input=True, frames_per_buffer=CHUNK,
+		                stream_callback=self._on_input)
+		with self._lock:
+			self.input_stream = stream
+
+	def _on_input(self, in_data, frame_count, time_info, status):
+		with self._lock:
+			if self._capture is not None:
+				self._capture.put(in_data)
+			else:
+				self._pre_roll.append(in_data)
+		return None, pyaudio.paContinue
+
+	def start_capture(self) -> _InputCapture:
+		"""
+		Starts handing the microphone's chunks to a recording.
+		:return: the chunks, beginning with the pre-roll
+		"""
+		self.warm_up()
+		with self._lock:
+			self._capture = _InputCapture(self._pre_roll)
+			self._pre_roll.clear()
+			return self._capture
+
+	def stop_capture(self):
+		"""
+		Ends the recording's capture. The microphone stays open, unless keep_input_open is False.
+		:return:
+		"""
+		with self._lock:
+			self._capture = None
+		if not self.keep_input_open:
+			self._close_input()
+
+	def _close_input(self):
+		with self._lock:
+			stream, self.input_stream = self.input_stream, None
+			self._capture = None
+		if stream is not None:
+			stream.stop_stream()
+			stream.close()
+
+	def close(self):
+		"""
+		Closes the microphone and shuts PortAudio down. The streams opened with host_api() have to be closed before.
+		:return:
+		"""
+		self._close_input()
+		with self._lock:
+			p, self.p = self.p, None
+		if p is not None:
+			p.terminate()
+
+
+class PlaybackEngine:
+	"""
+	Plays mp3 bytes from memory through one long-lived output stream, fed by a single worker thread.
+	Decoded clips are kept in an LRU cache, so playing one again starts right away.
+	"""
+	def __init__(self, cache_size=PLAYBACK_CACHE_SIZE):
+		self.cache_size = cache_size
+		self._cache = OrderedDict() # { sha-1 of the mp3: (pcm, rate, channels) }, least recently used first
+		self._cached_bytes = 0
+
+		self.stream = None
+		self._stream_format = None # (rate, channels) the output stream was opened with
+
+		self._condition = threading.Condition()
+		self._request = None # (mp3 bytes, start in seconds) for the worker to decode and play
+		self._clip = None # (pcm, rate, channels) being played
+		self._position = 0 # the next byte of the clip's pcm to play
+		self._generation = 0 # bumped by play() and stop(), so a decode that was overtaken is not played
+		self._closed = False
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def play(self, mp3_bytes: bytes, start=0.0):
+		"""
+		Stops whatever is playing and plays the clip. Returns right away - decoding happens in the worker.
+		:param mp3_bytes: the clip
+		:param start: where to start, in seconds
+		"""
+		with self._condition:
+			self._generation += 1
+			self._request = (mp3_bytes, start)
+			self._clip = None
+			self._condition.notify()
+
+	def stop(self):
+		with self._condition:
+			self._generation += 1
+			self._request = None
+			self._clip = None
+
+	def seek(self, seconds: float):
+		"""
+		Moves the playing clip to the given time.
+		"""
+		with self._condition:
+			if self._request is not None:
+				self._request = (self._request[0], seconds)
+			elif self._clip is not None:
+				pcm, rate, channels = self._clip
+				self._position = min(len(pcm), self._offset(max(seconds, 0.0), rate, channels))
+
+	@property
+	def position(self) -> float:
+		"""
+		:return: how far the playing clip is, in seconds (0 if nothing is playing)
+		"""
+		with self._condition:
+			if self._clip is None:
+				return 0.0
+			pcm, rate, channels = self._clip
+			return self._position / (rate * channels * 2)
+
+	@property
+	def playing(self) -> bool:
+		with self._condition:
+			return self._request is not None or self._clip is not None
+
+	def close(self):
+		"""
+		Stops the worker and closes the output stream.
+		"""
+		with self._condition:
+			self._closed = True
+			self._request = None
+			self._clip = None
+			self._condition.notify()
+		self._thread.join()
+		if self.stream is not None:
+			self.stream.close()
+			self.stream = None
+
+	@staticmethod
+	def _offset(seconds: float, rate: int, channels: int) -> int:
+		return int(seconds * rate) * channels * 2 # 16 bit samples
+
+	def _decode(self, mp3_bytes: bytes) -> tuple[bytes, int, int]:
+		"""
+		:return: (pcm, rate, channels) of the clip, from the cache if it was played recently
+		"""
+		key = hashlib.sha1(mp3_bytes).digest()
+		clip = self._cache.get(key)
+		if clip is not None:
+			self._cache.move_to_end(key)
+			return clip
+
+		# a recording that goes on at a lower bit rate is decoded a part at a time
+		parts = [soundfile.read(io.BytesIO(part), dtype="int16", always_2d=True)
+		         for part in split_bit_rates(mp3_bytes)]
+		data, rate = parts[0]
+		clip = (b"".join(part.tobytes() for part, _ in parts), rate, data.shape[1])
+		self._cache[key] = clip
+		self._cached_bytes += len(clip[0])
+		while self._cached_bytes > self.cache_size and len(self._cache) > 1:
+			_, (pcm, _, _) = self._cache.popitem(last=False)
+			self._cached_bytes -= len(pcm)
+		return clip
+
+	def _write(self, pcm: bytes, rate: int, channels: int):
+		# the stream stays open between clips - it is only reopened for a clip with another format
+		if self._stream_format != (rate, channels):
+			if self.stream is not None:
+				self.stream.close()
+			self.stream = get_audio_devices().host_api().open(format=FORMAT, channels=channels, rate=rate,
+			                                                  output=True, frames_per_buffer=CHUNK)
+			self._stream_format = (rate, channels)
+		self.stream.write(pcm) # blocks for about as long as the pcm plays
+
+	def _run(self):
+		while True:
+			with self._condition:
+				while not self._closed and self._request is None and self._clip is None:
+					self._condition.wait()
+				if self._closed:
+					return
+				request, self._request = self._request, None
+				generation = self._generation
+
+			if request is not None:
+				mp3_bytes, start = request
+				try:
+					clip = self._decode(mp3_bytes)
+				except Exception as e:
+					print(f"[ ERROR ] Could not decode the voice message.\n\t Error: {e}")
+					continue
+				with self._condition:
+					if generation == self._generation and self._request is None:
+						self._clip = clip
+						self._position = min(len(clip[0]), self._offset(max(start, 0.0), clip[1], clip[2]))
+				continue
+
+			# play the next CHUNK, so stop() and seek() take effect within one CHUNK
+			with self._condition:
+				if self._clip is None:
+					continue
+				pcm, rate, channels = self._clip
+				start = self._position
+				end = min(len(pcm), start + CHUNK * channels * 2)
+				self._position = end
+				if end >= len(pcm):
+					self._clip = None
+			try:
+				self._write(pcm[start:end], rate, channels)
+			except OSError as e:
+				print(f"[ ERROR ] An error occurred whilst playing audio.\n\t Error: {e}")
+				self.stop()
+
+
+_playback_engine = None
+_playback_engine_lock = threading.Lock()
+_audio_devices = None
+_audio_devices_lock = threading.Lock()
+
+
+def get_audio_devices() -> AudioDevices:
+	"""
+	:return: the sound devices that recording and playback share
+	"""
+	global _audio_devices
+	with _audio_devices_lock:
+		if _audio_devices is None:
+			_audio_devices = AudioDevices()
+		return _audio_devices
+
+
+def close_audio():
+	"""
+	Stops the playback and closes the sound devices, e.g. when the app exits. Stop the recordings first.
+	"""
+	global _playback_engine, _audio_devices
+	with _playback_engine_lock:
+		if _playback_engine is not None:
+			_playback_engine.close()
+			_playback_engine = None
+	with _audio_devices_lock:
+		if _audio_devices is not None:
+			_audio_devices.close()
+			_audio_devices = None
+
+
+def get_playback_engine() -> PlaybackEngine:
+	"""
+	:return: the engine all voice messages are played with (started on first use)
+	"""
+	global _playback_engine
+	with _playback_engine_lock:
+		if _playback_engine is None:
+			_playback_engine = PlaybackEngine()
+		return _playback_engine
 
 
 def play_audio(mp3_bytes):
 	"""
 	Play audio directly from the mp3 bytes.
 	"""
-	threading.Thread(target=lambda: play_audio_helper(mp3_bytes), daemon=True).start()
+	get_playback_engine().play(mp3_bytes)
+
+
+def stop_audio():
+	"""
+	Stops the voice message that is playing, if any.
+	"""
+	get_playback_engine().stop()
+
+def _parse_frame_header(header: int):
+	"""
+	:param header: the 4 bytes of an mp3 frame header, as a big endian int
+	:return: (frame length in bytes, samples in the frame, sample rate, bit rate, version, channels),
+	         or None if it is not a header
+	"""
+	if header >> 21 != 0x7FF: # frame sync
+		return None
+	version = (header >> 19) & 3
+	layer = (header >> 17) & 3
+	bit_rate_index = (header >> 12) & 15
+	sample_rate_index = (header >> 10) & 3
+	if version == 1 or layer == 0 or bit_rate_index in (0, 15) or sample_rate_index == 3:
+		return None # reserved values, or free format (its frames have no length in the header)
+
+	padding = (header >> 9) & 1
+	channels = 1 if (header >> 6) & 3 == 3 else 2
+	bit_rate = _BIT_RATES[(_MPEG1 if version == _MPEG1 else _MPEG2, layer)][bit_rate_index] * 1000
+	sample_rate = _SAMPLE_RATES[version][sample_rate_index]
+
+	if layer == _LAYER1:
+		return (12 * bit_rate // sample_rate + padding) * 4, 384, sample_rate, bit_rate, version, channels
+	if layer == _LAYER3 and version != _MPEG1:
+		return 72 * bit_rate // sample_rate + padding, 576, sample_rate, bit_rate, version, channels
+	return 144 * bit_rate // sample_rate + padding, 1152, sample_rate, bit_rate, version, channels
+
+
+def _vbr_frame_count(mp3_bytes: bytes, position: int, version: int, channels: int):
+	"""
+	Looks for a Xing/Info or VBRI tag in the first frame, which holds the number of frames of the whole file.
+	:return: the number of frames, or None if there is no such tag
+	"""
+	# the Xing tag comes after the side information, whose size depends on the version and channels
+	if version == _MPEG1:
+		xing_at = position + (36 if channels == 2 else 21)
+	else:
+		xing_at = position + (21 if channels == 2 else 13)
+	if mp3_bytes[xing_at:xing_at + 4] in (b"Xing", b"Info"):
+		flags = _MP3_HEADER.unpack_from(mp3_bytes, xing_at + 4)[0]
+		if flags & 1: # the frame count is there
+			return _MP3_HEADER.unpack_from(mp3_bytes, xing_at + 8)[0]
+		return None
+
+	vbri_at = position + 36
+	if mp3_bytes[vbri_at:vbri_at + 4] == b"VBRI":
+		return _MP3_HEADER.unpack_from(mp3_bytes, vbri_at + 14)[0]
+	return None
+
+
+def _audio_bounds(mp3_bytes: bytes) -> tuple[int, int]:
+	"""
+	:return: where the frames of the mp3 start and end - without its ID3 tags
+	"""
+	start = 0
+	# skip an ID3v2 tag
+	if mp3_bytes[:3] == b"ID3" and len(mp3_bytes) >= 10:
+		size = 0
+		for byte in mp3_bytes[6:10]: # "syncsafe" int: 7 bits per byte
+			size = (size << 7) | (byte & 0x7F)
+		start = 10 + size + (10 if mp3_bytes[5] & 0x10 else 0) # the footer flag
+
+	end = len(mp3_bytes)
+	if mp3_bytes[end - 128:end - 125] == b"TAG": # ID3v1 tag
+		end -= 128
+	return start, end
+
+
+def _frames(mp3_bytes: bytes, position: int, end: int):
+	"""
+	Walks the frames of the mp3 between position and end, skipping whatever is not a frame.
+	:return: an iterator of (position, the frame's _parse_frame_header)
+	"""
+	while position + 4 <= end:
+		frame = _parse_frame_header(_MP3_HEADER.unpack_from(mp3_bytes, position)[0])
+		if frame is None:
+			# not a frame - move on to the next possible frame sync
+			position = mp3_bytes.find(b"\xff", position + 1)
+			if position == -1:
+				return
+			continue
+		if position + frame[0] > end:
+			return
+		yield position, frame
+		position += frame[0]
+
+
+def split_bit_rates(mp3_bytes: bytes) -> list[bytes]:
+	"""
+	Splits an mp3 where its bit rate changes, like the recordings of AudioManager that go on at a lower bit rate.
+	libsndfile takes the length of an mp3 without a Xing tag from the bit rate of its first frame, so it would cut
+	such a clip short - each of the parts is constant bit rate.
+	An mp3 whose bit rate changes all the time (variable bit rate) is not split.
+	:param mp3_bytes: the mp3
+	:return: the parts, in order
+	"""
+	start, end = _audio_bounds(mp3_bytes)
+	first = next(_frames(mp3_bytes, start, end), None)
+	if first is None or _last_frame_bit_rate(mp3_bytes, start, end) in (first[1][3], None):
+		return [mp3_bytes]
+
+	parts = []
+	part_start = start
+	part_frames = 0
+	bit_rate = first[1][3]
+	for position, frame in _frames(mp3_bytes, start, end):
+		if frame[3] != bit_rate:
+			if part_frames < CBR_CHECK_FRAMES:
+				return [mp3_bytes] # variable bit rate
+			parts.append(mp3_bytes[part_start:position])
+			part_start = position
+			part_frames = 0
+			bit_rate = frame[3]
+		part_frames += 1
+	parts.append(mp3_bytes[part_start:end])
+	return parts
+
+
+def _last_frame_bit_rate(mp3_bytes: bytes, start: int, end: int):
+	"""
+	Looks for the frames that end exactly at `end`, in the last CBR_CHECK_TAIL bytes (but not before `start`).
+	:return: the bit rate of the last frame, or None if no run of frames ends there (e.g. a clip that is still arriving)
+	"""
+	candidate = mp3_bytes.find(b"\xff", max(start, end - CBR_CHECK_TAIL), end)
+	while candidate != -1:
+		position = candidate
+		bit_rate = None
+		while position + 4 <= end:
+			frame = _parse_frame_header(_MP3_HEADER.unpack_from(mp3_bytes, position)[0])
+			if frame is None:
+				break
+			position += frame[0]
+			bit_rate = frame[3]
+		if position == end and bit_rate is not None:
+			return bit_rate
+		candidate = mp3_bytes.find(b"\xff", candidate + 1, end)
+	return None
+
+
+def probe_audio_duration(mp3_bytes: bytes) -> float:
+	"""
+	Finds the duration of an mp3 from its bytes, reading only frame headers: the Xing/VBRI tag if there is one,
+	otherwise the first CBR_CHECK_FRAMES frames, and every frame only if their bit rates differ (variable bit rate).
+	:param mp3_bytes: the mp3
+	:return: the duration in seconds
+	"""
+	start, end = _audio_bounds(mp3_bytes)
+	samples = 0
+	sample_rate = None
+	frames = 0
+	bit_rates = set()
+	for position, frame in _frames(mp3_bytes, start, end):
+		length, frame_samples, frame_sample_rate, bit_rate, version, channels = frame
+		if not frames:
+			frame_count = _vbr_frame_count(mp3_bytes, position, version, channels)
+			if frame_count is not None:
+				return frame_count * frame_samples / frame_sample_rate
+		samples += frame_samples
+		sample_rate = frame_sample_rate
+		position += length
+
+		frames += 1
+		bit_rates.add(bit_rate)
+		if frames == CBR_CHECK_FRAMES and len(bit_rates) == 1 and _last_frame_bit_rate(mp3_bytes, position, end) in (
+				bit_rate, None):
+			# constant bit rate: the rest of the bytes tell the rest of the duration
+			return samples / sample_rate + (end - position) * 8 / bit_rate
+
+	return samples / sample_rate if sample_rate else 0.0
+
+
+_duration_cache = OrderedDict() # { sha-1 of the mp3: duration }, least recently used first
+_duration_cache_lock = threading.Lock()
+
+
+def get_audio_duration(mp3_bytes: bytes) -> float:
+	"""
+	The duration of the mp3 in seconds. Remembered by the clip's content hash, so showing it again is free.
+	"""
+	key = hashlib.sha1(mp3_bytes).digest()
+	with _duration_cache_lock:
+		if key in _duration_cache:
+			_duration_cache.move_to_end(key)
+			return _duration_cache[key]
+
+	duration = probe_audio_duration(mp3_bytes)
+	with _duration_cache_lock:
+		_duration_cache[key] = duration
+		while len(_duration_cache) > DURATION_CACHE_SIZE:
+			_duration_cache.popitem(last=False)
+	return duration
 
-def play_audio_helper(mp3_bytes):
-	# create a temporary .mp3 file
-	with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmp:
-		tmp.write(mp3_bytes)
-		tmp_path = tmp.name.replace("\\", "/")
-	try:
-		playsound(tmp_path)
-	finally:
-		# Remove the temporary file
-		os.remove(tmp_path)
 
 def get_audio_duration_str(mp3_bytes):
 	"""
 	Gets the duration in seconds as a str representation
 	:return:
 	"""
-	with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmp:
-		tmp.write(mp3_bytes)
-		tmp_path = tmp.name
-
 	try:
-		audio = MP3(tmp_path)
-		seconds = int(audio.info.length)
-		minutes, seconds = divmod(seconds, 60)
-		return f"{minutes}:{seconds:02d}"
+		seconds = int(get_audio_duration(mp3_bytes))
 	except Exception as e:
 		print("Error reading duration:", e)
 		return "0:00"
-	finally:
-		os.remove(tmp_path)
+	minutes, seconds = divmod(seconds, 60)
+	return f"{minutes}:{seconds:02d}"
+
+
+def create_encoder(bit_rate=BIT_RATE, channels=1) -> lameenc.Encoder:
+	"""
+	:param bit_rate: The mp3 bit rate in kbps
+	:param channels: The channels of the PCM
+	:return: an mp3 encoder for the PCM that AudioManager records (mono, after the VoicePreprocessor)
+	"""
+	encoder = lameenc.Encoder()
+	encoder.set_bit_rate(bit_rate)
+	encoder.set_in_sample_rate(RATE)
+	encoder.set_out_sample_rate(RATE) # lame would resample low bit rates - the parts of a recording have to match
+	encoder.set_channels(channels)
+	encoder.set_quality(7)  # 2-highest, 7-fastest
+	return encoder
+
+
+def profile_bit_rate(seconds: float) -> int:
+	"""
+	:return: the mp3 bit rate (kbps) for a recording that is this many seconds long, from BIT_RATE_PROFILE
+	"""
+	for up_to, bit_rate in BIT_RATE_PROFILE:
+		if up_to is None or seconds < up_to:
+			return bit_rate
+	return BIT_RATE_PROFILE[-1][1]
+
+
+_encode_time = metrics.timer("audio_manager.encode") # of every CHUNK that is recorded: preprocessing and encoding
 
 
 class AudioManager:
-	def __init__(self):
-		self.p = None
+	def __init__(self, devices: AudioDevices | None = None):
+		"""
+		:param devices: The sound devices to record with (default: the ones the app shares)
+		"""
+		self.devices = devices or get_audio_devices()
 		self.stream = None
 
 		self.recording = False
-		self.frames = []
+		self._thread = None
+
+		# the mp3 is encoded while recording - the PCM is never kept
+		self.preprocessor = None
+		self.encoder = None
+		self.bit_rate = BIT_RATE
+		self._bit_rates = [] # the bit rates of the recording, in order
+		self.mp3 = bytearray()
+		self._unsent = 0 # how many bytes at the end of self.mp3 were not handed to on_mp3 yet
+		self.on_mp3 = None
 
-	def start_recording(self):
+		# the sizes of the last recording:
+		# { "recorded_seconds", "kept_seconds", "bit_rates", "bytes", "unprocessed_bytes" (mp3 bytes at BIT_RATE,
+		# without the VoicePreprocessor) }
+		self.clip_report = None
+
+	def warm_up(self):
+		"""
+		Opens the microphone ahead of the first recording. The app works without it if that fails.
+		:return:
+		"""
+		try:
+			self.devices.warm_up()
+		except OSError as e:
+			print(f"[ ERROR ] Could not open the microphone.\n\t Error: {e}")
+
+	def _open_input_stream(self):
+		"""
+		Starts taking the microphone's audio, from the pre-roll on.
+		:return: something to read the chunks from, like a pyaudio input stream
+		"""
+		return self.devices.start_capture()
+
+	def _close_input_stream(self):
+		self.devices.stop_capture()
+
+	def start_recording(self, on_mp3: Callable[[bytes, bool], None] = None):
 		"""
 		Starts capturing microphone input.
+		:param on_mp3: called with the mp3 as it is encoded (roughly every STREAM_FLUSH_SIZE bytes) and whether it is
+		               the last piece, e.g. to send the message while it is being recorded. Called from the
+		               recording thread, except for the last piece which comes from stop_recording.
 		"""
 		if self.recording:
 			return
 
-		self.p = pyaudio.PyAudio()
-		self.stream = self.p.open(
-			format=FORMAT,
-			channels=CHANNELS,
-			rate=RATE,
-			input=True,
-			frames_per_buffer=CHUNK
-		)
-		self.frames = []
+		self.stream = self._open_input_stream()
+		self.preprocessor = VoicePreprocessor(CHANNELS, RATE)
+		self.bit_rate = profile_bit_rate(0)
+		self._bit_rates = [self.bit_rate]
+		self.encoder = create_encoder(self.bit_rate)
+		self.mp3 = bytearray()
+		self._unsent = 0
+		self.on_mp3 = on_mp3
 		self.recording = True
-		print('[ Debug ] Recording audio...')
-		threading.Thread(target=self._record).start()
+		self._thread = threading.Thread(target=self._record, daemon=True)
+		self._thread.start()
 		return
 
 	def _record(self):
 		try:
 			while self.recording:
 				data = self.stream.read(CHUNK, exception_on_overflow=False)
-				self.frames.append(data)
-		except (OSError, Exception) as e:
+				start = time.perf_counter()
+				pcm = self.preprocessor.process(data)
+				mp3_bytes = self.encoder.encode(pcm) if pcm else b""
+				_encode_time.record(time.perf_counter() - start)
+				if pcm:
+					self._add_mp3(mp3_bytes)
+				self._switch_bit_rate()
+		except (OSError, RuntimeError, ValueError) as e: # the device (pyaudio), the encoder (lameenc), the samples
 			print(f"[ ERROR ] An error occurred whilst recording audio.\n\t Error: {e}")
 
+	def _switch_bit_rate(self):
+		"""
+		Goes on with an encoder of the bit rate that the recording's length calls for. The mp3s of both are one after
+		the other in self.mp3 - a player plays them as one, with a few ms of silence between them, which is why the
+		switch waits for a pause.
+		"""
+		seconds = self.preprocessor.kept_seconds
+		bit_rate = profile_bit_rate(seconds)
+		if bit_rate == self.bit_rate:
+			return
+		if self.preprocessor.speaking and profile_bit_rate(seconds - BIT_RATE_SWITCH_DELAY) == self.bit_rate:
+			return
+		self._add_mp3(self.encoder.flush())
+		self.bit_rate = bit_rate
+		self._bit_rates.append(bit_rate)
+		self.encoder = create_encoder(bit_rate)
+
+	def _add_mp3(self, mp3_bytes: bytes, final=False):
+		self.mp3 += mp3_bytes
+		self._unsent += len(mp3_bytes)
+		if self.on_mp3 is not None and (final or self._unsent >= STREAM_FLUSH_SIZE):
+			self.on_mp3(bytes(self.mp3[len(self.mp3) - self._unsent:]), final)
+			self._unsent = 0
 
+	@metrics.timed(sample_every=1)
 	def stop_recording(self):
 		"""
 		Stops recording microphone input.
+		Only what was not encoded yet (at most one CHUNK) is left to do, so this takes the same time for any length.
 		:return: The bytes corresponding to what we have recorded.
 		"""
-		print('[ Debug ] Stopped recording audio...')
 		self.recording = False
-		self.stream.stop_stream()
-		self.stream.close()
-		self.p.terminate()
-
-		pcm_data = b"".join(self.frames)
-		pcm_array = np.frombuffer(pcm_data, dtype=np.int16)
-
-		# mp3 encoding
-		encoder = lameenc.Encoder()
-		encoder.set_bit_rate(32)
-		encoder.set_in_sample_rate(RATE)
-		encoder.set_channels(CHANNELS)
-		encoder.set_quality(7)  # 2-highest, 7-fastest
-		# Can call this in a loop
-		mp3_bytes = encoder.encode(pcm_array.tobytes())
+		self._thread.join() # the current read returns after at most one CHUNK
+		self._close_input_stream()
+
 		# Flush when finished encoding the entire stream
-		mp3_bytes += encoder.flush()
-
-		print(f"[Debug] PCM size: {len(pcm_data)} bytes")
-		print(f"[Debug] MP3 size: {len(mp3_bytes)} bytes")
-		return mp3_bytes
-
-		# # Write to memory instead of disk
-		# buffer = io.BytesIO()
-		# with wave.open(buffer, 'wb') as wf:
-		# 	wf.setnchannels(CHANNELS)
-		# 	wf.setsampwidth(self.p.get_sample_size(FORMAT))
-		# 	wf.setframerate(RATE)
-		# 	for data in self.frames:
-		# 		wf.writeframes(data)
-		#
-		# audio_bytes = buffer.getvalue()
-		# return audio_bytes
+		pcm = self.preprocessor.flush()
+		self._add_mp3((self.encoder.encode(pcm) if pcm else b"") + self.encoder.flush(), final=True)
+		self.encoder = None
+		self.on_mp3 = None
+
+		self.clip_report = {
+			"recorded_seconds": self.preprocessor.recorded_seconds,
+			"kept_seconds": self.preprocessor.kept_seconds,
+			"bit_rates": self._bit_rates,
+			"bytes": len(self.mp3),
+			"unprocessed_bytes": int(self.preprocessor.recorded_seconds * BIT_RATE * 1000 / 8),
+		}
+		metrics.counter("audio_manager.recordings").inc()
+		metrics.counter("audio_manager.recorded_seconds").inc(self.clip_report["recorded_seconds"])
+		metrics.counter("audio_manager.kept_seconds").inc(self.clip_report["kept_seconds"])
+		metrics.counter("audio_manager.mp3_bytes").inc(self.clip_report["bytes"])
+		metrics.counter("audio_manager.unprocessed_bytes").inc(self.clip_report["unprocessed_bytes"])
+		metrics.counter("audio_manager.bit_rate_switches").inc(len(self.clip_report["bit_rates"]) - 1)
+		return bytes(self.mp3)
+
+	def close(self):
+		"""
+		Stops the recording in progress, if any - it is dropped. The devices are closed by close_audio().
+		:return:
+		"""
+		if self.recording:
+			self.on_mp3 = None
+			self.stop_recording()
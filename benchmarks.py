@@ -0,0 +1,1425 @@
+"""
+Benchmarks for the chat server and the wire path.
+Run all of them with `python benchmarks.py`, or a single one with `python benchmarks.py <name>`.
+The micro benchmarks can be kept as a baseline and compared with later:
+    python benchmarks.py micro --json baseline.json
+    python benchmarks.py micro --baseline baseline.json
+"""
+import argparse
+import asyncio
+import functools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+
+import encryption_utils
+import protocol
+
+
+def _free_port() -> int:
+    """
+    Asks the OS for a port nobody is listening on.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((protocol.SERVER_ADDRESS, 0))
+        return sock.getsockname()[1]
+
+
+def _run_server(port: int):
+    import server
+    # logins are not what we measure - keep password hashing cheap
+    server.PASSWORD_HASH_ITERATIONS = 1
+    asyncio.run(server.ChatServer(protocol.SERVER_ADDRESS, port).serve_forever())
+
+
+def _start_server_process(port: int) -> multiprocessing.Process:
+    process = multiprocessing.Process(target=_run_server, args=(port,), daemon=True)
+    process.start()
+    # wait until the server accepts connections
+    deadline = time.perf_counter() + 10
+    while time.perf_counter() < deadline:
+        try:
+            socket.create_connection((protocol.SERVER_ADDRESS, port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("server did not start")
+
+
+async def _connect_client(port: int, username: str, private_key, public_pem: str):
+    """
+    Connects and logs in a headless client.
+    :return: (reader, writer, AES_key)
+    """
+    reader, writer = await asyncio.open_connection(protocol.SERVER_ADDRESS, port)
+    await protocol.recv_server_msg_async(reader)  # hello
+
+    writer.write(protocol.create_user_msg_handshake(public_pem))
+    success, code, msg_type, data = await protocol.recv_server_msg_async(reader)
+    encrypted_AES = bytes.fromhex(data.split(protocol.SESSION_KEY_PREFIX, 1)[1])
+    AES_key = encryption_utils.deserialize_AES_key(encryption_utils.decrypt_RSA(encrypted_AES, private_key))
+
+    writer.write(protocol.create_user_msg_set_username(username, True, AES_key))
+    await protocol.recv_server_msg_async(reader, True, AES_key)
+    writer.write(protocol.create_user_msg_set_password(username, "password", True, AES_key))
+    success, code, msg_type, data = await protocol.recv_server_msg_async(reader, True, AES_key)
+    if code not in (protocol.RESPONSE_CORRECT_PASSWORD, protocol.RESPONSE_CREATED_USER):
+        raise RuntimeError(f"login failed for {username}: {data}")
+    return reader, writer, AES_key
+
+
+async def _count_messages(reader: asyncio.StreamReader, expected: int):
+    for _ in range(expected):
+        success, code, msg_type, data = await protocol.recv_server_msg_async(reader)
+        if not success:
+            raise RuntimeError("connection closed during the benchmark")
+
+
+async def _server_throughput(port: int, clients: int, senders: int, messages_per_sender: int, message_size: int):
+    # one RSA keypair for everyone - keygen would otherwise dominate the setup
+    private_key, public_key = encryption_utils.generate_RSA_keys()
+    public_pem = encryption_utils.serialize_public_RSA_key(public_key)
+
+    start = time.perf_counter()
+    connections = await asyncio.gather(*(_connect_client(port, f"user{i}", private_key, public_pem)
+                                         for i in range(clients)))
+    setup_time = time.perf_counter() - start
+
+    total_sent = senders * messages_per_sender
+    # every sender also receives the messages of the other senders
+    receivers = [_count_messages(reader, total_sent - (messages_per_sender if i < senders else 0))
+                 for i, (reader, writer, AES_key) in enumerate(connections)]
+
+    message = "x" * message_size
+    start = time.perf_counter()
+    receiving = asyncio.gather(*receivers)
+    for _ in range(messages_per_sender):
+        for i in range(senders):
+            reader, writer, AES_key = connections[i]
+            writer.write(protocol.create_user_msg_broadcast(f"user{i}", protocol.MESSAGE_TEXT, message,
+                                                            True, AES_key))
+        await asyncio.sleep(0)
+    await receiving
+    elapsed = time.perf_counter() - start
+
+    for reader, writer, AES_key in connections:
+        writer.close()
+    delivered = total_sent * (clients - 1)
+    return setup_time, delivered, elapsed
+
+
+def bench_server_throughput(clients=1000, senders=10, messages_per_sender=20, message_size=64):
+    """
+    Broadcast fan-out through a real server process: `senders` clients broadcast to `clients` connected clients.
+    Reports delivered messages/sec (the server's target is 20,000/sec on one core with 1,000 clients).
+    Note that the clients run in this process, so on a single core they compete with the server.
+    """
+    port = _free_port()
+    process = _start_server_process(port)
+    try:
+        setup_time, delivered, elapsed = asyncio.run(
+            _server_throughput(port, clients, senders, messages_per_sender, message_size))
+    finally:
+        process.kill()
+
+    print(f"server_throughput: {clients} clients logged in in {setup_time:.2f}s, "
+          f"{delivered} messages delivered in {elapsed:.2f}s -> {delivered / elapsed:,.0f} msg/s")
+    return delivered / elapsed
+
+
+def bench_frame_sizes(voice_size=200_000):
+    """
+    Bytes on the wire for an encrypted voice broadcast, v1 (hex inside hex) against v2 (raw bytes).
+    """
+    AES_key = encryption_utils.generate_AES_key()
+    mp3_bytes = os.urandom(voice_size)
+    v1 = protocol.create_user_msg_broadcast("alice", protocol.MESSAGE_VOICE, mp3_bytes.hex(), True, AES_key)
+    v2 = protocol.create_user_msg_broadcast("alice", protocol.MESSAGE_VOICE, mp3_bytes, True, AES_key,
+                                            protocol.PROTOCOL_V2)
+    print(f"frame_sizes: {voice_size:,} B voice -> v1 {len(v1):,} B ({len(v1) / voice_size:.2f}x), "
+          f"v2 {len(v2):,} B ({len(v2) / voice_size:.2f}x)")
+    return len(v1), len(v2)
+
+
+def _legacy_recv_fixed(sock: socket.socket, size: int) -> str:
+    """
+    protocol._recv_fixed before recv_into - the baseline of bench_recv_path.
+    """
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed while reading fixed size data")
+        data += chunk
+    return data.decode()
+
+
+def _recv_mb_per_sec(read_frame, frame: bytes, count: int) -> float:
+    """
+    Streams `count` copies of `frame` through a socketpair and times read_frame(sock, len(frame)) on the other end.
+    """
+    sender_sock, receiver_sock = socket.socketpair()
+    sender = threading.Thread(target=lambda: [sender_sock.sendall(frame) for _ in range(count)], daemon=True)
+    start = time.perf_counter()
+    sender.start()
+    for _ in range(count):
+        read_frame(receiver_sock, len(frame))
+    elapsed = time.perf_counter() - start
+    sender.join()
+    sender_sock.close()
+    receiver_sock.close()
+    return len(frame) * count / elapsed / 1e6
+
+
+def bench_recv_path(frame_size=1_000_000, count=50):
+    """
+    MB/s reading 1 MB hex frames (an encrypted v1 payload): the old concatenating reader + bytes.fromhex,
+    against recv_into a preallocated buffer + unhexlify.
+    """
+    frame = os.urandom(frame_size // 2).hex().encode()
+    before = _recv_mb_per_sec(lambda sock, size: bytes.fromhex(_legacy_recv_fixed(sock, size)), frame, count)
+    after = _recv_mb_per_sec(protocol._recv_hex, frame, count)
+    raw_before = _recv_mb_per_sec(_legacy_recv_fixed, frame, count)
+    raw_after = _recv_mb_per_sec(protocol._recv_fixed_bytes, frame, count)
+    print(f"recv_path: {frame_size:,} B frames - hex payload {before:,.0f} -> {after:,.0f} MB/s, "
+          f"raw read {raw_before:,.0f} -> {raw_after:,.0f} MB/s")
+    return before, after
+
+
+class _CountingSocket:
+    """
+    Wraps a socket and counts the receive calls (one syscall each).
+    """
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.calls = 0
+
+    def recv(self, size: int) -> bytes:
+        self.calls += 1
+        return self.sock.recv(size)
+
+    def recv_into(self, buffer, size: int) -> int:
+        self.calls += 1
+        return self.sock.recv_into(buffer, size)
+
+
+def bench_decoder(messages=20_000):
+    """
+    Receive syscalls per message and messages/sec for a burst of small encrypted server messages:
+    recv_server_msg (exact-size reads) against FrameDecoder fed with RECV_BUFFER_SIZE reads.
+    """
+    AES_key = encryption_utils.generate_AES_key()
+    stream = b"".join(protocol.create_server_msg(protocol.RESPONSE_OK, protocol.MESSAGE_TEXT, f"alice: message {i}",
+                                                 True, AES_key) for i in range(messages))
+
+    def run(receive_all) -> tuple[float, float]:
+        sender_sock, receiver_sock = socket.socketpair()
+        sender = threading.Thread(target=sender_sock.sendall, args=(stream,), daemon=True)
+        counting = _CountingSocket(receiver_sock)
+        start = time.perf_counter()
+        sender.start()
+        receive_all(counting)
+        elapsed = time.perf_counter() - start
+        sender.join()
+        sender_sock.close()
+        receiver_sock.close()
+        return counting.calls / messages, messages / elapsed
+
+    def with_recv_server_msg(sock):
+        for _ in range(messages):
+            protocol.recv_server_msg(sock, True, AES_key)
+
+    def with_decoder(sock):
+        decoder = protocol.FrameDecoder(from_client=False, encryption_enabled=True, AES_key=AES_key)
+        received = 0
+        while received < messages:
+            decoder.feed(sock.recv(protocol.RECV_BUFFER_SIZE))
+            received += sum(1 for _ in decoder)
+
+    before_calls, before_rate = run(with_recv_server_msg)
+    after_calls, after_rate = run(with_decoder)
+    print(f"decoder: recv calls/message {before_calls:.2f} -> {after_calls:.3f}, "
+          f"messages/s {before_rate:,.0f} -> {after_rate:,.0f}")
+    return before_calls, after_calls
+
+
+def bench_session_cipher(message_size=100, seconds=1.0):
+    """
+    Encrypt + decrypt round trips per second on one core: encrypt_AES/decrypt_AES (new AES-CBC context and padder per
+    message, str in and out) against one SessionCipher (AES-GCM, bytes in and out).
+    """
+    AES_key = encryption_utils.generate_AES_key()
+    session_cipher = encryption_utils.SessionCipher(AES_key)
+    text = "x" * message_size
+    data = text.encode()
+
+    def rate(round_trip) -> float:
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            for _ in range(100):
+                round_trip()
+            count += 100
+        return count / (time.perf_counter() - start)
+
+    before = rate(lambda: encryption_utils.decrypt_AES(encryption_utils.encrypt_AES(text, AES_key), AES_key))
+    after = rate(lambda: session_cipher.decrypt(session_cipher.encrypt(data)))
+    print(f"session_cipher: {message_size} B messages/s per core - AES-CBC {before:,.0f}, AES-GCM session {after:,.0f}")
+    return before, after
+
+
+async def _timed_handshake(port: int, use_X25519: bool) -> float:
+    """
+    Connects like GuiChatClient.connect (fresh keys every time) and times it until the AES key is known.
+    """
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(protocol.SERVER_ADDRESS, port)
+    await protocol.recv_server_msg_async(reader)  # hello
+    features = {protocol.FEATURE_BINARY_FRAMES, protocol.FEATURE_AEAD}
+    if use_X25519:
+        features.add(protocol.FEATURE_X25519)
+    writer.write(protocol.create_user_msg_hello(features))
+    await protocol.recv_server_msg_async(reader)  # the features to use
+
+    if use_X25519:
+        private_key, public_key = encryption_utils.generate_X25519_keys()
+        writer.write(protocol.create_user_msg_handshake(
+            protocol.X25519_PREFIX + encryption_utils.serialize_public_X25519_key(public_key), protocol.PROTOCOL_V2))
+        success, code, msg_type, data = await protocol.recv_server_msg_async(reader)
+        server_public_key = encryption_utils.deserialize_public_X25519_key(data.split(protocol.X25519_PREFIX, 1)[1])
+        encryption_utils.derive_AES_key(private_key, server_public_key)
+    else:
+        private_key, public_key = encryption_utils.generate_RSA_keys()
+        writer.write(protocol.create_user_msg_handshake(encryption_utils.serialize_public_RSA_key(public_key),
+                                                        protocol.PROTOCOL_V2))
+        success, code, msg_type, data = await protocol.recv_server_msg_async(reader)
+        encrypted_AES = bytes.fromhex(data.split(protocol.SESSION_KEY_PREFIX, 1)[1])
+        encryption_utils.decrypt_RSA(encrypted_AES, private_key)
+
+    elapsed = time.perf_counter() - start
+    writer.close()
+    return elapsed
+
+
+def bench_handshake(connections=30):
+    """
+    Connection setup latency (connect → AES key established) against a real server: RSA-OAEP with a new RSA-2048
+    key pair per connection, against ephemeral X25519 + HKDF.
+    """
+    port = _free_port()
+    process = _start_server_process(port)
+
+    async def run(use_X25519: bool) -> list[float]:
+        return [await _timed_handshake(port, use_X25519) for _ in range(connections)]
+
+    try:
+        results = {name: sorted(asyncio.run(run(use_X25519))) for name, use_X25519 in (("RSA", False), ("X25519", True))}
+    finally:
+        process.kill()
+
+    summary = ", ".join(f"{name} p50 {times[len(times) // 2] * 1000:.2f} ms / max {times[-1] * 1000:.2f} ms"
+                        for name, times in results.items())
+    print(f"handshake: {summary}")
+    return results
+
+
+class _FakeMicrophone:
+    """
+    Stands in for the pyaudio input stream: hands out `chunks` reads of synthetic PCM as fast as they are asked for,
+    then blocks like a real device (one CHUNK of silence per CHUNK of time).
+    """
+    def __init__(self, chunks: int, chunk_size: int):
+        self.remaining = chunks
+        self.done = threading.Event()
+        self.pcm = os.urandom(chunk_size)
+        self.silence = bytes(chunk_size)
+
+    def read(self, frames: int, exception_on_overflow=True) -> bytes:
+        import audio_manager
+        if self.remaining:
+            self.remaining -= 1
+            return self.pcm
+        self.done.set()
+        time.sleep(frames / audio_manager.RATE)
+        return self.silence
+
+
+class _RecordedMicrophone(_FakeMicrophone):
+    """
+    A _FakeMicrophone that hands out the given chunks of PCM.
+    """
+    def __init__(self, chunks: list[bytes]):
+        super().__init__(len(chunks), len(chunks[0]))
+        self.chunks = iter(chunks)
+
+    def read(self, frames: int, exception_on_overflow=True) -> bytes:
+        if self.remaining:
+            self.remaining -= 1
+            return next(self.chunks)
+        return super().read(frames, exception_on_overflow)
+
+
+def _fake_microphone_audio_manager(microphone: _FakeMicrophone):
+    """
+    :return: an AudioManager that records from the microphone instead of a sound device
+    """
+    import audio_manager
+
+    class FakeMicrophoneAudioManager(audio_manager.AudioManager):
+        def _open_input_stream(self):
+            return microphone
+
+        def _close_input_stream(self):
+            pass
+
+    return FakeMicrophoneAudioManager()
+
+
+def _legacy_stop_recording(frames: list[bytes]) -> bytes:
+    """
+    AudioManager.stop_recording before the incremental encoding - the baseline of bench_recording.
+    """
+    import numpy as np
+    import audio_manager
+    pcm_data = b"".join(frames)
+    pcm_array = np.frombuffer(pcm_data, dtype=np.int16)
+    encoder = audio_manager.create_encoder(audio_manager.BIT_RATE, audio_manager.CHANNELS)
+    mp3_bytes = encoder.encode(pcm_array.tobytes())
+    mp3_bytes += encoder.flush()
+    return mp3_bytes
+
+
+def bench_recording(minutes=(1, 5, 30)):
+    """
+    Peak traced memory and stop_recording latency for recordings of each length (fed faster than real time):
+    keeping the PCM and encoding it when the recording stops, against encoding it in the recording thread.
+    """
+    import audio_manager
+
+    chunk_size = audio_manager.CHUNK * audio_manager.CHANNELS * 2  # 16 bit samples
+    results = dict()
+    for length in minutes:
+        chunks = int(length * 60 * audio_manager.RATE / audio_manager.CHUNK)
+
+        tracemalloc.start()
+        microphone = _FakeMicrophone(chunks, chunk_size)
+        frames = [microphone.read(audio_manager.CHUNK) for _ in range(chunks)]
+        start = time.perf_counter()
+        _legacy_stop_recording(frames)
+        before_latency = time.perf_counter() - start
+        before_peak = tracemalloc.get_traced_memory()[1]
+        del frames
+        tracemalloc.stop()
+
+        tracemalloc.start()
+        microphone = _FakeMicrophone(chunks, chunk_size)
+        manager = _fake_microphone_audio_manager(microphone)
+        manager.start_recording()
+        microphone.done.wait()
+        start = time.perf_counter()
+        manager.stop_recording()
+        after_latency = time.perf_counter() - start
+        after_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results[length] = (before_peak, before_latency, after_peak, after_latency)
+        print(f"recording: {length} min - peak memory {before_peak / 1e6:,.1f} -> {after_peak / 1e6:,.1f} MB, "
+              f"stop latency {before_latency * 1000:,.0f} -> {after_latency * 1000:,.0f} ms")
+    return results
+
+
+def bench_recording_start(starts=10):
+    """
+    Time from pressing record to the first chunk of audio the recorder gets: a new PyAudio and input stream for every
+    recording (like before AudioDevices), against the warm input stream, whose pre-roll is there at once.
+    Needs pyaudio and a microphone.
+    """
+    try:
+        import audio_manager
+        pyaudio = audio_manager.pyaudio
+        pyaudio.PyAudio().terminate()
+    except (ImportError, OSError) as e:
+        print(f"recording_start: skipped, it needs pyaudio and a microphone ({e})")
+        return None
+
+    # the cold starts first - PortAudio is only really initialized when nothing else holds it
+    cold = []
+    for _ in range(starts):
+        start = time.perf_counter()
+        p = pyaudio.PyAudio()
+        stream = p.open(format=audio_manager.FORMAT, channels=audio_manager.CHANNELS, rate=audio_manager.RATE,
+                        input=True, frames_per_buffer=audio_manager.CHUNK)
+        stream.read(audio_manager.CHUNK, exception_on_overflow=False)
+        cold.append(time.perf_counter() - start)
+        stream.close()
+        p.terminate()
+
+    devices = audio_manager.AudioDevices()
+    devices.warm_up()
+    warm = []
+    for _ in range(starts):
+        time.sleep(audio_manager.INPUT_PRE_ROLL) # the time between two recordings fills the pre-roll
+        start = time.perf_counter()
+        devices.start_capture().read(audio_manager.CHUNK)
+        warm.append(time.perf_counter() - start)
+        devices.stop_capture()
+    devices.close()
+
+    cold.sort()
+    warm.sort()
+    print(f"recording_start: p50 {cold[len(cold) // 2] * 1000:,.1f} -> {warm[len(warm) // 2] * 1000:,.2f} ms, "
+          f"max {cold[-1] * 1000:,.1f} -> {warm[-1] * 1000:,.2f} ms, "
+          f"{audio_manager.INPUT_PRE_ROLL} s of audio from before the start")
+    return cold, warm
+
+
+def _synthetic_speech(seconds: float, seed=0):
+    """
+    Something with the energy of a voice message: phrases of voiced sound (harmonics of a wandering pitch, a few
+    syllables a second) between pauses, quiet like a laptop microphone, with 1.5 s of room noise before it and
+    2 s after it.
+    :return: the int16 samples, one column per audio_manager.CHANNELS (the same in each, like the microphone's)
+    """
+    import numpy as np
+    import audio_manager
+    rng = np.random.default_rng(seed)
+    rate = audio_manager.RATE
+    voice = np.zeros(int(seconds * rate), dtype=np.float64)
+    position = int(1.5 * rate)
+    end = len(voice) - 2 * rate
+    while position < end:
+        length = min(int(rng.uniform(1, 4) * rate), end - position)
+        t = np.arange(length) / rate
+        pitch = rng.uniform(100, 220) * (1 + 0.1 * np.sin(2 * np.pi * 0.5 * t))
+        phase = 2 * np.pi * np.cumsum(pitch) / rate
+        phrase = sum(np.sin(harmonic * phase) / harmonic for harmonic in range(1, 8))
+        phrase *= np.abs(np.sin(np.pi * rng.uniform(3, 5) * t)) ** 0.5 # syllables
+        voice[position:position + length] = phrase / np.sqrt(np.mean(phrase ** 2)) * 32768 * 10 ** (-32 / 20)
+        position += length + int(rng.uniform(0.2, 1.5) * rate)
+    voice += rng.normal(0, 32768 * 10 ** (-62 / 20), len(voice)) # room noise
+    samples = np.clip(voice, -32768, 32767).astype(np.int16)
+    return np.repeat(samples[:, None], audio_manager.CHANNELS, axis=1)
+
+
+def bench_voice_preprocessing(seconds=(10, 60, 300)):
+    """
+    mp3 bytes of a recording of each length: the microphone's channels at the fixed BIT_RATE (like before the
+    VoicePreprocessor), against what AudioManager records now (mono, trimmed, normalised, at the profile's bit
+    rates), and the time the VoicePreprocessor takes per CHUNK.
+    """
+    import audio_manager
+    from voice_processing import VoicePreprocessor
+
+    results = dict()
+    for length in seconds:
+        samples = _synthetic_speech(length)
+        chunk_size = audio_manager.CHUNK * audio_manager.CHANNELS * 2 # 16 bit samples
+        pcm = samples.tobytes()
+        chunks = [pcm[i:i + chunk_size] for i in range(0, len(pcm) - chunk_size + 1, chunk_size)]
+
+        encoder = audio_manager.create_encoder(audio_manager.BIT_RATE, audio_manager.CHANNELS)
+        before = len(encoder.encode(pcm) + encoder.flush())
+
+        microphone = _RecordedMicrophone(chunks)
+        manager = _fake_microphone_audio_manager(microphone)
+        manager.start_recording()
+        microphone.done.wait()
+        after = len(manager.stop_recording())
+        report = manager.clip_report
+
+        preprocessor = VoicePreprocessor(audio_manager.CHANNELS, audio_manager.RATE)
+        start = time.perf_counter()
+        for chunk in chunks:
+            preprocessor.process(chunk)
+        per_chunk = (time.perf_counter() - start) / len(chunks)
+
+        results[length] = (before, after, report, per_chunk)
+        bit_rates = " -> ".join(map(str, report["bit_rates"]))
+        chunk_ms = audio_manager.CHUNK * 1000 // audio_manager.RATE
+        print(f"voice_preprocessing: {length} s clip - {before:,} -> {after:,} B ({1 - after / before:.0%} smaller; "
+              f"{report['kept_seconds']:.1f} s kept, {bit_rates} kbps mono), "
+              f"preprocessing {per_chunk * 1e6:,.0f} us per {chunk_ms} ms chunk")
+    return results
+
+
+def bench_playback_start(seconds=30, plays=20):
+    """
+    Time from PlaybackEngine.play() to the first PCM handed to the output stream, for a clip that has to be decoded
+    and for a replay from the cache. The output stream is replaced by a recorder, so no sound device is needed.
+    """
+    import numpy as np
+    import audio_manager
+
+    class SilentPlaybackEngine(audio_manager.PlaybackEngine):
+        def __init__(self):
+            self.first_write = threading.Event()
+            super().__init__()
+
+        def _write(self, pcm: bytes, rate: int, channels: int):
+            self.first_write.set()
+
+    def encode(pitch: float) -> bytes:
+        samples = np.sin(np.arange(seconds * audio_manager.RATE) / pitch) * 8000
+        encoder = audio_manager.create_encoder()
+        return encoder.encode(samples.astype(np.int16).tobytes()) + encoder.flush()
+
+    clips = [encode(10 + i) for i in range(plays)]  # a clip that was not played yet for every cold start
+
+    engine = SilentPlaybackEngine()
+
+    def start_latency(clip: bytes) -> float:
+        engine.first_write.clear()
+        start = time.perf_counter()
+        engine.play(clip)
+        engine.first_write.wait()
+        elapsed = time.perf_counter() - start
+        engine.stop()
+        return elapsed
+
+    cold = sorted(start_latency(clip) for clip in clips)
+    cached = sorted(start_latency(clips[-1]) for _ in range(plays))
+    engine.close()
+    print(f"playback_start: {seconds} s clip - decode p50 {cold[len(cold) // 2] * 1000:.2f} ms, "
+          f"cached p50 {cached[len(cached) // 2] * 1000:.3f} ms")
+    return cold, cached
+
+
+def _legacy_get_audio_duration(mp3_bytes: bytes) -> float:
+    """
+    audio_manager.get_audio_duration_str before the header probe (temp file + mutagen) - the baseline of
+    bench_duration_probe.
+    """
+    from mutagen.mp3 import MP3
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmp:
+        tmp.write(mp3_bytes)
+        tmp_path = tmp.name
+    try:
+        return MP3(tmp_path).info.length
+    finally:
+        os.remove(tmp_path)
+
+
+def bench_duration_probe(clips=300, seconds=20):
+    """
+    Time to get the durations for rendering a chat with `clips` voice messages: temp file + mutagen for each,
+    against the in-memory header probe, and against rendering the same chat again (cached by content hash).
+    """
+    import numpy as np
+    import audio_manager
+
+    encoder = audio_manager.create_encoder()
+    samples = (np.sin(np.arange(seconds * audio_manager.RATE) / 10) * 8000).astype(np.int16)
+    mp3_bytes = encoder.encode(samples.tobytes()) + encoder.flush()
+    # a different (empty) ID3 tag in front of every clip, so nothing is cached in the first rendering
+    chat = [b"ID3\x04\x00\x00" + bytes((0, 0, 0, 4)) + i.to_bytes(4, "big") + mp3_bytes for i in range(clips)]
+
+    def elapsed_ms(get_duration) -> float:
+        start = time.perf_counter()
+        for clip in chat:
+            get_duration(clip)
+        return (time.perf_counter() - start) * 1000
+
+    before = elapsed_ms(_legacy_get_audio_duration)
+    cold = elapsed_ms(audio_manager.get_audio_duration)
+    cached = elapsed_ms(audio_manager.get_audio_duration)
+    print(f"duration_probe: {clips} x {seconds} s clips - temp file + mutagen {before:,.1f} ms, "
+          f"header probe {cold:,.1f} ms, cached {cached:,.2f} ms")
+    return before, cold, cached
+
+
+def _create_tk_root(name: str):
+    """
+    :return: a hidden Tk root for the GUI benchmarks, or None if there is no display
+    """
+    import tkinter as tk
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        print(f"{name}: skipped, it needs a display ({e})")
+        return None
+    root.withdraw()
+    return root
+
+
+def bench_chat_render(messages=2000):
+    """
+    Time to load a conversation of text messages into ChatArea, and to append one more message after it:
+    a widget per message (CHAT_RENDERER = "widgets") against one Text widget (CHAT_RENDERER = "text").
+    """
+    import gui_config
+    from chat_area import ChatArea
+
+    root = _create_tk_root("chat_render")
+    if root is None:
+        return None
+    history = [("alice", protocol.MESSAGE_TEXT, f"message number {i} " * 3) for i in range(messages)]
+
+    results = dict()
+    for renderer in ("widgets", "text"):
+        gui_config.CHAT_RENDERER = renderer
+        chat_area = ChatArea(root)
+        chat_area.frame.pack()
+
+        start = time.perf_counter()
+        chat_area.show_chat("General", history)
+        root.update()
+        load = time.perf_counter() - start
+
+        start = time.perf_counter()
+        chat_area.add_message("bob", protocol.MESSAGE_TEXT, "one more")
+        root.update()
+        append = time.perf_counter() - start
+
+        chat_area.frame.destroy()
+        results[renderer] = (load, append)
+
+    root.destroy()
+    summary = ", ".join(f"{renderer} load {load * 1000:,.0f} ms / append {append * 1000:,.1f} ms"
+                        for renderer, (load, append) in results.items())
+    print(f"chat_render: {messages:,} messages - {summary}")
+    return results
+
+
+def bench_chat_switch(messages=10_000, switches=10):
+    """
+    Latency of switching back and forth between two chats of `messages` text messages each:
+    drawing the chat again on every switch (a view cache of 1) against the retained views of the default cache.
+    """
+    import gui_config
+    from chat_area import ChatArea
+
+    root = _create_tk_root("chat_switch")
+    if root is None:
+        return None
+    chats = {name: [(name, protocol.MESSAGE_TEXT, f"message number {i}") for i in range(messages)]
+             for name in ("alice", "bob")}
+
+    results = dict()
+    for cache_size in (1, gui_config.CHAT_VIEW_CACHE_SIZE):
+        chat_area = ChatArea(root, cache_size)
+        chat_area.frame.pack()
+        times = []
+        for i in range(switches + 2):
+            name = ("alice", "bob")[i % 2]
+            start = time.perf_counter()
+            chat_area.show_chat(name, chats[name])
+            root.update()
+            if i >= 2:  # the first time each chat is drawn in both cases
+                times.append(time.perf_counter() - start)
+        chat_area.frame.destroy()
+        results[cache_size] = sorted(times)
+
+    root.destroy()
+    summary = ", ".join(f"cache of {cache_size}: p50 {times[len(times) // 2] * 1000:,.1f} ms"
+                        for cache_size, times in results.items())
+    print(f"chat_switch: {messages:,} messages per chat - {summary}")
+    return results
+
+
+def bench_chat_history(messages=50_000, appends=50):
+    """
+    Load time and append latency of a very long conversation: one Text widget (CHAT_RENDERER = "text") against the
+    virtualized list (CHAT_RENDERER = "virtual"), and how many canvas items the virtualized list keeps.
+    """
+    import gui_config
+    from chat_area import ChatArea
+
+    root = _create_tk_root("chat_history")
+    if root is None:
+        return None
+    root.geometry(f"{gui_config.SCREEN_WIDTH}x{gui_config.SCREEN_HEIGHT}")
+    history = [("alice", protocol.MESSAGE_TEXT, f"message number {i} " * (1 + i % 7)) for i in range(messages)]
+
+    results = dict()
+    threshold = gui_config.VIRTUAL_CHAT_THRESHOLD
+    gui_config.VIRTUAL_CHAT_THRESHOLD = messages + appends + 1 # only CHAT_RENDERER decides here
+    for renderer in ("text", "virtual"):
+        gui_config.CHAT_RENDERER = renderer
+        chat_area = ChatArea(root)
+        chat_area.frame.pack(fill="both", expand=True)
+
+        start = time.perf_counter()
+        chat_area.show_chat("General", history)
+        root.update()
+        load = time.perf_counter() - start
+
+        times = []
+        for i in range(appends):
+            start = time.perf_counter()
+            chat_area.add_message("bob", protocol.MESSAGE_TEXT, f"one more {i}")
+            root.update()
+            times.append(time.perf_counter() - start)
+        times.sort()
+
+        view = chat_area.active_view
+        items = len(view.canvas.find_all()) if renderer == "virtual" else None
+        chat_area.frame.destroy()
+        results[renderer] = (load, times[len(times) // 2], times[int(len(times) * 0.99)], items)
+    gui_config.VIRTUAL_CHAT_THRESHOLD = threshold
+
+    root.destroy()
+    summary = ", ".join(f"{renderer} load {load * 1000:,.0f} ms / append p50 {p50 * 1000:,.1f} ms p99 {p99 * 1000:,.1f} ms"
+                        + ("" if items is None else f" / {items} canvas items")
+                        for renderer, (load, p50, p99, items) in results.items())
+    print(f"chat_history: {messages:,} messages - {summary}")
+    return results
+
+
+def bench_ui_dispatch(bursts=20, burst_size=200, pause=0.05):
+    """
+    Receive-to-render latency of messages that arrive in bursts from another thread: the old loop that drained the
+    whole queue every 100 ms against UiDispatcher (woken by the network thread, budgeted frames, one scroll per frame).
+    Also the longest the Tk loop was blocked in one go, which is what the user feels as a frozen window.
+    """
+    import queue
+    import threading
+    from chat_area import ChatArea
+    from ui_dispatch import UiDispatcher
+
+    root = _create_tk_root("ui_dispatch")
+    if root is None:
+        return None
+
+    def produce(messages: queue.Queue, wake):
+        for burst in range(bursts):
+            for i in range(burst_size):
+                messages.put((time.perf_counter(), protocol.RESPONSE_OK, protocol.MESSAGE_TEXT, f"message {burst}.{i}"))
+                wake()
+            time.sleep(pause)
+
+    results = dict()
+    for mode in ("poll", "dispatcher"):
+        chat_area = ChatArea(root)
+        chat_area.frame.pack()
+        chat_area.show_chat("General", [])
+        messages = queue.Queue()
+        latencies, stalls, handled = [], [], [0]
+
+        def handle(item):
+            chat_area.add_message("alice", item[2], item[3])
+            handled[0] += 1
+
+        def timed(function):
+            # how long the Tk loop is busy with the messages each time
+            def wrapper():
+                start = time.perf_counter()
+                function()
+                stalls.append(time.perf_counter() - start)
+            return wrapper
+
+        if mode == "poll":
+            def poll():
+                received = []
+                while not messages.empty():
+                    item = messages.get()
+                    received.append(item[0])
+                    handle(item)
+                end = time.perf_counter()
+                latencies.extend(end - received_at for received_at in received)
+                if handled[0] < bursts * burst_size:
+                    root.after(100, timed(poll))
+            root.after(100, timed(poll))
+            wake = lambda: None
+        else:
+            dispatcher = UiDispatcher(root, messages, handle, chat_area.start_batch, chat_area.end_batch)
+            dispatcher.latencies = latencies # keep all of them
+            dispatcher.dispatch = timed(dispatcher.dispatch)
+            wake = dispatcher.wake
+
+        threading.Thread(target=produce, args=(messages, wake), daemon=True).start()
+        while handled[0] < bursts * burst_size:
+            root.update()
+        chat_area.frame.destroy()
+        latencies.sort()
+        results[mode] = (latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)], max(stalls))
+
+    root.destroy()
+    summary = ", ".join(f"{mode} p50 {p50 * 1000:,.1f} ms / p99 {p99 * 1000:,.1f} ms / longest stall {stall * 1000:,.1f} ms"
+                        for mode, (p50, p99, stall) in results.items())
+    print(f"ui_dispatch: {bursts} bursts of {burst_size} messages - {summary}")
+    return results
+
+
+def bench_history_store(chats=10, messages=20_000):
+    """
+    The message history: appending, opening it again (what a restart costs) and reading the pages of older messages
+    from the hot window up to the first message, and the memory the chats take - all the messages in lists (the old
+    App.chats) against MessageStore's hot window.
+    """
+    import gui_config
+    from message_store import MessageStore
+
+    def history(chat):
+        return [(f"user{i % 50}", protocol.MESSAGE_TEXT, f"{chat} message number {i} " * (1 + i % 7))
+                for i in range(messages)]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "history.db")
+
+        tracemalloc.start()
+        lists = {f"chat{chat}": history(chat) for chat in range(chats)}
+        lists_memory = tracemalloc.get_traced_memory()[0]
+        del lists
+        tracemalloc.stop()
+
+        store = MessageStore(path)
+        start = time.perf_counter()
+        for chat in range(chats):
+            store.add_chat(f"chat{chat}")
+            for sender, message_type, text in history(chat):
+                store.append(f"chat{chat}", sender, message_type, text)
+        append = (time.perf_counter() - start) / (chats * messages)
+        store.close()
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        store = MessageStore(path)
+        reopen = time.perf_counter() - start
+        store_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        # scroll up through the whole chat, like the chat area does
+        loaded = len(store.recent("chat0"))
+        page_times = []
+        while True:
+            start = time.perf_counter()
+            page = store.older("chat0", loaded)
+            page_times.append(time.perf_counter() - start)
+            if not page:
+                break
+            loaded += len(page)
+        assert loaded == messages
+        older, deepest = page_times[0], page_times[-2]
+        store.close()
+
+    print(f"history_store: {chats} chats of {messages:,} messages - append {append * 1e6:,.1f} us, "
+          f"reopen {reopen * 1000:,.1f} ms, older page {older * 1000:,.2f} ms (at the first message "
+          f"{deepest * 1000:,.2f} ms), "
+          f"memory {lists_memory / 2 ** 20:,.1f} MB in lists vs {store_memory / 2 ** 20:,.1f} MB hot window")
+    return append, reopen, older, lists_memory, store_memory
+
+
+def bench_history_search(messages=1_000_000, chats=20, searches=20):
+    """
+    Searching the message history: a word, a prefix, and a word in one chat from one sender, over `messages`
+    text messages. The history is written in one transaction, like MessageStore.append would write it message by
+    message, to keep the setup short.
+    """
+    import random
+    from message_store import MessageStore
+
+    words = [f"{syllable}{suffix}" for syllable in ("ka", "lo", "mi", "ne", "ru", "ta", "vo", "zi")
+             for suffix in ("", "ba", "do", "fen", "gar", "hul", "jem", "kip", "lor", "mas")] # 80 words
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as directory:
+        store = MessageStore(os.path.join(directory, "history.db"))
+        for chat in range(chats):
+            store.add_chat(f"chat{chat}")
+
+        start = time.perf_counter()
+        with store.db:
+            for i in range(messages):
+                text = " ".join(rng.choices(words, k=rng.randint(3, 12)))
+                if i % 10_000 == 0:
+                    text += " needle"
+                cursor = store.db.execute("INSERT INTO messages (chat, sender, type, content) VALUES (?, ?, ?, ?)",
+                                          (f"chat{i % chats}", f"user{i % 100}", protocol.MESSAGE_TEXT, text))
+                store.db.execute("INSERT INTO messages_index (rowid, text) VALUES (?, ?)", (cursor.lastrowid, text))
+        build = time.perf_counter() - start
+
+        queries = {
+            "rare word": lambda: store.search("needle"),
+            "common word": lambda: store.search("kaba"),
+            "prefix": lambda: store.search("zig*"),
+            "two words": lambda: store.search("lofen rumas"),
+            "chat and sender": lambda: store.search("mi", chat_name="chat3", sender="user43"),
+        }
+        results = dict()
+        for name, query in queries.items():
+            times = []
+            for _ in range(searches):
+                start = time.perf_counter()
+                found = query()
+                times.append(time.perf_counter() - start)
+            assert found, name
+            results[name] = sorted(times)[len(times) // 2]
+        store.close()
+
+    summary = ", ".join(f"{name} {seconds * 1000:,.2f} ms" for name, seconds in results.items())
+    print(f"history_search: {messages:,} messages (written in {build:,.0f} s) - p50 {summary}")
+    return results
+
+
+def bench_client_send(messages=20_000):
+    """
+    A burst of small messages from GuiChatClient to a real server: a write per frame (COALESCE_SIZE = 0) against
+    the outbound queue joining the queued frames. Reports the writes it took and the time until every send Future
+    was done.
+    """
+    import concurrent.futures
+    import gui_client
+
+    port = _free_port()
+    process = _start_server_process(port)
+    coalesce_size = gui_client.COALESCE_SIZE
+    results = dict()
+    try:
+        for mode, size in (("write per frame", 0), ("coalesced", coalesce_size)):
+            gui_client.COALESCE_SIZE = size
+            client = gui_client.GuiChatClient(protocol.SERVER_ADDRESS, port)
+            client.connect(f"sender{size}").result()
+            concurrent.futures.wait([client.send_message(protocol.MESSAGE_TEXT, "/set_password password")])
+            while client.incoming_messages.get()[1] != protocol.RESPONSE_CREATED_USER:
+                pass
+
+            writes = [0]
+            write = client.writer.write
+            def counting_write(data):
+                writes[0] += 1
+                write(data)
+            client.writer.write = counting_write
+
+            start = time.perf_counter()
+            futures = [client.send_message(protocol.MESSAGE_TEXT, f"message number {i}") for i in range(messages)]
+            concurrent.futures.wait(futures)
+            elapsed = time.perf_counter() - start
+            assert all(future.result() for future in futures)
+            client.close()
+            results[mode] = (writes[0], elapsed)
+    finally:
+        gui_client.COALESCE_SIZE = coalesce_size
+        process.kill()
+
+    summary = ", ".join(f"{mode} {writes:,} writes in {elapsed * 1000:,.0f} ms ({messages / elapsed:,.0f} msg/s)"
+                        for mode, (writes, elapsed) in results.items())
+    print(f"client_send: {messages:,} messages - {summary}")
+    return results
+
+
+def bench_login_stall(logins=5):
+    """
+    The longest time the UI thread could not run during a login, for each handshake: waiting for connect() like the
+    Tk callback did before the login ran in the background, against a UI thread that wakes every ms and takes the
+    login's progress messages from the queue. Also the time from cancel_connect() to the LOGIN_CANCELLED message,
+    against a server that never says hello.
+    """
+    import gui_client
+
+    def background_login(client: gui_client.GuiChatClient, username: str) -> float:
+        login = client.connect(username)
+        longest = 0.0
+        last = time.perf_counter()
+        while not login.done() or not client.incoming_messages.empty():
+            time.sleep(0.001)
+            while not client.incoming_messages.empty():
+                client.incoming_messages.get_nowait()
+            now = time.perf_counter()
+            longest = max(longest, now - last)
+            last = now
+        return longest
+
+    port = _free_port()
+    process = _start_server_process(port)
+    handshakes = {"x25519": protocol.SUPPORTED_FEATURES,
+                  "rsa": protocol.SUPPORTED_FEATURES - {protocol.FEATURE_X25519}}
+    results = dict()
+    try:
+        for name, features in handshakes.items():
+            blocking, background = [], []
+            for i in range(logins):
+                client = gui_client.GuiChatClient(protocol.SERVER_ADDRESS, port, features)
+                start = time.perf_counter()
+                client.connect(f"{name}blocking{i}").result()
+                blocking.append(time.perf_counter() - start)
+                client.close()
+
+                client = gui_client.GuiChatClient(protocol.SERVER_ADDRESS, port, features)
+                background.append(background_login(client, f"{name}{i}"))
+                client.close()
+            results[name] = (max(blocking), max(background))
+    finally:
+        process.kill()
+
+    # a server that accepts the connection and then says nothing
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as silent_server:
+        silent_server.bind((protocol.SERVER_ADDRESS, 0))
+        silent_server.listen()
+        client = gui_client.GuiChatClient(protocol.SERVER_ADDRESS, silent_server.getsockname()[1])
+        client.connect("patient")
+        time.sleep(0.1)
+        start = time.perf_counter()
+        client.cancel_connect()
+        while client.incoming_messages.get()[3] != gui_client.LOGIN_CANCELLED:
+            pass
+        cancel_latency = time.perf_counter() - start
+        client.close()
+
+    summary = ", ".join(f"{name} {before * 1000:,.1f} -> {after * 1000:,.1f} ms"
+                        for name, (before, after) in results.items())
+    print(f"login_stall: longest UI stall over {logins} logins - {summary}; "
+          f"cancel {cancel_latency * 1000:,.2f} ms")
+    return results, cancel_latency
+
+
+def _chat_corpus(messages: int) -> tuple[list[str], str]:
+    """
+    :return: text messages to measure with, and where they came from: the histories recorded in HISTORY_DIR,
+             or else messages made of the comments and docstrings of this repository (English prose, no history
+             needed)
+    """
+    import glob
+    import random
+    import sqlite3
+    import gui_config
+
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(gui_config.HISTORY_DIR, "*.db"))):
+        with sqlite3.connect(path) as db:
+            corpus += [content for content, in db.execute("SELECT content FROM messages WHERE type = ?",
+                                                          (protocol.MESSAGE_TEXT,))]
+    if corpus:
+        return corpus[-messages:], f"the histories in {gui_config.HISTORY_DIR}"
+
+    lines = []
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.py"))):
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                line = line.strip().lstrip("#").strip()
+                if len(line) > 20 and not line.startswith((":", "return", "def ", "import ", "from ")):
+                    lines.append(line)
+    rng = random.Random(0)
+    for _ in range(messages):
+        # chat messages are mostly short - a line, sometimes a few
+        start = rng.randrange(len(lines))
+        corpus.append(" ".join(lines[start:start + rng.choice((1, 1, 1, 2, 3, 5))]))
+    return corpus, "the comments and docstrings of this repository"
+
+
+def bench_compression(messages=5000):
+    """
+    Bytes on the wire for a corpus of text messages as the server sends them (encrypted v2 frames), without
+    compression and with each negotiable compression, and the time it takes to build the frames.
+    """
+    corpus, source = _chat_corpus(messages)
+    key = encryption_utils.generate_AES_key()
+    results = dict()
+    compressions = {"none": protocol.COMPRESSION_NONE, "zlib": protocol.COMPRESSION_ZLIB}
+    if protocol.zstandard is not None:
+        compressions["zstd"] = protocol.COMPRESSION_ZSTD
+    for name, compression in compressions.items():
+        cipher = encryption_utils.SessionCipher(key)
+        start = time.perf_counter()
+        frames = [protocol.create_server_msg(protocol.RESPONSE_OK, protocol.MESSAGE_TEXT, f"alice: {text}", True,
+                                             cipher, protocol.PROTOCOL_V2, compression) for text in corpus]
+        elapsed = time.perf_counter() - start
+        compressed = sum(frame[2] != protocol.MESSAGE_TEXT for frame in frames) # the message type byte of the header
+        results[name] = (sum(map(len, frames)), compressed, elapsed / len(corpus))
+
+    plain = results["none"][0]
+    summary = ", ".join(f"{name} {size:,} B ({1 - size / plain:.0%} saved, {compressed:,} frames compressed, "
+                        f"{seconds * 1e6:,.1f} us/message)" for name, (size, compressed, seconds) in results.items())
+    print(f"compression: {len(corpus):,} messages from {source} - {summary}")
+    return results
+
+
+MICRO_PROCESSES = 3 # fresh processes the micro benchmarks run in, one after the other - the median counts. Calls of a
+                    # microsecond are up to 1.5x faster in one process than in another (memory layout, hash seed)
+MICRO_REPEATS = 3 # runs of every micro benchmark in a process - the fastest counts, the others were slowed down by
+                  # something else. The runs are passes over all of them, so a slow moment of the machine slows down
+                  # one run of a benchmark, not all of them
+MICRO_MIN_TIME = 0.05 # seconds that one run takes at least
+MICRO_TOLERANCE = 0.2 # slower than the baseline by more than this (20%) is a regression
+MICRO_TEXT_SIZES = (10, 1_000) # bytes
+MICRO_VOICE_SIZES = (100_000, 1_000_000) # bytes
+
+
+def _size_name(size: int) -> str:
+    for unit, scale in (("MB", 1_000_000), ("kB", 1_000)):
+        if size >= scale:
+            return f"{size / scale:g} {unit}"
+    return f"{size} B"
+
+
+class _TimedCalls:
+    """
+    Like timeit: the number of calls in a run is doubled (the first time) until a run takes MICRO_MIN_TIME.
+    """
+    def __init__(self, function):
+        self.timer = timeit.Timer(function)
+        self.number = None
+
+    def __call__(self) -> float:
+        """
+        :return: seconds per call, of one run
+        """
+        if self.number is None:
+            self.number = 1
+            while self.timer.timeit(self.number) < MICRO_MIN_TIME:
+                self.number *= 2
+        return self.timer.timeit(self.number) / self.number
+
+
+def _time_recv_per_call(receive, frame: bytes) -> float:
+    """
+    Streams copies of `frame` through a socketpair and times receive(sock) reading them on the other end.
+    :return: seconds per frame, of one run
+    """
+    count = max(10, min(2_000, 20_000_000 // len(frame)))
+    sender_sock, receiver_sock = socket.socketpair()
+    sender = threading.Thread(target=sender_sock.sendall, args=(frame * count,), daemon=True)
+    start = time.perf_counter()
+    sender.start()
+    for _ in range(count):
+        if not receive(receiver_sock)[0]:
+            raise RuntimeError("the frame could not be read")
+    elapsed = time.perf_counter() - start
+    sender.join()
+    sender_sock.close()
+    receiver_sock.close()
+    return elapsed / count
+
+
+def _micro_cases() -> tuple[list[tuple[str, object, int]], list[str]]:
+    """
+    The micro benchmarks: the wire path functions, for text of MICRO_TEXT_SIZES and voice of MICRO_VOICE_SIZES.
+    The payloads and keys are made once, with a fixed seed where the contents could matter.
+    :return: ([(name, a function that runs it once and returns the seconds per call, payload bytes)],
+             [why benchmarks were skipped])
+    """
+    rng = random.Random(0)
+    AES_key = encryption_utils.generate_AES_key()
+    session_cipher = encryption_utils.SessionCipher(AES_key)
+    private_key, public_key = encryption_utils.generate_RSA_keys()
+    public_pem = encryption_utils.serialize_public_RSA_key(public_key)
+    # v1 frames are encrypted with the AES key, v2 frames with the session cipher - what the app negotiates
+    versions = {"v1": (protocol.PROTOCOL_V1, AES_key), "v2": (protocol.PROTOCOL_V2, session_cipher)}
+
+    # (name, message type, size, {version name: data}) - voice is hex in v1, like the app sends it
+    payloads = [(f"text {_size_name(size)}", protocol.MESSAGE_TEXT, size, dict.fromkeys(versions, "x" * size))
+                for size in MICRO_TEXT_SIZES]
+    for size in MICRO_VOICE_SIZES:
+        voice = rng.randbytes(size)
+        payloads.append((f"voice {_size_name(size)}", protocol.MESSAGE_VOICE, size, {"v1": voice.hex(), "v2": voice}))
+
+    cases = []
+    skipped = []
+
+    def add_call(name: str, function, size=0):
+        cases.append((name, _TimedCalls(function), size))
+
+    def add_recv(name: str, receive, frame: bytes, size=0):
+        cases.append((name, functools.partial(_time_recv_per_call, receive, frame), size))
+
+    # v1 length fields have LENGTH_FIELD_SIZE digits - the 1 MB voice only fits in a v2 frame
+    fits_v1 = {name: len(data["v1"]) * 2 < 10 ** protocol.LENGTH_FIELD_SIZE for name, _, _, data in payloads}
+    for name, message_type, size, data in payloads:
+        if fits_v1[name]:
+            add_call(f"_pad_with_length/{name}", functools.partial(protocol._pad_with_length, data["v1"]), size)
+
+    add_call("create_user_msg_hello", functools.partial(protocol.create_user_msg_hello, protocol.SUPPORTED_FEATURES))
+    add_call("create_user_msg_resume", functools.partial(protocol.create_user_msg_resume, "t" * 64,
+                                                         protocol.PROTOCOL_V2))
+    add_call("create_user_msg_handshake", functools.partial(protocol.create_user_msg_handshake, public_pem,
+                                                            protocol.PROTOCOL_V2))
+    for version_name, (version, key) in versions.items():
+        add_call(f"create_user_msg_set_username/{version_name}",
+                 functools.partial(protocol.create_user_msg_set_username, "alice", True, key, version))
+        add_call(f"create_user_msg_set_password/{version_name}",
+                 functools.partial(protocol.create_user_msg_set_password, "alice", "password", True, key, version))
+        for name, message_type, size, data in payloads:
+            if version == protocol.PROTOCOL_V1 and not fits_v1[name]:
+                continue
+            broadcast = protocol.create_user_msg_broadcast("alice", message_type, data[version_name], True, key,
+                                                           version)
+            server_msg = protocol.create_server_msg(protocol.RESPONSE_OK, message_type, data[version_name], True, key,
+                                                    version)
+            add_call(f"create_user_msg_broadcast/{version_name} {name}",
+                     functools.partial(protocol.create_user_msg_broadcast, "alice", message_type, data[version_name],
+                                       True, key, version), size)
+            add_call(f"create_user_msg_private/{version_name} {name}",
+                     functools.partial(protocol.create_user_msg_private, "alice", "bob", message_type,
+                                       data[version_name], True, key, version), size)
+            add_call(f"create_server_msg/{version_name} {name}",
+                     functools.partial(protocol.create_server_msg, protocol.RESPONSE_OK, message_type,
+                                       data[version_name], True, key, version), size)
+            add_recv(f"recv_client_msg/{version_name} {name}",
+                     functools.partial(protocol.recv_client_msg, encryption_enabled=True, encryption_key=key),
+                     broadcast, size)
+            add_recv(f"recv_server_msg/{version_name} {name}",
+                     functools.partial(protocol.recv_server_msg, encryption_enabled=True, AES_key=key),
+                     server_msg, size)
+
+    chunk = rng.randbytes(protocol.VOICE_CHUNK_SIZE)
+    add_call("create_user_msg_voice_chunk", functools.partial(protocol.create_user_msg_voice_chunk, "alice", "", 0, 0,
+                                                              False, chunk, True, session_cipher), len(chunk))
+    add_call("create_server_msg_voice_chunk",
+             functools.partial(protocol.create_server_msg_voice_chunk, "alice",
+                               protocol.create_stream_field(0, 0, False), chunk, True, session_cipher), len(chunk))
+
+    for name, message_type, size, data in payloads:
+        plain = data["v2"] if isinstance(data["v2"], bytes) else data["v2"].encode()
+        size_name = name.split(" ", 1)[1]
+        cipher_text = encryption_utils.encrypt_AES(plain, AES_key)
+        add_call(f"encrypt_AES/{size_name}", functools.partial(encryption_utils.encrypt_AES, plain, AES_key), size)
+        add_call(f"decrypt_AES/{size_name}", functools.partial(encryption_utils.decrypt_AES, cipher_text, AES_key,
+                                                               True), size)
+        sealed = session_cipher.encrypt(plain)
+        add_call(f"SessionCipher.encrypt/{size_name}", functools.partial(session_cipher.encrypt, plain), size)
+        add_call(f"SessionCipher.decrypt/{size_name}", functools.partial(session_cipher.decrypt, sealed), size)
+
+    # the RSA handshake step by step: the client's keys, the server encrypting the session key, the client decrypting
+    session_key = encryption_utils.serialize_AES_key(AES_key)
+    encrypted_session_key = encryption_utils.encrypt_RSA(session_key, public_key)
+    add_call("RSA handshake/generate_RSA_keys", encryption_utils.generate_RSA_keys)
+    add_call("RSA handshake/serialize_public_RSA_key",
+             functools.partial(encryption_utils.serialize_public_RSA_key, public_key))
+    add_call("RSA handshake/encrypt_RSA", lambda: encryption_utils.encrypt_RSA(
+        session_key, encryption_utils.deserialize_public_RSA_key(public_pem)))
+    add_call("RSA handshake/decrypt_RSA", functools.partial(encryption_utils.decrypt_RSA, encrypted_session_key,
+                                                            private_key))
+
+    try:
+        import numpy as np
+        import audio_manager
+    except ImportError as e:
+        skipped.append(f"get_audio_duration_str skipped, it needs the audio packages ({e})")
+    else:
+        encoder = audio_manager.create_encoder()
+        samples = (np.sin(np.arange(20 * audio_manager.RATE) / 10) * 8000).astype(np.int16)
+        mp3_bytes = encoder.encode(samples.tobytes()) + encoder.flush()
+
+        def probe() -> str:
+            audio_manager._duration_cache.clear()
+            return audio_manager.get_audio_duration_str(mp3_bytes)
+
+        add_call("get_audio_duration_str/probe", probe, len(mp3_bytes))
+        add_call("get_audio_duration_str/cached", functools.partial(audio_manager.get_audio_duration_str, mp3_bytes),
+                 len(mp3_bytes))
+    return cases, skipped
+
+
+def _run_micro_benchmarks() -> tuple[dict[str, tuple[float, int]], list[str]]:
+    """
+    One process of bench_micro: MICRO_REPEATS passes over all the micro benchmarks.
+    :return: ({name: (seconds per call of the fastest run, payload bytes)}, [why benchmarks were skipped])
+    """
+    cases, skipped = _micro_cases()
+    best = dict.fromkeys((name for name, run, size in cases), float("inf"))
+    for _ in range(MICRO_REPEATS):
+        for name, run, size in cases:
+            best[name] = min(best[name], run())
+    return {name: (best[name], size) for name, run, size in cases}, skipped
+
+
+def bench_micro(json_path: str = None, baseline_path: str = None, tolerance=MICRO_TOLERANCE):
+    """
+    Time per call of the hot functions of the wire path (framing, parsing, encryption, the RSA handshake and the
+    voice duration), from 10 B text to 1 MB voice.
+    :param json_path: Where to write the results as JSON, to be the baseline of a later run
+    :param baseline_path: The JSON of an earlier run (on the same machine) to compare with
+    :param tolerance: How much slower than the baseline is a regression, 0.2 for 20%
+    :return: (the results, the names of the regressions)
+    """
+    baseline = None
+    if baseline_path:
+        with open(baseline_path) as file:
+            baseline = json.load(file)["results"]
+
+    # spawned, not forked, so every process gets its own memory layout and hash seed
+    runs = []
+    for _ in range(MICRO_PROCESSES):
+        with multiprocessing.get_context("spawn").Pool(1) as pool:
+            runs.append(pool.apply(_run_micro_benchmarks))
+    for reason in runs[0][1]:
+        print(f"micro: {reason}")
+
+    times = {name: sorted(run[0][name][0] for run in runs) for name in runs[0][0]}
+    results = dict()
+    regressions = []
+    for name, (_, size) in runs[0][0].items():
+        seconds = times[name][len(runs) // 2]
+        results[name] = {"seconds": seconds, "bytes": size}
+        line = f"micro: {name:<48} {seconds * 1e6:>14,.2f} us"
+        if size:
+            line += f" {size / seconds / 1e6:>10,.1f} MB/s"
+        if baseline is not None:
+            if name not in baseline:
+                line += " (not in the baseline)"
+            else:
+                ratio = seconds / baseline[name]["seconds"]
+                line += f"  {ratio:5.2f}x the baseline"
+                if ratio > 1 + tolerance:
+                    regressions.append(name)
+                    line += " REGRESSION"
+        print(line)
+
+    if json_path:
+        with open(json_path, "w") as file:
+            json.dump({"python": platform.python_version(), "platform": platform.platform(), "results": results}, file,
+                      indent=1)
+        print(f"micro: {len(results)} results written to {json_path}")
+    if baseline is not None:
+        print(f"micro: {len(regressions)} of {len(results)} more than {tolerance:.0%} slower than {baseline_path}"
+              + (f": {', '.join(regressions)}" if regressions else ""))
+    return results, regressions
+
+
+BENCHMARKS = {
+    "server_throughput": bench_server_throughput,
+    "frame_sizes": bench_frame_sizes,
+    "recv_path": bench_recv_path,
+    "decoder": bench_decoder,
+    "session_cipher": bench_session_cipher,
+    "handshake": bench_handshake,
+    "recording": bench_recording,
+    "voice_preprocessing": bench_voice_preprocessing,
+    "recording_start": bench_recording_start,
+    "playback_start": bench_playback_start,
+    "duration_probe": bench_duration_probe,
+    "chat_render": bench_chat_render,
+    "chat_switch": bench_chat_switch,
+    "chat_history": bench_chat_history,
+    "ui_dispatch": bench_ui_dispatch,
+    "history_store": bench_history_store,
+    "history_search": bench_history_search,
+    "client_send": bench_client_send,
+    "login_stall": bench_login_stall,
+    "compression": bench_compression,
+    "micro": bench_micro,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat benchmarks")
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run (default: all): {', '.join(BENCHMARKS)}")
+    parser.add_argument("--json", help="write the results of the micro benchmarks to this file")
+    parser.add_argument("--baseline", help="compare the micro benchmarks with this file (written by --json), "
+                                           "and exit with 1 if any of them got slower")
+    parser.add_argument("--tolerance", type=float, default=MICRO_TOLERANCE,
+                        help=f"how much slower than the baseline is a regression (default: {MICRO_TOLERANCE})")
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+    names = args.names or (["micro"] if args.json or args.baseline else BENCHMARKS)
+    regressions = []
+    for name in names:
+        if name == "micro":
+            regressions = bench_micro(args.json, args.baseline, args.tolerance)[1]
+        else:
+            BENCHMARKS[name]()
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
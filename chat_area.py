@@ -1,95 +1,246 @@
 import tkinter as tk
+from collections import OrderedDict
 from typing import Literal, Callable
 import gui_config
+import metrics
 import protocol
-from scrollable_canvas_frame import ScrollableCanvasWithFrame
+from chat_text_view import ChatTextView
+from chat_widget_view import ChatWidgetView
+from chat_virtual_view import ChatVirtualView
 from audio_manager import play_audio, get_audio_duration_str
+from voice_stream import VoiceStream
 
 class ChatArea:
-    def __init__(self, parent: tk.Tk):
+    def __init__(self, parent: tk.Tk, cache_size=gui_config.CHAT_VIEW_CACHE_SIZE,
+                 load_older: Callable[[str, int], list] | None = None):
+        """
+        :param parent: The parent widget
+        :param cache_size: How many chats keep their drawn view while another chat is shown
+        :param load_older: Called when the user scrolls to the top of a chat: (chat name, how many of its newest
+                           messages are shown) -> the messages before them, oldest first ([] if there are none)
+        """
         self.frame: tk.Frame = tk.Frame(parent, bg=gui_config.BG_COLOR)
-        self.scrollable_frame = ScrollableCanvasWithFrame(self.frame)
+        self.cache_size = cache_size
+        self.load_older = load_older
+
+        # { chat_name: view } - switching back to a chat shows its view again instead of drawing it from scratch.
+        # least recently shown first, the shown chat is last
+        self.views: OrderedDict[str, ChatTextView | ChatWidgetView | ChatVirtualView] = OrderedDict()
+        self.active_chat = None
+        self.message_counts: dict[str, int] = dict() # { chat_name: how many messages its view shows }
+        self._loading_older = set() # chats whose older messages are about to be loaded
+        self._all_loaded = set() # chats whose view shows all of their messages
+
+        # the views that got messages since start_batch() - they are scrolled once, by end_batch()
+        self._batch_views = None
 
+    @property
+    def active_view(self) -> ChatTextView | ChatWidgetView | ChatVirtualView | None:
+        return self.views.get(self.active_chat)
+
+    def _create_view(self, chat_name: str, message_count: int) -> ChatTextView | ChatWidgetView | ChatVirtualView:
+        on_scroll_top = lambda: self._schedule_load_older(chat_name)
+        # see gui_config.CHAT_RENDERER and gui_config.VIRTUAL_CHAT_THRESHOLD
+        if gui_config.CHAT_RENDERER == "virtual" or message_count >= gui_config.VIRTUAL_CHAT_THRESHOLD:
+            return ChatVirtualView(self.frame, self.create_voice_message, on_scroll_top)
+        if gui_config.CHAT_RENDERER == "text":
+            return ChatTextView(self.frame, self.create_voice_message, on_scroll_top)
+        return ChatWidgetView(self.frame, self.create_voice_message, on_scroll_top)
+
+    @metrics.timed(sample_every=1)
+    def show_chat(self, chat_name: str, messages: list):
+        """
+        Shows the chat. Its view is reused if it is still cached, otherwise it is drawn from the messages.
+        :param chat_name: The chat to show
+        :param messages: The newest messages of the chat (only used if its view has to be drawn) - the older ones
+                         are loaded with load_older when the user scrolls up
+        :return:
+        """
+        if chat_name == self.active_chat:
+            return
+        if self.active_view is not None:
+            self.active_view.frame.pack_forget()
+
+        view = self.views.get(chat_name)
+        if view is None:
+            view = self.views[chat_name] = self._create_view(chat_name, len(messages))
+            self.active_chat = chat_name
+            self.message_counts[chat_name] = 0
+            self._all_loaded.discard(chat_name)
+            self.load_messages(messages)
+        else:
+            self.views.move_to_end(chat_name)
+            self.active_chat = chat_name
+        view.frame.pack(fill=tk.BOTH, expand=True)
+
+        # forget the views that were not shown for the longest time - they are drawn again when needed
+        while len(self.views) > max(self.cache_size, 1):
+            evicted_chat, evicted_view = self.views.popitem(last=False)
+            evicted_view.frame.destroy()
+            del self.message_counts[evicted_chat]
 
     def clear(self):
         """
-        Clears the entire chat area from all widgets - that is, removes them from the frame...
+        Clears the shown chat from all widgets - that is, removes them from the frame...
         :return:
         """
-        for widget in self.scrollable_frame.scroll_frame.winfo_children():
-            widget.destroy()
+        if self.active_view is not None:
+            self.active_view.clear()
+            self.message_counts[self.active_chat] = 0
 
+    @metrics.timed(sample_every=1)
     def load_messages(self, messages: list[(str, str)]):
         """
-        Loads all the messages to the chat area.
+        Loads all the messages to the shown chat.
         :param messages: The messages to be loaded
         :return:
         """
-        for sender, text, message_type in messages:
-            self.add_message(sender, text, message_type)
+        view = self.active_view
+        for sender, message_type, content in messages:
+            self._add_to_view(view, sender, message_type, content)
+        self.message_counts[self.active_chat] += len(messages)
+        view.scroll_to_bottom()
 
-    def add_message(self, sender: str, message_type: Literal[0, 1], content: str):
+    @metrics.timed(sample_every=1)
+    def add_message(self, sender: str, message_type: Literal[0, 1], content: str | bytes | VoiceStream, chat=None):
         """
         Adds the specific message to the chat area
         :param sender: The sender of the message
         :param message_type: The type of the message. i.e: voice message, or text message.
         :param content: The content of the message
+        :param chat: The chat of the message (default: the shown one). Nothing happens if its view is not cached,
+                     as it is drawn from all of its messages when it is shown.
         :return:
         """
-        if message_type == protocol.MESSAGE_TEXT:
-            widget = self.create_text_message(sender, content)
-        elif message_type == protocol.MESSAGE_VOICE:
-            widget = self.create_voice_message(sender, content)
+        chat = self.active_chat if chat is None else chat
+        view = self.views.get(chat)
+        if view is None:
+            return
+        self._add_to_view(view, sender, message_type, content)
+        self.message_counts[chat] += 1
+        if self._batch_views is None:
+            view.scroll_to_bottom()
         else:
+            self._batch_views.add(view)
+
+    def start_batch(self):
+        """
+        The messages added until end_batch() scroll their views once, together.
+        :return:
+        """
+        if self._batch_views is None:
+            self._batch_views = set()
+
+    @metrics.timed(sample_every=1)
+    def end_batch(self):
+        """
+        Scrolls the views that got messages since start_batch().
+        :return:
+        """
+        views, self._batch_views = self._batch_views, None
+        for view in views or ():
+            if view.frame.winfo_exists(): # it may have been evicted in the meantime
+                view.scroll_to_bottom()
+
+    def scroll_to_message(self, newer: int):
+        """
+        Scrolls the shown chat to one of its messages, loading the older messages up to it first.
+        :param newer: How many of the chat's messages are newer than it
+        :return:
+        """
+        chat_name = self.active_chat
+        while (self.load_older is not None and self.message_counts[chat_name] <= newer
+               and chat_name not in self._all_loaded):
+            self._load_older(chat_name)
+        index = self.message_counts[chat_name] - 1 - newer
+        if index >= 0:
+            self.active_view.scroll_to_message(index)
+
+    def _schedule_load_older(self, chat_name: str):
+        # the views call it while they scroll - the messages are loaded once Tk is idle
+        if self.load_older is None or chat_name in self._all_loaded or chat_name in self._loading_older:
+            return
+        self._loading_older.add(chat_name)
+        self.frame.after_idle(lambda: self._load_older(chat_name))
+
+    def _load_older(self, chat_name: str):
+        """
+        Adds a page of older messages to the top of the chat's view.
+        """
+        self._loading_older.discard(chat_name)
+        view = self.views.get(chat_name)
+        if view is None: # evicted in the meantime
+            return
+        messages = self.load_older(chat_name, self.message_counts[chat_name])
+        if not messages:
+            self._all_loaded.add(chat_name)
+            return
+        for sender, message_type, content in messages:
+            self._check_message_type(message_type)
+        view.prepend_messages(messages)
+        self.message_counts[chat_name] += len(messages)
+
+    def _check_message_type(self, message_type):
+        if message_type not in (protocol.MESSAGE_TEXT, protocol.MESSAGE_VOICE):
             raise ValueError(f"message_type must be of type string, and one of two values: 0 or 1.\n\t"
                              f"Provided: {message_type}")
-        widget.pack(anchor="w", fill=tk.X, padx=5, pady=5)
-        self.scrollable_frame.scroll_canvas_to_bottom()
 
+    def _add_to_view(self, view: ChatTextView | ChatWidgetView | ChatVirtualView, sender: str,
+                     message_type: Literal[0, 1], content: str | bytes | VoiceStream):
+        self._check_message_type(message_type)
+        view.add_message(sender, message_type, content)
 
-    def create_text_message(self, sender: str, text: str) -> tk.Widget:
+    def create_voice_message(self, sender, audio_data: str | bytes | VoiceStream, parent: tk.Widget) -> tk.Widget:
         """
-        Creates a text widget that looks like this: sender (in bold): text
+        Creates a widget that represents the voice message.
         :param sender: The sender of the message
-        :param text: The message itself
-        :return: The text widget representing that message to be displayed on the canvas
+        :param audio_data: The mp3 bytes, their hex representation (protocol v1),
+                           or a VoiceStream - it can be played while it is still arriving
+        :param parent: The widget to create it in (given by the view)
+        :return:
         """
-        text_widget: tk.Text = tk.Text(
-            self.scrollable_frame.scroll_frame,
-            wrap="word",
-            font=gui_config.MSG_FONT,
+        if isinstance(audio_data, VoiceStream):
+            return self._create_streamed_voice_message(sender, audio_data, parent)
+
+        frame = tk.Frame(parent, bg="red")
+        sender_label = tk.Label(frame, text=sender, font=gui_config.MSG_SENDER_FONT, bg="green")
+        container = tk.Frame(frame, bg="blue", relief="ridge", bd=1)
+
+        mp3_bytes = audio_data if isinstance(audio_data, bytes) else bytes.fromhex(audio_data)
+        play_button = tk.Button(
+            container,
+            text="➤",
             bg=gui_config.BG_COLOR,
+            fg=gui_config.TEXT_COLOR,
+            activebackground=gui_config.BG_COLOR,
+            activeforeground=gui_config.TEXT_COLOR,
             bd=0,
-            relief="flat",
-            height=10,
+            command=lambda: play_audio(mp3_bytes),
+            width=2
         )
+        duration_str  = get_audio_duration_str(mp3_bytes=mp3_bytes)
+        duration_label = tk.Label(container, text=duration_str, bg="orange", font=gui_config.MSG_FONT)
 
-        text_widget.tag_configure("sender", font=gui_config.MSG_SENDER_FONT, foreground=gui_config.TEXT_COLOR)
-        text_widget.tag_configure("message", font=gui_config.MSG_FONT, foreground=gui_config.TEXT_COLOR)
-
-        # "sender (bold): then message"
-        text_widget.insert("end", f"{sender}\n", "sender")
-        text_widget.insert("end", f"{text}", "message")
-        text_widget.config(state="disabled")
+        sender_label.pack(anchor="w")
+        play_button.pack(side="left", padx=4, pady=2)
+        duration_label.pack(side="right", padx=4)
+        container.pack(anchor="w", pady=2)
 
-        # according to ChatGPT:
-        text_widget.update_idletasks()
-        num_lines = int(text_widget.index('end-1c').split('.')[0])
-        text_widget.config(height=num_lines)
-        return text_widget
+        return frame
 
-    def create_voice_message(self, sender, audio_data: str) -> tk.Widget:
+    def _create_streamed_voice_message(self, sender, stream: VoiceStream, parent: tk.Widget) -> tk.Widget:
         """
-        Creates a widget that represents the voice message.
+        Creates a widget that represents a voice message that may still be arriving.
+        The play button plays whatever arrived so far, the duration is shown once it is complete.
         :param sender: The sender of the message
-        :param audio_data: The hex representation of the audio
+        :param stream: The voice message
+        :param parent: The widget to create it in
         :return:
         """
-        frame = tk.Frame(self.scrollable_frame.scroll_frame, bg="red")
+        frame = tk.Frame(parent, bg="red")
         sender_label = tk.Label(frame, text=sender, font=gui_config.MSG_SENDER_FONT, bg="green")
         container = tk.Frame(frame, bg="blue", relief="ridge", bd=1)
 
-        mp3_bytes = bytes.fromhex(audio_data)
         play_button = tk.Button(
             container,
             text="➤",
@@ -98,11 +249,20 @@ class ChatArea:
             activebackground=gui_config.BG_COLOR,
             activeforeground=gui_config.TEXT_COLOR,
             bd=0,
-            command=lambda: play_audio(mp3_bytes),
+            command=lambda: play_audio(stream.get_bytes()),
             width=2
         )
-        duration_str  = get_audio_duration_str(mp3_bytes=mp3_bytes)
-        duration_label = tk.Label(container, text=duration_str, bg="orange", font=gui_config.MSG_FONT)
+        duration_label = tk.Label(container, text="...", bg="orange", font=gui_config.MSG_FONT)
+
+        def show_duration():
+            # the chat may have been switched (and this widget destroyed) in the meantime
+            if duration_label.winfo_exists():
+                duration_label.config(text=get_audio_duration_str(mp3_bytes=stream.get_bytes()))
+
+        if stream.complete:
+            show_duration()
+        else:
+            stream.on_complete.append(show_duration)
 
         sender_label.pack(anchor="w")
         play_button.pack(side="left", padx=4, pady=2)
@@ -0,0 +1,146 @@
+import tkinter as tk
+from typing import Callable
+import gui_config
+import protocol
+
+class ChatTextView:
+    """
+    Draws a whole conversation into one Text widget: the sender and the body of a message are tagged text,
+    and only voice messages are embedded widgets. Appending a message costs the same however long the history is.
+    Has the same methods as ChatWidgetView.
+    """
+    def __init__(self, parent, create_voice_message: Callable[[str, object, tk.Widget], tk.Widget],
+                 on_scroll_top: Callable[[], None] | None = None):
+        """
+        :param parent: The parent widget
+        :param create_voice_message: Creates the widget of a voice message: (sender, audio data, parent) -> widget
+        :param on_scroll_top: Called when the user scrolled to the first message, e.g. to load older ones
+        """
+        self.create_voice_message = create_voice_message
+        self.on_scroll_top = on_scroll_top
+        self.frame = tk.Frame(parent, bg=gui_config.BG_COLOR)
+
+        self.text = tk.Text(
+            self.frame,
+            wrap="word",
+            font=gui_config.MSG_FONT,
+            bg=gui_config.BG_COLOR,
+            fg=gui_config.TEXT_COLOR,
+            bd=0,
+            relief="flat",
+            padx=10,
+            pady=5,
+            cursor="arrow",
+            state="disabled",
+        )
+        self.scrollbar = tk.Scrollbar(self.frame, orient="vertical", command=self._on_scrollbar)
+        self.text.configure(yscrollcommand=self.scrollbar.set)
+        # only the user's scrolling loads older messages - not the view moving while a chat is drawn
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>", "<Prior>"):
+            self.text.bind(sequence, self._on_user_scroll, add="+")
+        self.scrollbar.pack(side="right", fill="y")
+        self.text.pack(side="left", fill=tk.BOTH, expand=True)
+        self.messages_parent = self.text # embedded message widgets are created in it
+
+        self.text.tag_configure("sender", font=gui_config.MSG_SENDER_FONT, foreground=gui_config.TEXT_COLOR,
+                                spacing1=10)
+        self.text.tag_configure("message", font=gui_config.MSG_FONT, foreground=gui_config.TEXT_COLOR)
+
+    def clear(self):
+        """
+        Removes every message (and destroys the embedded voice message widgets).
+        :return:
+        """
+        for widget in self.text.winfo_children():
+            widget.destroy()
+        self.text.config(state="normal")
+        self.text.delete("1.0", "end")
+        self.text.config(state="disabled")
+
+    def add_message(self, sender: str, message_type, content):
+        """
+        Appends a message.
+        :param sender: The sender of the message
+        :param message_type: The type of the message. i.e: voice message, or text message.
+        :param content: The content of the message
+        :return:
+        """
+        if message_type == protocol.MESSAGE_TEXT:
+            self.add_text_message(sender, content)
+        else:
+            self.add_widget_message(self.create_voice_message(sender, content, self.messages_parent))
+
+    def prepend_messages(self, messages: list):
+        """
+        Inserts older messages before the first one, without moving what the user sees.
+        :param messages: (sender, message type, content) of each message, oldest first
+        :return:
+        """
+        self.text.config(state="normal")
+        self.text.mark_set("previous_top", "@0,0") # moves down with the text that is inserted before it
+        for sender, message_type, content in reversed(messages):
+            if message_type == protocol.MESSAGE_TEXT:
+                self.text.insert("1.0", f"{sender}\n", "sender", f"{content}\n", "message")
+            else:
+                self.text.insert("1.0", "\n")
+                self.text.window_create("1.0", window=self.create_voice_message(sender, content, self.text),
+                                        padx=5, pady=5)
+        self.text.config(state="disabled")
+        self.text.yview("previous_top")
+
+    def add_text_message(self, sender: str, text: str):
+        """
+        Appends a text message: the sender (in bold) and the text under it.
+        :param sender: The sender of the message
+        :param text: The message itself
+        :return:
+        """
+        self.text.config(state="normal")
+        self.text.insert("end", f"{sender}\n", "sender", f"{text}\n", "message")
+        self.text.config(state="disabled")
+
+    def add_widget_message(self, widget: tk.Widget):
+        """
+        Appends a message that is a widget, e.g. a voice message. The widget has to be a child of self.messages_parent.
+        :param widget: The widget that represents the message
+        :return:
+        """
+        self.text.config(state="normal")
+        self.text.window_create("end", window=widget, padx=5, pady=5)
+        self.text.insert("end", "\n")
+        self.text.config(state="disabled")
+
+    def scroll_to_message(self, index: int):
+        """
+        Scrolls so that the message is at the top.
+        :param index: The message, counted from the first one shown
+        :return:
+        """
+        # a text message starts at its sender line, a voice message is its embedded widget
+        starts = [str(start) for start in self.text.tag_ranges("sender")[::2]]
+        starts += [self.text.index(window) for window in self.text.window_names()]
+        starts.sort(key=lambda position: tuple(map(int, position.split("."))))
+        if 0 <= index < len(starts):
+            self.text.yview(starts[index])
+
+    def _on_scrollbar(self, *args):
+        self.text.yview(*args)
+        self._on_user_scroll()
+
+    def _on_user_scroll(self, event=None):
+        # checked once Tk is idle - the Text's own bindings scroll after this one
+        self.text.after_idle(self._check_scroll_top)
+
+    def _check_scroll_top(self):
+        if self.on_scroll_top is None or not self.text.winfo_exists():
+            return
+        first, last = self.text.yview()
+        if first <= 0 and last < 1:
+            self.on_scroll_top()
+
+    def scroll_to_bottom(self):
+        """
+        Scrolls to the last message.
+        :return:
+        """
+        self.text.see("end")
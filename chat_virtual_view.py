@@ -0,0 +1,329 @@
+import math
+import tkinter as tk
+import tkinter.font as tkfont
+from typing import Callable
+import gui_config
+import protocol
+
+OVERSCAN = 600 # pixels above and below the viewport whose messages are drawn too, so scrolling does not show gaps
+MESSAGE_PADDING = 10 # pixels between messages
+ESTIMATED_VOICE_HEIGHT = 70 # pixels - the height of a voice message that was never drawn
+TEXT_MARGIN = 15 # pixels to the left of the messages
+
+
+class _HeightIndex:
+    """
+    The heights of the messages in a Fenwick tree: appending, changing a height, the y of a message and the message
+    at some y all take O(log n).
+    """
+    def __init__(self, heights=()):
+        """
+        :param heights: The heights to start with - built in O(n)
+        """
+        self.heights = list(heights)
+        self._tree = [0] + self.heights # 1-based
+        for index in range(1, len(self._tree)):
+            parent = index + (index & -index)
+            if parent < len(self._tree):
+                self._tree[parent] += self._tree[index]
+
+    def __len__(self):
+        return len(self.heights)
+
+    def append(self, height: int):
+        self.heights.append(height)
+        index = len(self.heights)
+        # the new node covers the `lowbit` heights that end with this one
+        self._tree.append(height + self.top(index - 1) - self.top(index - (index & -index)))
+
+    def update(self, index: int, height: int):
+        delta = height - self.heights[index]
+        self.heights[index] = height
+        index += 1
+        while index < len(self._tree):
+            self._tree[index] += delta
+            index += index & -index
+
+    def top(self, index: int) -> int:
+        """
+        :return: the y where message `index` starts (the sum of the heights before it)
+        """
+        total = 0
+        while index > 0:
+            total += self._tree[index]
+            index -= index & -index
+        return total
+
+    @property
+    def total(self) -> int:
+        return self.top(len(self.heights))
+
+    def find(self, y: int) -> int:
+        """
+        :return: the index of the message at height y (len(self) if y is below the last one)
+        """
+        index = 0
+        step = 1 << len(self._tree).bit_length()
+        while step:
+            if index + step < len(self._tree) and self._tree[index + step] <= y:
+                index += step
+                y -= self._tree[index]
+            step >>= 1
+        return index
+
+
+class ChatVirtualView:
+    """
+    Draws a conversation as a list that only creates what is near the viewport.
+    Text messages are canvas text items that are reused as the user scrolls, and voice messages are created when they
+    scroll into view and destroyed when they leave it. The rest only has a height - measured once a message was drawn,
+    estimated from its length before that. Memory and the cost of appending stay flat for very long histories.
+    Has the same methods as ChatTextView.
+    """
+    def __init__(self, parent, create_voice_message: Callable[[str, object, tk.Widget], tk.Widget],
+                 on_scroll_top: Callable[[], None] | None = None):
+        """
+        :param parent: The parent widget
+        :param create_voice_message: Creates the widget of a voice message: (sender, audio data, parent) -> widget
+        :param on_scroll_top: Called when the user scrolled to the first message, e.g. to load older ones
+        """
+        self.create_voice_message = create_voice_message
+        self.on_scroll_top = on_scroll_top
+        self.frame = tk.Frame(parent, bg=gui_config.BG_COLOR)
+
+        self.canvas = tk.Canvas(self.frame, bg=gui_config.BG_COLOR, highlightthickness=0)
+        self.scrollbar = tk.Scrollbar(self.frame, orient="vertical", command=self._on_scrollbar)
+        self.canvas.configure(yscrollcommand=self.scrollbar.set)
+        self.scrollbar.pack(side="right", fill="y")
+        self.canvas.pack(side="left", fill=tk.BOTH, expand=True)
+        self.messages_parent = self.canvas # voice message widgets are created in it
+
+        self.canvas.bind("<MouseWheel>", lambda event: self._scroll(-int(event.delta / 60), "units"))
+        self.canvas.bind("<Button-4>", lambda event: self._scroll(-3, "units"))
+        self.canvas.bind("<Button-5>", lambda event: self._scroll(3, "units"))
+        self.canvas.bind("<Configure>", self._on_resize)
+
+        self.sender_font = tkfont.Font(font=gui_config.MSG_SENDER_FONT)
+        self.message_font = tkfont.Font(font=gui_config.MSG_FONT)
+
+        self.messages = [] # (sender, message_type, content)
+        self.heights = _HeightIndex()
+        self.measured = [] # whether the height of each message was measured or is an estimate
+
+        self.drawn: dict[int, tuple] = dict() # { index: canvas items of the message }
+        self._free_text_items = [] # (sender item, message item) pairs to reuse
+        self._refresh_scheduled = False
+        self._follow_bottom = True # keep showing the newest message as messages are added
+        self._user_scrolled = False # only the user's scrolling loads older messages, not drawing a chat
+        self._width = 0
+
+    def clear(self):
+        """
+        Removes every message.
+        :return:
+        """
+        for index in list(self.drawn):
+            self._undraw(index)
+        self.messages = []
+        self.heights = _HeightIndex()
+        self.measured = []
+        self._follow_bottom = True
+        self._update_scroll_region()
+
+    def add_message(self, sender: str, message_type, content):
+        """
+        Appends a message. Nothing is drawn unless it is near the viewport.
+        :param sender: The sender of the message
+        :param message_type: The type of the message. i.e: voice message, or text message.
+        :param content: The content of the message
+        :return:
+        """
+        self.messages.append((sender, message_type, content))
+        self.heights.append(self._estimate_height(message_type, content))
+        self.measured.append(False)
+        self._schedule_refresh() # it updates the scroll region too
+
+    def prepend_messages(self, messages: list):
+        """
+        Inserts older messages before the first one, without moving what the user sees.
+        :param messages: (sender, message type, content) of each message, oldest first
+        :return:
+        """
+        if not messages:
+            return
+        top = self.canvas.canvasy(0)
+        added_heights = [self._estimate_height(message_type, content) for _, message_type, content in messages]
+
+        # every index moves - the height index is built again, the drawn messages keep their items
+        self.heights = _HeightIndex(added_heights + self.heights.heights)
+        self.messages = list(messages) + self.messages
+        self.measured = [False] * len(messages) + self.measured
+        self.drawn = {index + len(messages): items for index, items in self.drawn.items()}
+
+        self._update_scroll_region()
+        self.canvas.yview_moveto((top + sum(added_heights)) / max(self.heights.total, 1))
+        self._schedule_refresh()
+
+    def scroll_to_bottom(self):
+        """
+        Scrolls to the last message.
+        :return:
+        """
+        self._follow_bottom = True
+        self.canvas.yview_moveto(1.0)
+        self._schedule_refresh()
+
+    def scroll_to_message(self, index: int):
+        """
+        Scrolls so that the message is at the top.
+        :param index: The message, counted from the first one shown
+        :return:
+        """
+        if not 0 <= index < len(self.messages):
+            return
+        self._follow_bottom = False
+        self._update_scroll_region()
+        self.canvas.yview_moveto(self.heights.top(index) / max(self.heights.total, 1))
+        self._schedule_refresh()
+
+    def _scroll(self, amount: int, what: str):
+        self.canvas.yview_scroll(amount, what)
+        self._follow_bottom = self.canvas.yview()[1] >= 1.0
+        self._user_scrolled = True
+        self._schedule_refresh()
+
+    def _on_scrollbar(self, *args):
+        self.canvas.yview(*args)
+        self._follow_bottom = self.canvas.yview()[1] >= 1.0
+        self._user_scrolled = True
+        self._schedule_refresh()
+
+    def _on_resize(self, event):
+        if event.width != self._width:
+            # the text wraps differently now - the measured heights become estimates again
+            self._width = event.width
+            self.measured = [False] * len(self.messages)
+            for index, items in self.drawn.items():
+                if self.messages[index][1] == protocol.MESSAGE_TEXT:
+                    self.canvas.itemconfigure(items[1], width=self._text_width())
+        self._schedule_refresh()
+
+    def _update_scroll_region(self):
+        # the size comes from the heights - no bbox("all") over every item
+        self.canvas.configure(scrollregion=(0, 0, self.canvas.winfo_width(), self.heights.total))
+
+    def _text_width(self) -> int:
+        return max(self.canvas.winfo_width() - 2 * TEXT_MARGIN, 100)
+
+    def _estimate_height(self, message_type, content) -> int:
+        if message_type != protocol.MESSAGE_TEXT:
+            return ESTIMATED_VOICE_HEIGHT
+        characters_per_line = max(self._text_width() // self.message_font.measure("0"), 1)
+        lines = sum(max(math.ceil(len(line) / characters_per_line), 1) for line in content.split("\n"))
+        return (self.sender_font.metrics("linespace") + lines * self.message_font.metrics("linespace")
+                + MESSAGE_PADDING)
+
+    def _schedule_refresh(self):
+        # many changes in a row (e.g. loading a chat) are handled by one refresh
+        if not self._refresh_scheduled:
+            self._refresh_scheduled = True
+            self.canvas.after_idle(self._refresh)
+
+    def _refresh(self):
+        """
+        Draws the messages near the viewport at their place and frees the ones that left it.
+        """
+        self._refresh_scheduled = False
+        if not self.canvas.winfo_exists():
+            return
+        if self._follow_bottom:
+            self.canvas.yview_moveto(1.0)
+
+        top = self.canvas.canvasy(0) - OVERSCAN
+        bottom = self.canvas.canvasy(self.canvas.winfo_height()) + OVERSCAN
+        first = min(self.heights.find(max(int(top), 0)), len(self.messages))
+
+        # draw from the first visible message down. Measuring may change heights, which moves the ones below
+        visible = set()
+        index = first
+        y = self.heights.top(first)
+        while index < len(self.messages) and y < bottom:
+            self._draw(index, y)
+            visible.add(index)
+            y += self.heights.heights[index]
+            index += 1
+
+        for index in [index for index in self.drawn if index not in visible]:
+            self._undraw(index)
+
+        user_scrolled, self._user_scrolled = self._user_scrolled, False
+        if (user_scrolled and self.on_scroll_top is not None and self.canvas.canvasy(0) <= 0
+                and self.heights.total > self.canvas.winfo_height()):
+            self.on_scroll_top()
+
+        if self.heights.total != self._scroll_height():
+            self._update_scroll_region()
+            if self._follow_bottom:
+                self.canvas.yview_moveto(1.0)
+
+    def _scroll_height(self) -> int:
+        scroll_region = self.canvas.cget("scrollregion").split()
+        return int(float(scroll_region[3])) if len(scroll_region) == 4 else 0
+
+    def _draw(self, index: int, y: int):
+        """
+        Puts message `index` at y, creating (or reusing) its items if it is not drawn yet, and measures it.
+        """
+        sender, message_type, content = self.messages[index]
+        items = self.drawn.get(index)
+        if items is None:
+            if message_type == protocol.MESSAGE_TEXT:
+                if self._free_text_items:
+                    items = self._free_text_items.pop()
+                    self.canvas.itemconfigure(items[0], text=sender, state="normal")
+                    self.canvas.itemconfigure(items[1], text=content, width=self._text_width(), state="normal")
+                else:
+                    items = (
+                        self.canvas.create_text(TEXT_MARGIN, 0, anchor="nw", text=sender,
+                                                font=gui_config.MSG_SENDER_FONT, fill=gui_config.TEXT_COLOR),
+                        self.canvas.create_text(TEXT_MARGIN, 0, anchor="nw", text=content,
+                                                font=gui_config.MSG_FONT, fill=gui_config.TEXT_COLOR,
+                                                width=self._text_width()),
+                    )
+            else:
+                widget = self.create_voice_message(sender, content, self.canvas)
+                # its height is known only once it was laid out
+                widget.bind("<Configure>", lambda event: self._schedule_refresh(), add="+")
+                items = (self.canvas.create_window(TEXT_MARGIN, 0, anchor="nw", window=widget), widget)
+            self.drawn[index] = items
+
+        if message_type == protocol.MESSAGE_TEXT:
+            sender_item, message_item = items
+            self.canvas.coords(sender_item, TEXT_MARGIN, y)
+            self.canvas.coords(message_item, TEXT_MARGIN, y + self.sender_font.metrics("linespace"))
+            if not self.measured[index]:
+                x1, y1, x2, y2 = self.canvas.bbox(message_item)
+                self._set_height(index, y2 - y + MESSAGE_PADDING)
+        else:
+            window_item, widget = items
+            self.canvas.coords(window_item, TEXT_MARGIN, y)
+            # a new widget has no size until it was laid out - keep the estimate until then
+            if not self.measured[index] and widget.winfo_reqheight() > 1:
+                self._set_height(index, widget.winfo_reqheight() + MESSAGE_PADDING)
+
+    def _set_height(self, index: int, height: int):
+        self.measured[index] = True
+        if height != self.heights.heights[index]:
+            self.heights.update(index, height)
+
+    def _undraw(self, index: int):
+        items = self.drawn.pop(index)
+        sender, message_type, content = self.messages[index]
+        if message_type == protocol.MESSAGE_TEXT:
+            for item in items:
+                self.canvas.itemconfigure(item, state="hidden")
+            self._free_text_items.append(items)
+        else:
+            window_item, widget = items
+            self.canvas.delete(window_item)
+            widget.destroy()
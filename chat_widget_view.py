@@ -0,0 +1,149 @@
+import tkinter as tk
+from typing import Callable
+import gui_config
+import protocol
+from scrollable_canvas_frame import ScrollableCanvasWithFrame
+
+class ChatWidgetView:
+    """
+    Draws a conversation as a widget per message, stacked in a scrollable canvas.
+    Has the same methods as ChatTextView.
+    """
+    def __init__(self, parent, create_voice_message: Callable[[str, object, tk.Widget], tk.Widget],
+                 on_scroll_top: Callable[[], None] | None = None):
+        """
+        :param parent: The parent widget
+        :param create_voice_message: Creates the widget of a voice message: (sender, audio data, parent) -> widget
+        :param on_scroll_top: Called when the user scrolled to the first message, e.g. to load older ones
+        """
+        self.create_voice_message = create_voice_message
+        self.on_scroll_top = on_scroll_top
+        self.frame = tk.Frame(parent, bg=gui_config.BG_COLOR)
+        self.scrollable_frame = ScrollableCanvasWithFrame(self.frame)
+        self.messages_parent = self.scrollable_frame.scroll_frame # message widgets are created in it
+        # only the user's scrolling loads older messages - not the view moving while a chat is drawn
+        self.scrollable_frame.scrollbar.configure(command=self._on_scrollbar)
+        self.scrollable_frame.canvas.bind("<MouseWheel>", self._on_user_scroll, add="+")
+
+    def clear(self):
+        """
+        Clears the view from all widgets - that is, removes them from the frame...
+        :return:
+        """
+        for widget in self.scrollable_frame.scroll_frame.winfo_children():
+            widget.destroy()
+
+    def add_message(self, sender: str, message_type, content):
+        """
+        Appends a message.
+        :param sender: The sender of the message
+        :param message_type: The type of the message. i.e: voice message, or text message.
+        :param content: The content of the message
+        :return:
+        """
+        self.add_widget_message(self._create_message_widget(sender, message_type, content))
+
+    def prepend_messages(self, messages: list):
+        """
+        Inserts older messages before the first one, without moving what the user sees.
+        :param messages: (sender, message type, content) of each message, oldest first
+        :return:
+        """
+        canvas = self.scrollable_frame.canvas
+        first_widget = next(iter(self.messages_parent.pack_slaves()), None)
+        previous_height = self.messages_parent.winfo_reqheight()
+        top = canvas.canvasy(0)
+        for sender, message_type, content in messages:
+            widget = self._create_message_widget(sender, message_type, content)
+            if first_widget is None:
+                self.add_widget_message(widget)
+            else:
+                widget.pack(anchor="w", fill=tk.X, padx=5, pady=5, before=first_widget)
+
+        canvas.update_idletasks()
+        canvas.configure(scrollregion=canvas.bbox("all"))
+        height = self.messages_parent.winfo_reqheight()
+        canvas.yview_moveto((top + height - previous_height) / max(height, 1))
+
+    def _create_message_widget(self, sender: str, message_type, content) -> tk.Widget:
+        if message_type == protocol.MESSAGE_TEXT:
+            return self._create_text_widget(sender, content)
+        return self.create_voice_message(sender, content, self.messages_parent)
+
+    def add_text_message(self, sender: str, text: str):
+        """
+        Appends a text widget that looks like this: sender (in bold): text
+        :param sender: The sender of the message
+        :param text: The message itself
+        :return:
+        """
+        self.add_widget_message(self._create_text_widget(sender, text))
+
+    def _create_text_widget(self, sender: str, text: str) -> tk.Text:
+        text_widget: tk.Text = tk.Text(
+            self.messages_parent,
+            wrap="word",
+            font=gui_config.MSG_FONT,
+            bg=gui_config.BG_COLOR,
+            bd=0,
+            relief="flat",
+            height=10,
+        )
+
+        text_widget.tag_configure("sender", font=gui_config.MSG_SENDER_FONT, foreground=gui_config.TEXT_COLOR)
+        text_widget.tag_configure("message", font=gui_config.MSG_FONT, foreground=gui_config.TEXT_COLOR)
+
+        # "sender (bold): then message"
+        text_widget.insert("end", f"{sender}\n", "sender")
+        text_widget.insert("end", f"{text}", "message")
+        text_widget.config(state="disabled")
+
+        # according to ChatGPT:
+        text_widget.update_idletasks()
+        num_lines = int(text_widget.index('end-1c').split('.')[0])
+        text_widget.config(height=num_lines)
+        return text_widget
+
+    def add_widget_message(self, widget: tk.Widget):
+        """
+        Appends a message that is a widget, e.g. a voice message. The widget has to be a child of self.messages_parent.
+        :param widget: The widget that represents the message
+        :return:
+        """
+        widget.pack(anchor="w", fill=tk.X, padx=5, pady=5)
+
+    def scroll_to_message(self, index: int):
+        """
+        Scrolls so that the message is at the top.
+        :param index: The message, counted from the first one shown
+        :return:
+        """
+        widgets = self.messages_parent.pack_slaves()
+        if not 0 <= index < len(widgets):
+            return
+        canvas = self.scrollable_frame.canvas
+        canvas.update_idletasks()
+        canvas.configure(scrollregion=canvas.bbox("all"))
+        canvas.yview_moveto(widgets[index].winfo_y() / max(self.messages_parent.winfo_reqheight(), 1))
+
+    def _on_scrollbar(self, *args):
+        self.scrollable_frame.canvas.yview(*args)
+        self._on_user_scroll()
+
+    def _on_user_scroll(self, event=None):
+        self.scrollable_frame.canvas.after_idle(self._check_scroll_top)
+
+    def _check_scroll_top(self):
+        canvas = self.scrollable_frame.canvas
+        if self.on_scroll_top is None or not canvas.winfo_exists():
+            return
+        first, last = canvas.yview()
+        if first <= 0 and last < 1:
+            self.on_scroll_top()
+
+    def scroll_to_bottom(self):
+        """
+        Scrolls to the last message.
+        :return:
+        """
+        self.scrollable_frame.scroll_canvas_to_bottom()
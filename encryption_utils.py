@@ -1,12 +1,19 @@
 # found this library that does RSA and AES automatically: https://cryptography.io/en/latest/
 import os
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.asymmetric import rsa, padding, x25519
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives import padding as symmetric_padding
 from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
+import metrics
 
+HKDF_INFO = b"whispr session key"
+
+
+@metrics.timed(sample_every=1)
 def generate_RSA_keys() -> (rsa.RSAPrivateKey, rsa.RSAPublicKey):
     """
     Generates both private and public keys to be used in RSA algorithm.
@@ -48,6 +55,7 @@ def deserialize_public_RSA_key(public_key_str) -> rsa.RSAPublicKey:
     return serialization.load_pem_public_key(pem_bytes)
 
 
+@metrics.timed(sample_every=1)
 def encrypt_RSA(message: str, public_key: rsa.RSAPublicKey) -> bytes:
     """
     Encrypts the message using the provided public key.
@@ -70,6 +78,7 @@ def encrypt_RSA(message: str, public_key: rsa.RSAPublicKey) -> bytes:
     )
     return cipher_text
 
+@metrics.timed(sample_every=1)
 def decrypt_RSA(cipher_text: bytes, private_key: rsa.RSAPrivateKey) -> str:
     """
     Decrypts the cipher_text using the provided private key.
@@ -93,6 +102,51 @@ def decrypt_RSA(cipher_text: bytes, private_key: rsa.RSAPrivateKey) -> str:
     return plain_text.decode()
 
 
+def generate_X25519_keys() -> (x25519.X25519PrivateKey, x25519.X25519PublicKey):
+    """
+    Generates an ephemeral X25519 key pair - much cheaper than an RSA key pair, so it can be made for every connection.
+    :return: A tuple: (private key, public key)
+    """
+    private_key = x25519.X25519PrivateKey.generate()
+    return private_key, private_key.public_key()
+
+
+def serialize_public_X25519_key(public_key: x25519.X25519PublicKey) -> str:
+    """
+    Takes a public key object and returns its 32 raw bytes as a hex string.
+    :param public_key: The public key to serialize
+    :return: A string representation of the public key
+    """
+    if not isinstance(public_key, x25519.X25519PublicKey):
+        raise TypeError(f"public_key must be an X25519PublicKey.\n\tProvided: {public_key}")
+    return public_key.public_bytes(encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw).hex()
+
+
+def deserialize_public_X25519_key(public_key_str: str) -> x25519.X25519PublicKey:
+    """
+    Takes the hex string of a public key and returns a public key object.
+    :param public_key_str: The string representation of the public key to deserialize
+    :return: The public key
+    """
+    return x25519.X25519PublicKey.from_public_bytes(bytes.fromhex(public_key_str))
+
+
+@metrics.timed(sample_every=1)
+def derive_AES_key(private_key: x25519.X25519PrivateKey, peer_public_key: x25519.X25519PublicKey) -> bytes:
+    """
+    Both sides of an X25519 key agreement get the same 256-bit AES key out of this.
+    The shared secret goes through HKDF-SHA256, bound to both public keys.
+    :param private_key: Our private key
+    :param peer_public_key: The other side's public key
+    :return: The AES key
+    """
+    shared_secret = private_key.exchange(peer_public_key)
+    public_keys = sorted(key.public_bytes(encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+                         for key in (private_key.public_key(), peer_public_key))
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                info=HKDF_INFO + b"".join(public_keys)).derive(shared_secret)
+
+
 def generate_AES_key() -> bytes:
     """
     Generates a 256-bit AES key.
@@ -118,15 +172,18 @@ def deserialize_AES_key(AES_key_str: str) -> bytes:
     return bytes.fromhex(AES_key_str)
 
 
-def encrypt_AES(message: str, key: bytes) -> bytes:
+@metrics.timed()
+def encrypt_AES(message: str | bytes, key: bytes) -> bytes:
     """
     Encrypts the message using AES-CBC and prepends the IV to the ciphertext.
-    :param message: plaintext message
+    :param message: plaintext message (str, or bytes for binary payloads)
     :param key: AES key (must be 32 bytes for AES-256)
     :return: IV + ciphertext (as bytes)
     """
-    if not isinstance(message, str):
-        raise TypeError(f"message must be a str\n\tProvided: {message}")
+    if isinstance(message, str):
+        message = message.encode()
+    if not isinstance(message, (bytes, bytearray)):
+        raise TypeError(f"message must be a str or bytes\n\tProvided: {message}")
     if not isinstance(key, (bytes, bytearray)) or len(key) != 32:
         raise ValueError("key must be 32 bytes for AES-256")
 
@@ -134,7 +191,7 @@ def encrypt_AES(message: str, key: bytes) -> bytes:
 
     # pad the message to be multiple of block size
     padder = symmetric_padding.PKCS7(128).padder()
-    padded_data = padder.update(message.encode()) + padder.finalize()
+    padded_data = padder.update(message) + padder.finalize()
 
     cipher = Cipher(algorithms.AES(key), modes.CBC(iv))
     encryptor = cipher.encryptor()
@@ -142,20 +199,23 @@ def encrypt_AES(message: str, key: bytes) -> bytes:
 
     return iv + cipher_text  # prepend IV
 
-def decrypt_AES(cipher_text: bytes, key: bytes) -> str:
+@metrics.timed()
+def decrypt_AES(cipher_text: bytes, key: bytes, raw=False) -> str | bytes:
     """
     Decrypts AES-CBC ciphertext that has IV prepended.
-    :param cipher_text: IV + ciphertext
+    :param cipher_text: IV + ciphertext (a memoryview is decrypted in place, without copying it first)
     :param key: AES key (must be 32 bytes for AES-256)
+    :param raw: return the plaintext bytes instead of decoding them to a str
     :return: plaintext message
     """
-    if not isinstance(cipher_text, (bytes, bytearray)):
+    if not isinstance(cipher_text, (bytes, bytearray, memoryview)):
         raise TypeError(f"cipher_text must be bytes\n\tProvided: {cipher_text}")
     if not isinstance(key, (bytes, bytearray)) or len(key) != 32:
         raise ValueError("key must be 32 bytes for AES-256")
 
-    iv = cipher_text[:16] # first 16 bytes = IV
-    actual_ciphertext = cipher_text[16:]
+    cipher_view = memoryview(cipher_text)
+    iv = bytes(cipher_view[:16]) # first 16 bytes = IV
+    actual_ciphertext = cipher_view[16:]
 
     cipher = Cipher(algorithms.AES(key), modes.CBC(iv))
     decryptor = cipher.decryptor()
@@ -165,4 +225,45 @@ def decrypt_AES(cipher_text: bytes, key: bytes) -> str:
     unpadder = symmetric_padding.PKCS7(128).unpadder()
     plain_text = unpadder.update(decrypted_padded) + unpadder.finalize()
 
-    return plain_text.decode()
+    return plain_text if raw else plain_text.decode()
+
+
+class SessionCipher:
+    """
+    AES-256-GCM for the whole lifetime of one connection.
+    The key is set up once, so every message only costs a fresh random nonce - no new Cipher objects and no padding.
+    The tag authenticates every message, so a tampered ciphertext fails to decrypt instead of decrypting to garbage.
+    """
+    NONCE_SIZE = 12  # 96-bit nonces, as recommended for GCM
+
+    def __init__(self, key: bytes):
+        """
+        :param key: AES key (must be 32 bytes for AES-256)
+        """
+        if not isinstance(key, (bytes, bytearray)) or len(key) != 32:
+            raise ValueError("key must be 32 bytes for AES-256")
+        self.key = bytes(key)
+        self._aead = AESGCM(self.key)
+
+    @metrics.timed()
+    def encrypt(self, data: bytes, associated_data: bytes = None) -> bytes:
+        """
+        Encrypts the data and prepends the nonce to the ciphertext.
+        :param data: plaintext bytes
+        :param associated_data: bytes that are authenticated but not encrypted (e.g. the frame header)
+        :return: nonce + ciphertext + tag
+        """
+        nonce = os.urandom(self.NONCE_SIZE)
+        return nonce + self._aead.encrypt(nonce, data, associated_data)
+
+    @metrics.timed()
+    def decrypt(self, cipher_text: bytes, associated_data: bytes = None) -> bytes:
+        """
+        Decrypts what encrypt() returned.
+        :param cipher_text: nonce + ciphertext + tag (a memoryview is not copied)
+        :param associated_data: the same associated data that was given to encrypt()
+        :return: plaintext bytes
+        :raise cryptography.exceptions.InvalidTag: if the message was tampered with or the key is wrong
+        """
+        cipher_view = memoryview(cipher_text)
+        return self._aead.decrypt(bytes(cipher_view[:self.NONCE_SIZE]), cipher_view[self.NONCE_SIZE:], associated_data)
@@ -1,133 +1,595 @@
+import asyncio
+import concurrent.futures
 import queue
-import socket
 import threading
-from typing import Literal
-
-import select
+import time
+from collections import deque
+from typing import Literal, Callable
 
 import encryption_utils
+import metrics
 import protocol
+from voice_stream import VoiceStreamAssembler
+
+RECONNECT_DELAYS = (0.5, 1, 2, 4) # in seconds - the waits before each reconnect attempt
+COALESCE_SIZE = 64 * 1024 # small frames queued together are joined into writes of up to this many bytes
+MAX_OUTBOUND_SIZE = 4 * 1024 * 1024 # queued bytes - past this, the recorder waits for room and the UI thread is refused
+OUTBOUND_WAIT_TIMEOUT = 10 # in seconds - how long a sender waits for room before giving up
+LOGIN_TIMEOUT = 15 # in seconds - connect() gives up if the server did not answer the username by then
+
+# connect() puts every step of the login in incoming_messages as (time, LOGIN_PROGRESS, MESSAGE_TEXT, step).
+# The code is never sent by a server
+LOGIN_PROGRESS = -1
+LOGIN_CONNECTING = "connecting"
+LOGIN_SECURING = "securing" # the handshake
+LOGIN_SENDING_USERNAME = "sending username"
+LOGIN_DONE = "done" # the server's answer to the username comes right after it
+# the steps a login can end with, other than LOGIN_DONE
+LOGIN_FAILED = "failed"
+LOGIN_TIMED_OUT = "timed out"
+LOGIN_CANCELLED = "cancelled"
+
+_bytes_out = metrics.counter("protocol.bytes_out") # every frame is written by _write
 
 class GuiChatClient:
-    def __init__(self, host=protocol.SERVER_ADDRESS, port=protocol.PORT):
+    """
+    The connection to the server. It runs on an asyncio loop in its own thread: one task reads and decodes the
+    incoming frames, another writes the outgoing ones from a queue. The other threads (the UI, the recorder) call the
+    public methods, which hand the work to the loop and return concurrent.futures.Future objects.
+    """
+    def __init__(self, host=protocol.SERVER_ADDRESS, port=protocol.PORT, features=protocol.SUPPORTED_FEATURES):
         self.host = host
         self.port = port
-        self.sock = None
+        self.supported_features = features # the optional protocol features this client may use
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
         self.username = None
 
-        self.incoming_messages = queue.Queue()
+        self.incoming_messages = queue.Queue() # (time received, code, message type, message)
+        self.on_message: Callable[[], None] | None = None # called after a message was queued, e.g. to wake the UI
         self.running = False
 
+        # the loop thread is started by connect()
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread: threading.Thread | None = None
+        self._login: concurrent.futures.Future | None = None # the connect() in progress
+
+        # frames waiting to be written: (raw, future). Any thread appends, the writer task takes them
+        self._outbound = deque()
+        self._outbound_size = 0
+        self._outbound_lock = threading.Condition() # guards both, and is notified when the writer made room
+        # False from a dropped connection until the session was resumed: frames are refused instead of going to the
+        # closed socket, or to the new one ahead of the resumption. Guarded by _outbound_lock
+        self.connected = False
+        self._outbound_ready: asyncio.Event | None = None
+        self._writer_task: asyncio.Task | None = None
+        # read when a metrics snapshot is taken
+        metrics.gauge("gui_client.incoming_messages", self.incoming_messages.qsize)
+        metrics.gauge("gui_client.outbound_bytes", lambda: self._outbound_size)
+
+        # streamed voice messages ("voice-stream" feature)
+        self.voice_streams = VoiceStreamAssembler(
+            on_started=lambda stream: self._deliver(protocol.RESPONSE_OK, protocol.MESSAGE_VOICE, stream),
+            on_finished=lambda stream: self._deliver(protocol.RESPONSE_VOICE_CHUNK, protocol.MESSAGE_VOICE, stream))
+        self._outgoing_streams = dict() # { stream id: [recipient, next sequence] }
+        self._next_stream_id = 0
+
+        # negotiated with the server's hello
+        self.features = set()
+        self.version = protocol.PROTOCOL_V1
+        self.compression = protocol.COMPRESSION_NONE # for the text frames to the server
+
         # cryptography related variables
         self.private_key = None
         self.public_key = None
-        self.AES_key = None
+        self.AES_key = None # the raw key, or a SessionCipher with the "aead" feature
+        self.session_key = None # always the raw key
         self.encryption_ready = False
 
-    def connect(self, username):
+        # session resumption ticket from the server ("resume" feature), for reconnecting without a login
+        self.ticket = None
+
+    def _start_loop(self):
+        if self.loop is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._loop_thread.start()
+
+    def _call(self, coroutine) -> concurrent.futures.Future:
+        """
+        Runs the coroutine on the client's loop. Can be called from any thread.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def connect(self, username) -> concurrent.futures.Future:
         """
-        Connects to the server,
+        Connects to the server and sends the username, in the background. Every step is put in incoming_messages
+        (see LOGIN_PROGRESS), the last one being LOGIN_DONE, LOGIN_FAILED, LOGIN_TIMED_OUT or LOGIN_CANCELLED.
         :param username: The username to connect as
+        :return: a Future of whether it connected. The server's answer to the username arrives as a message
+        """
+        self._start_loop()
+        self._login = self._call(self._connect(username))
+        return self._login
+
+    def cancel_connect(self):
+        """
+        Gives up the connect() that is in progress, if any. Can be called from any thread.
         :return:
         """
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((self.host, self.port))
+        if self._login is not None:
+            self._login.cancel()
+
+    async def _connect(self, username) -> bool:
+        start = time.perf_counter()
+        try:
+            connected = await asyncio.wait_for(self._log_in(username), LOGIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("[ ERROR ] The server did not answer in time.")
+            self._abort_login(LOGIN_TIMED_OUT)
+            return False
+        except asyncio.CancelledError:
+            self._abort_login(LOGIN_CANCELLED)
+            raise
+        except (OSError, ValueError) as e:
+            print(f"[ ERROR ] Something went wrong connecting to the server: {e}")
+            self._abort_login(LOGIN_FAILED)
+            return False
+        if not connected:
+            print("[ ERROR ] Something went wrong connecting to the server.")
+            self._abort_login(LOGIN_FAILED)
+            return False
+        metrics.timer("gui_client.login").record(time.perf_counter() - start)
+        return True
+
+    async def _log_in(self, username) -> bool:
+        """
+        The steps of connect(): open the connection, the handshake, send the username.
+        :return: True if the server answered the username
+        """
+        self._deliver(LOGIN_PROGRESS, protocol.MESSAGE_TEXT, LOGIN_CONNECTING)
+        if not await self._open():
+            return False
         self.username = username
 
+        self._deliver(LOGIN_PROGRESS, protocol.MESSAGE_TEXT, LOGIN_SECURING)
+        start = time.perf_counter()
+        if protocol.FEATURE_X25519 in self.features:
+            await self._handshake_X25519()
+        else:
+            await self._handshake_RSA()
+        self._start_encryption(self.AES_key)
+        metrics.timer("gui_client.handshake").record(time.perf_counter() - start)
+        print("[Client] Handshake complete. AES session key established.")
+
+        # send over username
+        self._deliver(LOGIN_PROGRESS, protocol.MESSAGE_TEXT, LOGIN_SENDING_USERNAME)
+        self._write(protocol.create_user_msg_set_username(self.username, True, self.AES_key, self.version))
+
+        # get response from server and show it to the client
+        success, code, msg_type, data = await protocol.recv_server_msg_async(self.reader, self.encryption_ready,
+                                                                             self.AES_key)
+        if not success:
+            return False
+        self._deliver(LOGIN_PROGRESS, protocol.MESSAGE_TEXT, LOGIN_DONE)
+        self._deliver(code, msg_type, data)
+
+        self.running = True
+        self.connected = True
+        self._outbound_ready = asyncio.Event()
+        self._writer_task = asyncio.create_task(self._write_loop())
+        asyncio.create_task(self._read_loop())
+        return True
+
+    def _abort_login(self, step: str):
+        """
+        Closes the connection of a login that did not finish, and tells the UI how it ended.
+        """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.username = None
+        self.encryption_ready = False
+        metrics.counter(f"gui_client.login_{step.replace(' ', '_')}").inc()
+        self._deliver(LOGIN_PROGRESS, protocol.MESSAGE_TEXT, step)
+
+    async def _open(self) -> bool:
+        """
+        Opens the connection, reads the hello message and picks the optional features.
+        :return: True if the server said hello, False otherwise
+        """
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.encryption_ready = False
+
         # get first hello message from the server
-        success, code, msg_type, data = protocol.recv_server_msg(self.sock)
+        success, code, msg_type, data = await protocol.recv_server_msg_async(self.reader)
         if not success or code != protocol.RESPONSE_HELLO or msg_type != protocol.MESSAGE_TEXT:
-            print("[ ERROR ] Something went wrong connecting to the server.")
-            exit()
+            return False
+
+        # offer the optional features, the server answers with the ones both sides support
+        self.features = set()
+        if self.supported_features:
+            self._write(protocol.create_user_msg_hello(self.supported_features))
+            success, code, msg_type, data = await protocol.recv_server_msg_async(self.reader)
+            if not success or code != protocol.RESPONSE_HELLO:
+                return False
+            self.features = protocol.parse_features(data) & self.supported_features
+        self.version = protocol.PROTOCOL_V2 if protocol.FEATURE_BINARY_FRAMES in self.features else protocol.PROTOCOL_V1
+        self.compression = protocol.pick_compression(self.features)
+        return True
+
+    def _write(self, raw: bytes):
+        self.writer.write(raw)
+        _bytes_out.inc(len(raw))
 
-        # generate RSA keypair and send public key to server
-        self.private_key, self.public_key = encryption_utils.generate_RSA_keys()
+    def _start_encryption(self, AES_key: bytes):
+        self.session_key = AES_key
+        if protocol.FEATURE_AEAD in self.features:
+            # one AES-GCM context for the whole connection
+            self.AES_key = encryption_utils.SessionCipher(AES_key)
+        else:
+            self.AES_key = AES_key
+        self.encryption_ready = True
+
+    async def _resume(self) -> bool:
+        """
+        Presents the ticket on a freshly opened connection, to get back the AES key and the login in one round trip.
+        :return: True if the session was resumed
+        """
+        if self.ticket is None or protocol.FEATURE_RESUME not in self.features:
+            return False
+        self._write(protocol.create_user_msg_resume(self.ticket, self.version))
+        # the answer is not encrypted either way
+        success, code, msg_type, data = await protocol.recv_server_msg_async(self.reader)
+        self.ticket = None  # every ticket is used once, the server sends a new one
+        if not success or code != protocol.RESPONSE_CORRECT_PASSWORD:
+            return False
+
+        self._start_encryption(self.session_key)
+        # the username, encrypted with the restored key, proves to the server that this is the ticket's owner
+        self._write(protocol.create_user_msg_set_username(self.username, True, self.AES_key, self.version))
+        self._deliver(code, msg_type, data)
+        return True
+
+    async def _reconnect(self) -> bool:
+        """
+        Opens a new connection after the old one dropped and resumes the session with the ticket.
+        :return: True if the session was resumed
+        """
+        if self.ticket is None or protocol.FEATURE_RESUME not in self.features:
+            self.writer.close() # there is nothing to resume with
+            return False
+        for delay in RECONNECT_DELAYS:
+            await asyncio.sleep(delay)
+            if not self.running:
+                return False
+            self.writer.close()
+            try:
+                if not await self._open():
+                    continue
+                if await self._resume():
+                    return True
+            except OSError:
+                continue
+            break # the server is back, but it did not resume the session
+        self.writer.close()
+        return False
+
+    async def _handshake_RSA(self):
+        """
+        Sends a fresh public RSA key and gets the AES key encrypted with it.
+        """
+        # generate RSA keypair and send public key to server. Key generation and decryption take long enough to hold
+        # up the loop (and a timeout or a cancel with it) - they run in a worker thread
+        self.private_key, self.public_key = await asyncio.to_thread(encryption_utils.generate_RSA_keys)
         public_pem = encryption_utils.serialize_public_RSA_key(self.public_key)
-        self.sock.send(protocol.create_user_msg_handshake(public_pem))
+        self._write(protocol.create_user_msg_handshake(public_pem, self.version))
 
         # get the AES key
-        success, code, msg_type, encrypted_data = protocol.recv_server_msg(self.sock)
-        encrypted_hex = encrypted_data.split("SESSION_KEY:", 1)[1]
+        success, code, msg_type, encrypted_data = await protocol.recv_server_msg_async(self.reader)
+        if not success or protocol.SESSION_KEY_PREFIX not in encrypted_data:
+            raise ConnectionError("the server did not send the session key")
+        encrypted_hex = encrypted_data.split(protocol.SESSION_KEY_PREFIX, 1)[1]
         encrypted_AES = bytes.fromhex(encrypted_hex)
         # decrypt with RSA private key
-        decrypted_AES_hex = encryption_utils.decrypt_RSA(encrypted_AES, self.private_key)
+        decrypted_AES_hex = await asyncio.to_thread(encryption_utils.decrypt_RSA, encrypted_AES, self.private_key)
         self.AES_key = encryption_utils.deserialize_AES_key(decrypted_AES_hex)
-        self.encryption_ready = True
-        print("[Client] Handshake complete. AES session key established.")
 
-        # send over username
-        self.sock.send(protocol.create_user_msg_set_username(self.username, True, self.AES_key))
-
-        # get response from server and show it to the client
-        success, code, msg_type, data = protocol.recv_server_msg(self.sock, self.encryption_ready, self.AES_key)
-        self.incoming_messages.put((code, msg_type, data))
+    async def _handshake_X25519(self):
+        """
+        Exchanges ephemeral X25519 public keys with the server and derives the AES key from them.
+        """
+        self.private_key, self.public_key = encryption_utils.generate_X25519_keys()
+        public_key_str = protocol.X25519_PREFIX + encryption_utils.serialize_public_X25519_key(self.public_key)
+        self._write(protocol.create_user_msg_handshake(public_key_str, self.version))
 
-        self.running = True
-        threading.Thread(target=self.listen, daemon=True).start()
+        success, code, msg_type, data = await protocol.recv_server_msg_async(self.reader)
+        if not success or protocol.X25519_PREFIX not in data:
+            raise ConnectionError("the server did not send its public key")
+        server_public_key = encryption_utils.deserialize_public_X25519_key(data.split(protocol.X25519_PREFIX, 1)[1])
+        self.AES_key = encryption_utils.derive_AES_key(self.private_key, server_public_key)
 
-    def listen(self):
+    async def _read_loop(self):
         """
-        background thread: receive messages and push to queue
+        Receives messages and pushes them to the queue.
         """
+        # AES is enabled - the decoder decrypts v1 and v2 frames alike
+        decoder = protocol.FrameDecoder(from_client=False, encryption_enabled=self.encryption_ready,
+                                        AES_key=self.AES_key)
         while self.running:
-            ready_to_read, _, _ = select.select([self.sock], [], [], protocol.SELECT_TIMEOUT)
+            # one big read instead of several tiny ones per message
+            try:
+                data = await self.reader.read(protocol.RECV_BUFFER_SIZE)
+            except OSError:
+                data = b""
+            if not data:
+                if not self.running: # closed by close()
+                    break
+                print("[Client] The server closed the connection.")
+                with self._outbound_lock:
+                    self.connected = False
+                self.voice_streams.clear()
+                self._outgoing_streams.clear()
+                # the queued frames may be partly written already, and the server drops the unfinished voice streams
+                # with the connection - they are not sent again
+                self._fail_outbound()
+                if self.running and await self._reconnect():
+                    print("[Client] Reconnected and resumed the session.")
+                    decoder = protocol.FrameDecoder(from_client=False, encryption_enabled=True, AES_key=self.AES_key)
+                    with self._outbound_lock:
+                        self.connected = True
+                    self._outbound_ready.set()
+                    continue
+                self.running = False
+                self._writer_task.cancel()
+                break
 
-            # if a message was received
-            if self.sock in ready_to_read:
-                success, code, msg_type, data = protocol.recv_server_msg(self.sock)
+            decoder.feed(data)
+            for success, code, msg_type, message in decoder:
                 if not success:
                     continue
+                if code == protocol.RESPONSE_TICKET:
+                    self.ticket = message
+                    continue
+                if code == protocol.RESPONSE_VOICE_CHUNK:
+                    # the stream's first and last chunk turn into messages for the UI
+                    self.voice_streams.feed(message["prefix"], message["stream"], message["message"])
+                    continue
+                self._deliver(code, msg_type, message)
+
+    async def _write_loop(self):
+        """
+        Writes the queued frames. Frames that were queued together go out in as few writes as possible, and the next
+        ones wait until the socket took these (drain), so a slow connection makes the queue - not memory - grow.
+        """
+        while self.running:
+            await self._outbound_ready.wait()
+            self._outbound_ready.clear()
+            while True:
+                # take the whole queue at once - the senders wait for the lock as little as possible
+                with self._outbound_lock:
+                    if not self.connected: # _read_loop fails the frames and wakes the writer once it is resumed
+                        break
+                    queued, self._outbound = self._outbound, deque()
+                if not queued:
+                    break
+
+                while queued:
+                    frames, futures, size = [], [], 0
+                    while queued and (not frames or size + len(queued[0][0]) <= COALESCE_SIZE):
+                        raw, future = queued.popleft()
+                        frames.append(raw)
+                        futures.append(future)
+                        size += len(raw)
+
+                    try:
+                        self._write(frames[0] if len(frames) == 1 else b"".join(frames))
+                        await self.writer.drain()
+                        sent = True
+                    except OSError as e:
+                        print(f"[Client ERROR] Could not send to the server: {e}")
+                        sent = False
+
+                    with self._outbound_lock:
+                        self._outbound_size -= size
+                        self._outbound_lock.notify_all()
+                    for future in futures:
+                        future.set_result(sent)
+
+    def _enqueue(self, raw: bytes, wait=False, always=False) -> concurrent.futures.Future | None:
+        """
+        Queues a frame for the writer task. Can be called from any thread.
+        :param raw: The frame
+        :param wait: Wait (block) while the queue is full - only for threads that may block, e.g. the recorder.
+                     Otherwise a full queue refuses the frame.
+        :param always: Queue it even if the queue is full - for a tiny frame that must not be lost
+        :return: a Future of whether the frame was written, None if it could not be queued
+        """
+        if not self.running:
+            return None
+        future = concurrent.futures.Future()
+        with self._outbound_lock:
+            has_room = lambda: always or self._outbound_size < MAX_OUTBOUND_SIZE or not self.connected
+            if not (self._outbound_lock.wait_for(has_room, OUTBOUND_WAIT_TIMEOUT) if wait else has_room()):
+                print("[Client ERROR] The connection is too slow, the message was not sent.")
+                return None
+            if not self.connected:
+                print("[Client ERROR] Not connected to the server, the message was not sent.")
+                return None
+            # the writer takes everything that is queued before it waits again - only an empty queue needs a wake up
+            wake_writer = not self._outbound
+            self._outbound.append((raw, future))
+            self._outbound_size += len(raw)
+        if wake_writer:
+            self.loop.call_soon_threadsafe(self._outbound_ready.set)
+        return future
 
-                # decrypt message because AES is enabled
-                try:
-                    cipher_bytes = bytes.fromhex(data)
-                    padded_plain = encryption_utils.decrypt_AES(cipher_bytes, self.AES_key)
-                    length_field = padded_plain[:protocol.LENGTH_FIELD_SIZE]
-                    msg_len = int(length_field)
-                    data = padded_plain[protocol.LENGTH_FIELD_SIZE: protocol.LENGTH_FIELD_SIZE + msg_len]
-                except Exception as e:
-                    print(f"[Client ERROR] AES decryption failed: {e}")
-                    exit()
+    def _fail_outbound(self):
+        """
+        Drops the queued frames - their futures are False.
+        """
+        with self._outbound_lock:
+            frames, self._outbound = self._outbound, deque()
+            self._outbound_size -= sum(len(raw) for raw, future in frames)
+            self._outbound_lock.notify_all()
+        for raw, future in frames:
+            future.set_result(False)
 
-                self.incoming_messages.put((code, msg_type, data))
+    def _deliver(self, code: int, msg_type, message):
+        """
+        Queues a received message for the UI.
+        """
+        self.incoming_messages.put((time.perf_counter(), code, msg_type, message))
+        if self.on_message is not None:
+            self.on_message()
 
-    def send_message(self, msg_type: Literal[0, 1], message):
+    def send_message(self, msg_type: Literal[0, 1], message: str | bytes,
+                     recipient=None) -> concurrent.futures.Future | None:
         """
         Sends broadcast or a private message to the server
         :param msg_type: The message type (0 for "text", 1 for "voice")
-        :param message: The message to be sent to the serer.
-        :return: bool - True if message was sent successfully, False otherwise
+        :param message: The message to be sent to the serer. Voice messages are the raw mp3 bytes.
+        :param recipient: Sends a private message to this user (instead of parsing "/msg <recipient>")
+        :return: a Future of whether the message was sent, None if it is not valid or could not be queued
         """
-        message = message.strip()
-        if not message:
-            return False
+        if isinstance(message, bytes):
+            if not message:
+                return None
+            if msg_type == protocol.MESSAGE_VOICE and protocol.FEATURE_VOICE_STREAM in self.features:
+                # no frame has to hold the whole recording
+                return self.send_voice_chunk(self.start_voice_stream(recipient), message, final=True)
+            # v1 frames can only carry text
+            if self.version == protocol.PROTOCOL_V1:
+                message = message.hex()
+        else:
+            message = message.strip()
+            if not message:
+                return None
+
+        try:
+            raw = self._create_message(msg_type, message, recipient)
+        except ValueError as e:
+            print(f"[Client ERROR] Could not send the message: {e}")
+            return None
+        if raw is None:
+            return None
+
+        return self._enqueue(raw)
+
+    def start_voice_stream(self, recipient=None) -> int | None:
+        """
+        Starts a voice message that is sent in chunks, e.g. while it is being recorded.
+        :param recipient: Sends a private message to this user, None to broadcast
+        :return: the stream id to pass to send_voice_chunk, or None if the server cannot take streams
+        """
+        if protocol.FEATURE_VOICE_STREAM not in self.features:
+            return None
+        stream_id = self._next_stream_id
+        self._next_stream_id += 1
+        self._outgoing_streams[stream_id] = [recipient or "", 0]
+        return stream_id
+
+    def send_voice_chunk(self, stream_id: int, data: bytes, final=False) -> concurrent.futures.Future | None:
+        """
+        Sends the next part of a voice message started with start_voice_stream.
+        Waits while the outgoing queue is full, unless it is called from the UI thread - which is refused instead.
+        :param stream_id: the id start_voice_stream returned
+        :param data: the next mp3 bytes (any size - they are split into VOICE_CHUNK_SIZE chunks)
+        :param final: True to end the message
+        :return: a Future of whether the last chunk was sent, None if the data could not be queued
+        """
+        # the loop thread clears the streams when the connection drops - at any point of this
+        stream = self._outgoing_streams.get(stream_id)
+        if stream is None:
+            return None
+        recipient, sequence = stream
+        wait = threading.current_thread() is not threading.main_thread()
+
+        view = memoryview(data)
+        offsets = range(0, len(view), protocol.VOICE_CHUNK_SIZE) or range(1) # an empty final chunk still ends it
+        future = None
+        for offset in offsets:
+            chunk = view[offset:offset + protocol.VOICE_CHUNK_SIZE]
+            is_final = final and offset == offsets[-1]
+            future = self._enqueue(protocol.create_user_msg_voice_chunk(self.username, recipient, stream_id, sequence,
+                                                                        is_final, chunk, self.encryption_ready,
+                                                                        self.AES_key), wait)
+            if future is None:
+                print("[Client ERROR] Could not send the voice message.")
+                if self._outgoing_streams.pop(stream_id, None) is not None:
+                    # end the stream, so that the server and the recipients do not wait for the rest
+                    self._enqueue(protocol.create_user_msg_voice_chunk(self.username, recipient, stream_id, sequence,
+                                                                       True, b"", self.encryption_ready,
+                                                                       self.AES_key), always=True)
+                return None
+            sequence += 1
+
+        stream[1] = sequence
+        if final:
+            self._outgoing_streams.pop(stream_id, None)
+        return future
+
+    def _create_message(self, msg_type: Literal[0, 1], message: str | bytes, recipient=None):
+        """
+        Builds the frame for send_message.
+        :return: the bytes to send, or None if the message is not valid
+        """
+        if recipient is not None:
+            return protocol.create_user_msg_private(self.username, recipient, msg_type, message,
+                                                    self.encryption_ready, self.AES_key, self.version, self.compression)
+
+        if isinstance(message, bytes):
+            return protocol.create_user_msg_broadcast(self.username, msg_type, message,
+                                                      self.encryption_ready, self.AES_key, self.version)
 
         if msg_type == protocol.MESSAGE_TEXT and message.strip().lower().startswith("/set_password"):
             # format: /set_password <password>
             try:
                 _, password = message.split(" ")
-                raw = protocol.create_user_msg_set_password(self.username, password, self.encryption_ready, self.AES_key)
             except ValueError:
                 print("Invalid setting password message format. Please use: \"/set_password <password>\"")
-                return False
+                return None
+            return protocol.create_user_msg_set_password(self.username, password, self.encryption_ready,
+                                                         self.AES_key, self.version)
 
         elif message.strip().lower().startswith("/msg"):
             # format: /msg <recipient> <message>
             try:
                 _, recipient, *msg_parts = message.split(" ")
-                msg_text = " ".join(msg_parts)
-                raw = protocol.create_user_msg_private(self.username,recipient, msg_type, msg_text,
-                                                       self.encryption_ready, self.AES_key)
             except ValueError:
                 print("Invalid private message format. Please use: \"/msg <recipient> <message>\"")
-                return False
-        else:
-            # default: broadcast
-            raw = protocol.create_user_msg_broadcast(self.username, msg_type, message, self.encryption_ready, self.AES_key)
+                return None
+            msg_text = " ".join(msg_parts)
+            return protocol.create_user_msg_private(self.username, recipient, msg_type, msg_text,
+                                                    self.encryption_ready, self.AES_key, self.version, self.compression)
 
-        self.sock.send(raw)
-        return True
+        # default: broadcast
+        return protocol.create_user_msg_broadcast(self.username, msg_type, message, self.encryption_ready,
+                                                  self.AES_key, self.version, self.compression)
 
     def close(self):
+        """
+        Closes the connection and stops the loop thread. The queued frames that were not written are dropped.
+        """
         self.running = False
-        self.sock.close()
+        with self._outbound_lock:
+            self.connected = False
+        self.cancel_connect()
+        if self.loop is None:
+            return
+
+        async def shutdown():
+            if self._writer_task is not None:
+                self._writer_task.cancel()
+            if self.writer is not None:
+                self.writer.close()
+            self._fail_outbound()
+
+        try:
+            self._call(shutdown()).result(timeout=1)
+        except (concurrent.futures.TimeoutError, RuntimeError):
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._loop_thread.join(timeout=1)
+        self.loop = None
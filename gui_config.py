@@ -16,6 +16,29 @@ def _from_rgb(rgb: tuple[int, int, int]):
 SCREEN_WIDTH = 1280
 SCREEN_HEIGHT = 720
 
+# how ChatArea draws a conversation:
+# "text" - one Text widget for the whole conversation, "widgets" - a widget per message,
+# "virtual" - only the messages near the viewport are drawn
+CHAT_RENDERER = "text"
+VIRTUAL_CHAT_THRESHOLD = 5000 # chats with at least this many messages are drawn "virtual" whatever CHAT_RENDERER is
+CHAT_VIEW_CACHE_SIZE = 8 # chats that keep their drawn view while another chat is shown
+
+# received messages are drawn for at most this long per frame - a burst is spread over several frames
+UI_FRAME_BUDGET_MS = 12
+UI_LATENCY_SAMPLES = 1000 # messages whose receive-to-render latency is kept for UiDispatcher.latency_percentiles()
+
+# message history (message_store.py): every chat keeps its newest messages in memory and all of them in a file
+HISTORY_DIR = "history" # a file per username
+HISTORY_HOT_WINDOW = 500 # newest messages of every chat that are kept in memory
+HISTORY_PAGE_SIZE = 200 # older messages that are loaded at a time when the user scrolls up
+TRANSIENT_CHATS = ("Server Messages",) # chats that are not saved
+SEARCH_RESULTS_LIMIT = 50 # messages that a search of the history returns at most
+
+# metrics (metrics.py): a snapshot is written to <METRICS_DIR>/metrics_client.jsonl every metrics.METRICS_INTERVAL
+# seconds, and served as JSON at http://127.0.0.1:<METRICS_PORT>/ if it is set
+METRICS_DIR = "metrics"
+METRICS_PORT = None
+
 # --- Colors ---
 # white mode:
 BG_COLOR = _from_rgb((236, 234, 217))
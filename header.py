@@ -1,18 +1,31 @@
 import tkinter as tk
+from typing import Callable
 import gui_config
 
 
 class HeaderBar:
-    def __init__(self, parent: tk.Tk, username: str):
+    def __init__(self, parent: tk.Tk, username: str, on_search: Callable[[str], None] | None = None):
+        """
+        :param parent: The parent widget
+        :param username: The username to show
+        :param on_search: Called with the text of the search box when the user presses Enter in it
+        """
         self.frame: tk.Frame = tk.Frame(parent, bg=gui_config.HEADER_BG)
 
         self.chat_name_label: tk.Label = tk.Label(self.frame, text="General", bg=gui_config.HEADER_BG,
                                                   fg="white", font=gui_config.TITLE_FONT)
         self.username_label: tk.Label = tk.Label(self.frame, text=username, bg=gui_config.HEADER_BG,
                                                    fg="white", font=gui_config.TITLE_USERNAME_FONT)
+        self.search_entry: tk.Entry = tk.Entry(self.frame, font=gui_config.ENTRY_FONT, width=20)
+        self.search_results_label: tk.Label = tk.Label(self.frame, text="", bg=gui_config.HEADER_BG,
+                                                       fg="white", font=gui_config.MSG_FONT)
+        if on_search is not None:
+            self.search_entry.bind("<Return>", lambda event: on_search(self.search_entry.get()))
 
         self.chat_name_label.pack(padx=30, pady=15, side=tk.LEFT)
         self.username_label.pack(padx=15, side=tk.RIGHT)
+        self.search_entry.pack(padx=15, side=tk.RIGHT)
+        self.search_results_label.pack(side=tk.RIGHT)
 
     def set_chat_name(self, chat_name: str):
         """
@@ -28,4 +41,12 @@ class HeaderBar:
         :param username: The chosen username.
         :return: None
         """
-        self.username_label.config(text=username)
\ No newline at end of file
+        self.username_label.config(text=username)
+
+    def set_search_results(self, text: str):
+        """
+        Shows how the search went next to the search box, e.g. "2/15" or "No results".
+        :param text: The text to show
+        :return: None
+        """
+        self.search_results_label.config(text=text)
\ No newline at end of file
@@ -2,13 +2,14 @@ import tkinter as tk
 from typing import Callable
 import gui_config
 import protocol
-from GUI.audio_manager import AudioManager
+from audio_manager import AudioManager
 
 
 class InputArea:
-    def __init__(self, parent: tk.Tk, callback: Callable):
+    def __init__(self, parent: tk.Tk, callback: Callable, voice_stream_callback: Callable = None):
         self.frame: tk.Frame = tk.Frame(parent, bg=gui_config.BG_COLOR)
         self.callback = callback # App.send_message_from_current_username(text)
+        self.voice_stream_callback = voice_stream_callback # App.start_voice_stream()
         self.placeholder = "Enter your message"
         self.placeholder_active = True
 
@@ -106,7 +107,9 @@ class InputArea:
         if self.recording: # voice mode
             self.start_stop_recording_button.configure(text="➤")
 
-            self.audio_manager.start_recording()
+            # send the recording while it is being recorded, if the app can
+            on_mp3 = self.voice_stream_callback() if self.voice_stream_callback else None
+            self.audio_manager.start_recording(on_mp3)
             self._clear_placeholder(None)
             self.entry.insert(0, self.audio_placeholder)
             self.entry.config(state="disabled")
@@ -121,7 +124,5 @@ class InputArea:
             self._add_placeholder(None)
             self.send_button.config(state="normal")
 
-            if len(raw_bytes) > (10 ** protocol.LENGTH_FIELD_SIZE - 1):
-                print("file is way to large!")
-            elif raw_bytes:
-                self.callback(protocol.MESSAGE_VOICE, raw_bytes.hex())
+            # the client checks whether the clip fits in a frame (the app also has to hear about a streamed one)
+            self.callback(protocol.MESSAGE_VOICE, raw_bytes)
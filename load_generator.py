@@ -0,0 +1,484 @@
+"""
+Drives many simulated clients against a chat server, through the same protocol code as the app (the create_user_msg_*
+builders, recv_server_msg_async and FrameDecoder), and reports how it holds up: connection setup time, message
+throughput and end-to-end latency.
+
+Every client connects, does the handshake and logs in as a new user, then sends messages at random (Poisson) times:
+broadcasts and private messages, text and voice. The send time is written into every message, so the receivers
+measure the latency. The clients are spread over several processes, since every receiver decrypts every message
+it gets. Run `python load_generator.py --help` for the options, e.g.
+    python load_generator.py --start-server --clients 2000 --processes 4 --rate 0.05 --duration 30
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import struct
+import time
+
+import encryption_utils
+import protocol
+
+CONNECT_CONCURRENCY = 200 # connections being set up at once, per process
+DRAIN_TIME = 3 # in seconds - how long the clients keep receiving after the last message was sent
+LOGIN_PASSWORD = "password"
+MAX_OPEN_FILES = 65536 # the most open files to ask for - a soft limit cannot be unlimited, even if the hard one is
+
+_TIMESTAMP = struct.Struct(">d") # the send time at the start of a voice message
+
+
+def _percentiles(values: list[float], percents=(50, 90, 99)) -> list[float]:
+    """
+    :return: the percentiles of the values, and their maximum (0 for no values)
+    """
+    if not values:
+        return [0.0] * (len(percents) + 1)
+    values = sorted(values)
+    return [values[min(int(len(values) * percent / 100), len(values) - 1)] for percent in percents] + [values[-1]]
+
+
+def _format_ms(values: list[float]) -> str:
+    p50, p90, p99, maximum = _percentiles(values)
+    return f"p50 {p50 * 1000:,.1f} ms, p90 {p90 * 1000:,.1f} ms, p99 {p99 * 1000:,.1f} ms, max {maximum * 1000:,.1f} ms"
+
+
+class WorkerStats:
+    """
+    What the clients of one process measured. Sent back to the main process, which adds them up.
+    """
+    def __init__(self):
+        self.setup_times = [] # in seconds, from opening the connection to the server's answer to the password
+        self.failed = 0 # clients that could not connect or log in
+        self.errors = 0 # messages the server refused, connections that dropped
+        self.sent = {"broadcast": 0, "private": 0, "voice": 0} # voice messages are counted in the other two as well
+        self.bytes_sent = 0
+        self.received = 0
+        self.bytes_received = 0
+        self.latencies = {"text": [], "voice": []} # in seconds
+        self.send_time = 0.0 # how long the sending phase took
+
+    def add(self, other: "WorkerStats"):
+        self.setup_times += other.setup_times
+        self.failed += other.failed
+        self.errors += other.errors
+        for kind in self.sent:
+            self.sent[kind] += other.sent[kind]
+        self.bytes_sent += other.bytes_sent
+        self.received += other.received
+        self.bytes_received += other.bytes_received
+        for kind in self.latencies:
+            self.latencies[kind] += other.latencies[kind]
+        self.send_time = max(self.send_time, other.send_time)
+
+
+class SimulatedClient:
+    """
+    One headless client: a connection that logs in like GuiChatClient does and then sends and receives messages.
+    """
+    def __init__(self, index: int, options: argparse.Namespace, stats: WorkerStats, rng: random.Random,
+                 rsa_keys=None):
+        """
+        :param index: The number of the client among all the clients - its username is the prefix and the number
+        :param options: The command line options
+        :param stats: Where the measurements go
+        :param rng: The random numbers of the process
+        :param rsa_keys: (private key, public pem) that the clients of the process share for the RSA handshake
+        """
+        self.index = index
+        self.username = f"{options.prefix}{index}"
+        self.options = options
+        self.stats = stats
+        self.rng = rng
+        self.rsa_keys = rsa_keys
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+
+        # some clients speak only protocol v1, like old versions of the app
+        self.supported_features = set() if rng.random() < options.v1_ratio else set(protocol.SUPPORTED_FEATURES)
+        self.features = set()
+        self.version = protocol.PROTOCOL_V1
+        self.compression = protocol.COMPRESSION_NONE
+        self.AES_key = None
+        self.next_stream_id = 0
+        self.voice_starts = dict() # { (prefix, stream id): send time } of the streamed voice messages being received
+
+    async def connect(self) -> bool:
+        """
+        Connects, does the handshake and logs in.
+        :return: True if the client is logged in
+        """
+        start = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(self.options.host, self.options.port)
+
+        success, code, msg_type, data = await protocol.recv_server_msg_async(self.reader)
+        if not success or code != protocol.RESPONSE_HELLO:
+            return False
+        if self.supported_features:
+            self.writer.write(protocol.create_user_msg_hello(self.supported_features))
+            success, code, msg_type, data = await protocol.recv_server_msg_async(self.reader)
+            if not success or code != protocol.RESPONSE_HELLO:
+                return False
+            self.features = protocol.parse_features(data) & self.supported_features
+        self.version = protocol.PROTOCOL_V2 if protocol.FEATURE_BINARY_FRAMES in self.features else protocol.PROTOCOL_V1
+        self.compression = protocol.pick_compression(self.features)
+
+        if protocol.FEATURE_X25519 in self.features and self.options.handshake == "x25519":
+            AES_key = await self._handshake_X25519()
+        else:
+            AES_key = await self._handshake_RSA()
+        if AES_key is None:
+            return False
+        self.AES_key = encryption_utils.SessionCipher(AES_key) if protocol.FEATURE_AEAD in self.features else AES_key
+
+        self.writer.write(protocol.create_user_msg_set_username(self.username, True, self.AES_key, self.version))
+        success, code, msg_type, data = await protocol.recv_server_msg_async(self.reader, True, self.AES_key)
+        if not success or code not in (protocol.RESPONSE_USER_DOES_NOT_EXIST, protocol.RESPONSE_USER_EXISTS):
+            return False
+        self.writer.write(protocol.create_user_msg_set_password(self.username, LOGIN_PASSWORD, True, self.AES_key,
+                                                                self.version))
+        success, code, msg_type, data = await protocol.recv_server_msg_async(self.reader, True, self.AES_key)
+        if not success or code not in (protocol.RESPONSE_CREATED_USER, protocol.RESPONSE_CORRECT_PASSWORD):
+            return False
+
+        self.stats.setup_times.append(time.perf_counter() - start)
+        return True
+
+    async def _handshake_X25519(self) -> bytes | None:
+        private_key, public_key = encryption_utils.generate_X25519_keys()
+        public_key_str = protocol.X25519_PREFIX + encryption_utils.serialize_public_X25519_key(public_key)
+        self.writer.write(protocol.create_user_msg_handshake(public_key_str, self.version))
+        success, code, msg_type, data = await protocol.recv_server_msg_async(self.reader)
+        if not success or protocol.X25519_PREFIX not in data:
+            return None
+        server_public_key = encryption_utils.deserialize_public_X25519_key(data.split(protocol.X25519_PREFIX, 1)[1])
+        return encryption_utils.derive_AES_key(private_key, server_public_key)
+
+    async def _handshake_RSA(self) -> bytes | None:
+        private_key, public_pem = self.rsa_keys
+        self.writer.write(protocol.create_user_msg_handshake(public_pem, self.version))
+        success, code, msg_type, data = await protocol.recv_server_msg_async(self.reader)
+        if not success or protocol.SESSION_KEY_PREFIX not in data:
+            return None
+        encrypted_AES = bytes.fromhex(data.split(protocol.SESSION_KEY_PREFIX, 1)[1])
+        return encryption_utils.deserialize_AES_key(encryption_utils.decrypt_RSA(encrypted_AES, private_key))
+
+    async def receive(self):
+        """
+        Reads until the connection is closed, and measures the latency of every chat message.
+        """
+        decoder = protocol.FrameDecoder(from_client=False, encryption_enabled=True, AES_key=self.AES_key)
+        while True:
+            try:
+                data = await self.reader.read(protocol.RECV_BUFFER_SIZE)
+            except OSError:
+                data = b""
+            if not data:
+                return
+            now = time.perf_counter()
+            self.stats.bytes_received += len(data)
+            decoder.feed(data)
+            for success, code, msg_type, message in decoder:
+                if not success:
+                    self.stats.errors += 1
+                elif code == protocol.RESPONSE_OK:
+                    self._measure(msg_type, message, now)
+                elif code == protocol.RESPONSE_VOICE_CHUNK:
+                    self._measure_voice_chunk(message, now)
+                elif code != protocol.RESPONSE_TICKET:
+                    self.stats.errors += 1 # e.g. a private message to a client that is not connected
+
+    def _measure(self, msg_type, message: str | bytes, now: float):
+        """
+        A chat message: "<prefix>: <send time> ..." for text, the send time packed in front of the mp3 for voice.
+        """
+        self.stats.received += 1
+        if msg_type == protocol.MESSAGE_TEXT:
+            sent_at = float(message.split(": ", 1)[1].split(" ", 1)[0])
+            self.stats.latencies["text"].append(now - sent_at)
+            return
+        if isinstance(message, bytes):
+            voice = message.partition(b": ")[2]
+        else: # protocol v1: the mp3 is hex
+            voice = bytes.fromhex(message.split(": ", 1)[1][:_TIMESTAMP.size * 2])
+        self.stats.latencies["voice"].append(now - _TIMESTAMP.unpack_from(voice)[0])
+
+    def _measure_voice_chunk(self, message: dict, now: float):
+        """
+        A chunk of a streamed voice message - its latency is the time until the last chunk arrived.
+        """
+        stream_id, sequence, final = protocol.parse_stream_field(message["stream"])
+        key = (message["prefix"], stream_id)
+        if sequence == 0:
+            self.voice_starts[key] = _TIMESTAMP.unpack_from(message["message"])[0]
+        if final and key in self.voice_starts:
+            self.stats.received += 1
+            self.stats.latencies["voice"].append(now - self.voice_starts.pop(key))
+
+    async def send(self, deadline: float, voice_payload: bytes):
+        """
+        Sends messages at random times, options.rate a second on average, until the deadline.
+        :param deadline: The time.perf_counter() to stop at
+        :param voice_payload: Bytes to make the voice messages of (the send time is written over their start)
+        """
+        options = self.options
+        while True:
+            delay = self.rng.expovariate(options.rate)
+            if time.perf_counter() + delay >= deadline:
+                return
+            await asyncio.sleep(delay)
+            if self.writer.is_closing():
+                return
+
+            recipient = None
+            if options.clients > 1 and self.rng.random() < options.private_ratio:
+                recipient = self.rng.randrange(options.clients - 1)
+                recipient = f"{options.prefix}{recipient + (recipient >= self.index)}" # anyone but this client
+            sent_at = time.perf_counter()
+            if self.rng.random() < options.voice_ratio:
+                raw = self._voice_message(recipient, _TIMESTAMP.pack(sent_at) + voice_payload[_TIMESTAMP.size:])
+                self.stats.sent["voice"] += 1
+            else:
+                text = f"{sent_at!r} ".ljust(options.text_size, "x")
+                if recipient is None:
+                    raw = protocol.create_user_msg_broadcast(self.username, protocol.MESSAGE_TEXT, text, True,
+                                                             self.AES_key, self.version, self.compression)
+                else:
+                    raw = protocol.create_user_msg_private(self.username, recipient, protocol.MESSAGE_TEXT, text,
+                                                           True, self.AES_key, self.version, self.compression)
+            self.stats.sent["broadcast" if recipient is None else "private"] += 1
+            self.stats.bytes_sent += len(raw)
+            self.writer.write(raw)
+            try:
+                await self.writer.drain()
+            except OSError:
+                self.stats.errors += 1
+                return
+
+    def _voice_message(self, recipient: str | None, voice: bytes) -> bytes:
+        """
+        :return: the frames of a voice message, the way GuiChatClient.send_message sends it
+        """
+        if protocol.FEATURE_VOICE_STREAM in self.features:
+            stream_id = self.next_stream_id
+            self.next_stream_id += 1
+            offsets = range(0, len(voice), protocol.VOICE_CHUNK_SIZE)
+            return b"".join(protocol.create_user_msg_voice_chunk(self.username, recipient or "", stream_id, sequence,
+                                                                 offset == offsets[-1],
+                                                                 voice[offset:offset + protocol.VOICE_CHUNK_SIZE],
+                                                                 True, self.AES_key)
+                            for sequence, offset in enumerate(offsets))
+        message = voice if self.version == protocol.PROTOCOL_V2 else voice.hex()
+        if recipient is None:
+            return protocol.create_user_msg_broadcast(self.username, protocol.MESSAGE_VOICE, message, True,
+                                                      self.AES_key, self.version)
+        return protocol.create_user_msg_private(self.username, recipient, protocol.MESSAGE_VOICE, message, True,
+                                                self.AES_key, self.version)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def _run_clients(indices: range, options: argparse.Namespace, barrier) -> WorkerStats:
+    """
+    Runs the clients of one process: connects them, waits for the other processes, sends, and closes them.
+    """
+    stats = WorkerStats()
+    rng = random.Random(indices.start)
+    rsa_keys = None
+    if options.handshake == "rsa" or options.v1_ratio > 0:
+        # one keypair for the whole process - generating one per client would take longer than the test
+        private_key, public_key = encryption_utils.generate_RSA_keys()
+        rsa_keys = (private_key, encryption_utils.serialize_public_RSA_key(public_key))
+
+    clients = [SimulatedClient(index, options, stats, rng, rsa_keys) for index in indices]
+    limit = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    async def connect(client: SimulatedClient) -> bool:
+        async with limit:
+            try:
+                if await client.connect():
+                    return True
+            except (OSError, ValueError) as e:
+                print(f"[Load ERROR] {client.username} could not connect: {e}")
+            stats.failed += 1
+            client.close()
+            return False
+
+    connected = [client for client, ok in zip(clients, await asyncio.gather(*map(connect, clients))) if ok]
+    receivers = [asyncio.create_task(client.receive()) for client in connected]
+
+    # everyone starts sending together, once every process is connected
+    await asyncio.to_thread(barrier.wait)
+    voice_payload = os.urandom(options.voice_size)
+    start = time.perf_counter()
+    await asyncio.gather(*(client.send(start + options.duration, voice_payload) for client in connected))
+    stats.send_time = time.perf_counter() - start
+
+    await asyncio.sleep(DRAIN_TIME)
+    for client in connected:
+        client.close()
+    await asyncio.gather(*receivers, return_exceptions=True)
+    return stats
+
+
+def _worker(indices: range, options: argparse.Namespace, barrier, results: multiprocessing.Queue):
+    _raise_open_files_limit()
+    results.put(asyncio.run(_run_clients(indices, options, barrier)))
+
+
+def _raise_open_files_limit():
+    """
+    Every client is a socket - the default limit of open files is often lower than the number of clients.
+    """
+    try:
+        import resource
+    except ImportError: # not on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = MAX_OPEN_FILES if hard == resource.RLIM_INFINITY else min(hard, MAX_OPEN_FILES)
+    if soft == resource.RLIM_INFINITY or soft >= wanted:
+        return
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    except (ValueError, OSError) as e: # e.g. above the system's own limit (kern.maxfilesperproc on macOS)
+        print(f"[Load] Could not raise the limit of open files from {soft:,}: {e}")
+
+
+def _run_server(port: int, cheap_passwords: bool):
+    import server
+    _raise_open_files_limit()
+    if cheap_passwords:
+        # thousands of logins would otherwise be spent hashing passwords
+        server.PASSWORD_HASH_ITERATIONS = 1
+    try:
+        asyncio.run(server.ChatServer(protocol.SERVER_ADDRESS, port).serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+def _free_port() -> int:
+    """
+    Asks the OS for a port nobody is listening on.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((protocol.SERVER_ADDRESS, 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_server(host: str, port: int, timeout=10.0) -> bool:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def run(options: argparse.Namespace) -> WorkerStats:
+    """
+    Runs the load test.
+    :param options: The options of main()
+    :return: the measurements of all the clients
+    """
+    server_process = None
+    if options.start_server:
+        server_process = multiprocessing.Process(target=_run_server, args=(options.port, options.cheap_passwords),
+                                                 daemon=True)
+        server_process.start()
+        if not _wait_for_server(options.host, options.port):
+            server_process.kill()
+            raise RuntimeError("the server did not start")
+
+    processes = max(1, min(options.processes, options.clients))
+    barrier = multiprocessing.Barrier(processes)
+    results = multiprocessing.Queue()
+    # client i runs in process i % processes
+    workers = [multiprocessing.Process(target=_worker, args=(range(i, options.clients, processes), options, barrier,
+                                                             results), daemon=True)
+               for i in range(processes)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    try:
+        stats = WorkerStats()
+        for _ in workers:
+            stats.add(results.get())
+        for worker in workers:
+            worker.join()
+    finally:
+        if server_process is not None:
+            server_process.kill()
+    print(f"[Load] Done in {time.perf_counter() - start:,.1f} s.")
+    return stats
+
+
+def report(stats: WorkerStats, options: argparse.Namespace):
+    """
+    Prints the measurements.
+    """
+    connected = len(stats.setup_times)
+    print(f"[Load] Setup: {connected:,} of {options.clients:,} clients logged in ({stats.failed:,} failed) - "
+          f"{_format_ms(stats.setup_times)}")
+
+    sent = stats.sent["broadcast"] + stats.sent["private"]
+    seconds = stats.send_time or 1.0
+    print(f"[Load] Sent: {sent:,} messages ({stats.sent['broadcast']:,} broadcast, {stats.sent['private']:,} "
+          f"private, {stats.sent['voice']:,} of them voice) in {seconds:,.1f} s - {sent / seconds:,.1f} msg/s, "
+          f"{stats.bytes_sent / seconds / 1e6:,.2f} MB/s")
+
+    # a broadcast goes to everyone else, a private message to one client
+    expected = stats.sent["broadcast"] * max(connected - 1, 0) + stats.sent["private"]
+    delivered = stats.received / expected if expected else 1.0
+    print(f"[Load] Delivered: {stats.received:,} of {expected:,} messages ({delivered:.1%}) - "
+          f"{stats.received / seconds:,.0f} msg/s, {stats.bytes_received / seconds / 1e6:,.2f} MB/s received, "
+          f"{stats.errors:,} errors")
+
+    for kind, latencies in stats.latencies.items():
+        if latencies:
+            print(f"[Load] Latency ({kind}, {len(latencies):,} messages): {_format_ms(latencies)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the chat server: many simulated clients at once")
+    parser.add_argument("--host", default=protocol.SERVER_ADDRESS)
+    parser.add_argument("--port", type=int, default=protocol.PORT, help="0 with --start-server: any free port")
+    parser.add_argument("--start-server", action="store_true", help="start a server on the port for the test")
+    parser.add_argument("--cheap-passwords", action="store_true",
+                        help="with --start-server: hash passwords once instead of PASSWORD_HASH_ITERATIONS times")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1,
+                        help="processes to spread the clients over")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of sending")
+    parser.add_argument("--rate", type=float, default=0.1, help="messages per second that each client sends")
+    parser.add_argument("--private-ratio", type=float, default=0.2, help="the share of private messages")
+    parser.add_argument("--voice-ratio", type=float, default=0.05, help="the share of voice messages")
+    parser.add_argument("--text-size", type=int, default=64, help="characters of a text message")
+    parser.add_argument("--voice-size", type=int, default=40_000, help="bytes of a voice message (~10 s of mp3)")
+    parser.add_argument("--v1-ratio", type=float, default=0.0,
+                        help="the share of clients that speak only protocol v1, like old versions of the app")
+    parser.add_argument("--handshake", choices=("x25519", "rsa"), default="x25519")
+    parser.add_argument("--prefix", default=f"load{os.getpid()}-",
+                        help="the usernames are this and a number (the server remembers users until it restarts)")
+    options = parser.parse_args()
+    if options.rate <= 0 or options.clients < 1:
+        parser.error("--rate and --clients have to be positive")
+    if options.port == 0:
+        if not options.start_server:
+            parser.error("--port 0 only works with --start-server")
+        # the server and the clients run in their own processes - they all need the port before they start
+        options.port = _free_port()
+    options.voice_size = max(options.voice_size, _TIMESTAMP.size)
+    options.text_size = max(options.text_size, 1)
+
+    print(f"[Load] {options.clients:,} clients in {options.processes} processes against {options.host}:"
+          f"{options.port}, {options.duration:g} s at {options.rate:g} messages/s each")
+    report(run(options), options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""
+The message history of the chats: the newest messages of every chat in memory, all of them in a SQLite file.
+"""
+import os
+import re
+import sqlite3
+from collections import deque
+
+import gui_config
+import protocol
+from voice_stream import VoiceStream
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    name TEXT PRIMARY KEY,
+    position INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    chat TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    type INTEGER NOT NULL,
+    content BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_chat ON messages (chat, id);
+"""
+
+# an inverted index of the text messages (SQLite's FTS5) - only the index, the text is in `messages`.
+# the prefix indexes make the searches for the start of a word as fast as for whole words
+_SEARCH_INDEX_SCHEMA = """
+CREATE VIRTUAL TABLE messages_index USING fts5(text, content='', prefix='2 3', tokenize='unicode61');
+INSERT INTO messages_index (rowid, text) SELECT id, content FROM messages WHERE type = 0;
+"""
+
+
+class MessageStore:
+    """
+    Keeps the last `hot_window` messages of every chat in memory, for showing a chat right away,
+    and writes every message to a SQLite file, from which older messages are read a page at a time.
+    Messages are (sender, message type, content) like they are shown - voice messages are the mp3 bytes,
+    or a VoiceStream that is saved once it is complete.
+    """
+    def __init__(self, path=":memory:", hot_window=gui_config.HISTORY_HOT_WINDOW,
+                 transient_chats=gui_config.TRANSIENT_CHATS):
+        """
+        :param path: The SQLite file (":memory:" for a history that is not saved)
+        :param hot_window: How many of the newest messages of every chat are kept in memory
+        :param transient_chats: Chats that are never saved - they only have the messages in memory
+        """
+        self.hot_window = hot_window
+        self.transient_chats = set(transient_chats)
+        self.chats: dict[str, deque] = dict() # { chat_name: the newest messages }, in the order they were added
+        # older() reads a page by the id of the oldest message shown - not by an offset, which costs more the further
+        # the user scrolled. These find that id:
+        self._hot_ids: dict[str, deque] = dict() # { chat_name: the ids of the messages in memory } of the saved chats
+        self._cursors: dict[str, list[int]] = dict() # { chat_name: [n, id] } - the n newest are the ones from id on
+        self.db = None
+        self.open(path)
+
+    def open(self, path: str) -> list[str]:
+        """
+        Switches to the history in the file (e.g. once the user logged in). The transient chats are kept,
+        the others are replaced by the chats in the file.
+        :param path: The SQLite file - created if it does not exist
+        :return: The names of the chats in the file, in the order they were added
+        """
+        if self.db is not None:
+            self.db.close()
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.db = sqlite3.connect(path)
+        # the history is not worth an fsync per message - a crash loses at most the last messages
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(_SCHEMA)
+        if self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_index'").fetchone() is None:
+            # a history from before the search - its text messages are indexed once
+            with self.db:
+                self.db.executescript(_SEARCH_INDEX_SCHEMA)
+
+        self.chats = {chat_name: messages for chat_name, messages in self.chats.items()
+                      if chat_name in self.transient_chats}
+        self._hot_ids = dict()
+        self._cursors = dict()
+        stored_chats = [name for name, in self.db.execute("SELECT name FROM chats ORDER BY position")]
+        for chat_name in stored_chats:
+            ids, messages = self._read(chat_name, self.hot_window)
+            self._hot_ids[chat_name] = deque(reversed(ids), maxlen=self.hot_window)
+            self.chats[chat_name] = deque(reversed(messages), maxlen=self.hot_window)
+        return stored_chats
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+    def __contains__(self, chat_name: str) -> bool:
+        return chat_name in self.chats
+
+    def chat_names(self) -> list[str]:
+        return list(self.chats)
+
+    def add_chat(self, chat_name: str):
+        """
+        Adds an empty chat (nothing happens if it exists).
+        :param chat_name: The name of the chat
+        :return:
+        """
+        if chat_name in self.chats:
+            return
+        self.chats[chat_name] = deque(maxlen=self.hot_window)
+        if chat_name not in self.transient_chats:
+            self._hot_ids[chat_name] = deque(maxlen=self.hot_window)
+            self.db.execute("INSERT OR IGNORE INTO chats VALUES (?, ?)", (chat_name, len(self.chats)))
+            self.db.commit()
+
+    def append(self, chat_name: str, sender: str, message_type: int, content: str | bytes | VoiceStream):
+        """
+        Adds a message to the end of the chat.
+        :param chat_name: The chat of the message
+        :param sender: The sender of the message
+        :param message_type: The type of the message. i.e: voice message, or text message.
+        :param content: The text, the mp3 bytes or their hex (protocol v1), or a VoiceStream that may still be arriving
+        :return:
+        """
+        if message_type == protocol.MESSAGE_VOICE and isinstance(content, str):
+            content = bytes.fromhex(content) # half the size
+        self.chats[chat_name].append((sender, message_type, content))
+        if chat_name in self.transient_chats:
+            return
+
+        stored_content = content
+        if isinstance(content, VoiceStream):
+            stored_content = content.get_bytes() if content.complete else b""
+        cursor = self.db.execute("INSERT INTO messages (chat, sender, type, content) VALUES (?, ?, ?, ?)",
+                                 (chat_name, sender, message_type, stored_content))
+        if message_type == protocol.MESSAGE_TEXT:
+            self.db.execute("INSERT INTO messages_index (rowid, text) VALUES (?, ?)", (cursor.lastrowid, content))
+        self.db.commit()
+        self._hot_ids[chat_name].append(cursor.lastrowid)
+        if chat_name in self._cursors:
+            self._cursors[chat_name][0] += 1 # one more of the newest messages is from the cursor's id on
+
+        if isinstance(content, VoiceStream) and not content.complete:
+            # saved once the rest of it arrives
+            message_id = cursor.lastrowid
+            content.on_complete.append(lambda: self._update_content(message_id, content.get_bytes()))
+
+    def _update_content(self, message_id: int, content: bytes):
+        if self.db is not None:
+            self.db.execute("UPDATE messages SET content = ? WHERE id = ?", (content, message_id))
+            self.db.commit()
+
+    def recent(self, chat_name: str) -> list:
+        """
+        :return: the newest messages of the chat (the ones in memory), oldest first
+        """
+        return list(self.chats[chat_name])
+
+    def older(self, chat_name: str, loaded: int, limit=gui_config.HISTORY_PAGE_SIZE) -> list:
+        """
+        Reads older messages from the file, e.g. when the user scrolls up.
+        :param chat_name: The chat
+        :param loaded: How many of the chat's newest messages are already shown
+        :param limit: How many messages to read at most
+        :return: the `limit` messages before the `loaded` newest ones, oldest first ([] if there are no more)
+        """
+        if chat_name in self.transient_chats:
+            return []
+        ids, messages = self._read(chat_name, limit, self._oldest_loaded_id(chat_name, loaded))
+        if ids:
+            self._cursors[chat_name] = [loaded + len(ids), ids[-1]]
+        return messages[::-1]
+
+    def _oldest_loaded_id(self, chat_name: str, loaded: int) -> int | None:
+        """
+        :return: the id of the `loaded`-th newest message of the chat, None for 0
+        """
+        if loaded <= 0:
+            return None
+        cursor = self._cursors.get(chat_name)
+        if cursor is not None and cursor[0] == loaded: # the next page after the last one
+            return cursor[1]
+        hot_ids = self._hot_ids[chat_name]
+        if loaded <= len(hot_ids): # the first page before the messages in memory
+            return hot_ids[-loaded]
+        # neither, e.g. a view that kept its pages while another one was drawn - found the slow way, once
+        row = self.db.execute("SELECT id FROM messages WHERE chat = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                              (chat_name, loaded - 1)).fetchone()
+        return row[0] if row is not None else 0
+
+    def search(self, query: str, chat_name: str | None = None, sender: str | None = None,
+               limit=gui_config.SEARCH_RESULTS_LIMIT) -> list[tuple[int, str, str, str]]:
+        """
+        Finds the text messages that have all the words of the query. A word that ends with * matches every word that
+        starts with it, e.g. "voi*" matches "voice". The transient chats are not searched.
+        :param query: The words to find
+        :param chat_name: Only search this chat
+        :param sender: Only search the messages of this sender
+        :param limit: How many messages to return at most
+        :return: (message id, chat, sender, text) of the newest matching messages, newest first
+        """
+        words = re.findall(r"\w+\*?", query)
+        if not words:
+            return []
+        # every word is quoted, so nothing in it is taken as FTS5 syntax
+        match = " ".join(f'"{word.rstrip("*")}"' + ("*" if word.endswith("*") else "") for word in words)
+
+        sql = ("SELECT messages.id, messages.chat, messages.sender, messages.content FROM messages_index "
+               "JOIN messages ON messages.id = messages_index.rowid WHERE messages_index MATCH ?")
+        parameters = [match]
+        if chat_name is not None:
+            sql += " AND messages.chat = ?"
+            parameters.append(chat_name)
+        if sender is not None:
+            sql += " AND messages.sender = ?"
+            parameters.append(sender)
+        sql += " ORDER BY messages_index.rowid DESC LIMIT ?"
+        parameters.append(limit)
+        return self.db.execute(sql, parameters).fetchall()
+
+    def count_newer(self, chat_name: str, message_id: int) -> int:
+        """
+        :return: how many of the chat's messages are newer than the message, e.g. to find a search result in its chat
+        """
+        return self.db.execute("SELECT COUNT(*) FROM messages WHERE chat = ? AND id > ?",
+                               (chat_name, message_id)).fetchone()[0]
+
+    def _read(self, chat_name: str, limit: int, before_id: int | None = None) -> tuple[list[int], list]:
+        """
+        :param before_id: Only read the messages before this one (None: the newest ones)
+        :return: the ids and the messages, newest first
+        """
+        if before_id is None:
+            rows = self.db.execute("SELECT id, sender, type, content FROM messages WHERE chat = ? ORDER BY id DESC "
+                                   "LIMIT ?", (chat_name, limit)).fetchall()
+        else:
+            rows = self.db.execute("SELECT id, sender, type, content FROM messages WHERE chat = ? AND id < ? "
+                                   "ORDER BY id DESC LIMIT ?", (chat_name, before_id, limit)).fetchall()
+        return [row[0] for row in rows], [row[1:] for row in rows]
@@ -0,0 +1,279 @@
+"""
+Counters, gauges and histograms of where the client and the server spend their time, kept in one registry and written
+out as snapshots (start_reporting) - instead of reading it off print() lines.
+Recording a value takes no lock: a value recorded by two threads at the same moment may be lost, which is fine for an
+overview. The hot functions only time one call in METRICS_SAMPLE_EVERY, so being timed costs them ~0.2 us a call.
+"""
+import functools
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_ENABLED = True # False leaves the functions that are timed with timed() unwrapped - read when they are defined
+METRICS_INTERVAL = 60 # in seconds - how often start_reporting() writes a snapshot
+METRICS_DIR = "metrics" # where start_reporting() writes the snapshots, unless it is given another directory
+METRICS_FILE = "metrics_{name}.jsonl" # a JSON line per snapshot, name is the program's, e.g. "client" or "server"
+METRICS_MAX_FILE_SIZE = 16 * 1024 * 1024 # in bytes - a full file is renamed to <file>.1, replacing the one before
+METRICS_SAMPLE_EVERY = 16 # timed() times one call in this many (every call is counted)
+
+# histogram buckets in seconds: 4 per doubling, from 1 us to about a minute - percentiles are off by at most 19%
+HISTOGRAM_BOUNDS = tuple(1e-6 * 2 ** (i / 4) for i in range(4 * 26))
+
+
+class Counter:
+    """
+    A number that only goes up, e.g. frames or bytes sent.
+    """
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    """
+    A number that goes up and down, e.g. a queue's length. Either set() or read from a function at snapshot time,
+    which costs nothing until then.
+    """
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        if self.function is None:
+            return self.value
+        try:
+            return self.function()
+        except Exception: # e.g. what it reads was closed
+            return None
+
+
+class Histogram:
+    """
+    The distribution of a value, e.g. how long a call took in seconds, in the buckets of HISTOGRAM_BOUNDS.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1) # the last one is for values above the last bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(HISTOGRAM_BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent: float) -> float:
+        """
+        :return: the upper bound of the bucket the percentile is in (the maximum for the last bucket), 0 if empty
+        """
+        rank = self.count * percent / 100
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(HISTOGRAM_BOUNDS[i], self.max) if i < len(HISTOGRAM_BOUNDS) else self.max
+        return 0.0
+
+    def snapshot(self) -> dict:
+        return {"count": self.count, "sum": self.sum, "mean": self.sum / self.count if self.count else 0.0,
+                "p50": self.percentile(50), "p90": self.percentile(90), "p99": self.percentile(99), "max": self.max}
+
+
+class Timer(Histogram):
+    """
+    A histogram of how long the calls of a function took in seconds, of one call in sample_every - and how many calls
+    there were.
+    """
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def record(self, seconds: float):
+        """
+        A call that took this long - for timing code that is not a function of its own.
+        """
+        self.calls += 1
+        self.observe(seconds)
+
+    def snapshot(self) -> dict:
+        return {"calls": self.calls, **super().snapshot()}
+
+
+class Registry:
+    """
+    The metrics by name. Asking for a name again returns the same metric, so modules can share one.
+    """
+    def __init__(self):
+        self.metrics: dict[str, Counter | Gauge | Histogram] = dict()
+        self._lock = threading.Lock() # only for creating metrics, not for recording values
+
+    def _get(self, name: str, kind: type, *args):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self.metrics.setdefault(name, kind(*args))
+        if type(metric) is not kind:
+            raise ValueError(f"metric {name} is a {type(metric).__name__}, not a {kind.__name__}")
+        return metric
+
+    def counter(self, name: str) -> Counter:
+        return self._get(name, Counter)
+
+    def gauge(self, name: str, function=None) -> Gauge:
+        """
+        :param function: Read at snapshot time instead of set() - a later call with a function replaces it
+        """
+        gauge = self._get(name, Gauge)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name: str) -> Histogram:
+        return self._get(name, Histogram)
+
+    def timer(self, name: str) -> Timer:
+        return self._get(name, Timer)
+
+    def snapshot(self) -> dict:
+        """
+        :return: {"time": Unix time, "counters": {name: value}, "gauges": {name: value},
+                  "histograms": {name: {count, sum, mean, p50, p90, p99, max}},
+                  "timers": {name: {calls, and the same as a histogram of the timed calls}}}
+        """
+        snapshot = {"time": time.time(), "counters": dict(), "gauges": dict(), "histograms": dict(), "timers": dict()}
+        sections = {Counter: "counters", Gauge: "gauges", Histogram: "histograms", Timer: "timers"}
+        for name, metric in sorted(self.metrics.items()):
+            snapshot[sections[type(metric)]][name] = metric.snapshot()
+        return snapshot
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+timer = REGISTRY.timer
+snapshot = REGISTRY.snapshot
+
+
+def timed(name: str = None, sample_every=METRICS_SAMPLE_EVERY):
+    """
+    Decorator: counts the calls of the function and times them in the timer <name>.
+    :param name: Default: the function's module and qualified name, e.g. "protocol.create_server_msg"
+    :param sample_every: Time one call in this many - 1 for functions that are called rarely or take long anyway
+    """
+    def decorate(function):
+        if not METRICS_ENABLED:
+            return function
+        calls = timer(name or f"{function.__module__}.{function.__qualname__}")
+        clock = time.perf_counter
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            calls.calls += 1
+            if calls.calls % sample_every:
+                result = function(*args, **kwargs)
+            else:
+                start = clock()
+                result = function(*args, **kwargs)
+                calls.observe(clock() - start)
+            return result
+        return wrapper
+    return decorate
+
+
+class _Reporter:
+    """
+    Writes a snapshot to a file every METRICS_INTERVAL seconds, and serves the current one over HTTP on localhost.
+    """
+    def __init__(self, path: str, interval: float, port: int | None):
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._http = None
+        if port is not None:
+            self._http = ThreadingHTTPServer(("127.0.0.1", port), _SnapshotHandler)
+            self._http.daemon_threads = True
+            threading.Thread(target=self._http.serve_forever, daemon=True).start()
+            print(f"[Metrics] Serving at http://127.0.0.1:{self._http.server_address[1]}/")
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        try:
+            # keep the newest snapshots only: this file and the one before it
+            if os.path.exists(self.path) and os.path.getsize(self.path) >= METRICS_MAX_FILE_SIZE:
+                os.replace(self.path, self.path + ".1")
+            with open(self.path, "a") as file:
+                file.write(json.dumps(snapshot()) + "\n")
+        except OSError as e:
+            print(f"[Metrics ERROR] Could not write {self.path}: {e}")
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        if self._http is not None:
+            self._http.shutdown()
+            self._http.server_close()
+        self.write()
+
+
+class _SnapshotHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(snapshot(), indent=1).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # no line per request
+        pass
+
+
+_reporter: _Reporter | None = None
+
+
+def start_reporting(name: str, directory=METRICS_DIR, interval=METRICS_INTERVAL, port: int = None):
+    """
+    Starts writing snapshots to METRICS_FILE in the directory, in a background thread. Does nothing if metrics are
+    disabled or it already started.
+    :param name: The name of the program, for the file name
+    :param directory: Where the file goes - it is made if it does not exist
+    :param interval: Seconds between snapshots
+    :param port: Also serve the snapshot as JSON at http://127.0.0.1:<port>/ (None: no endpoint, 0: any free port)
+    """
+    global _reporter
+    if not METRICS_ENABLED or _reporter is not None:
+        return
+    try:
+        os.makedirs(directory, exist_ok=True)
+        _reporter = _Reporter(os.path.join(directory, METRICS_FILE.format(name=name)), interval, port)
+    except OSError as e: # the directory cannot be made, the port is taken
+        print(f"[Metrics ERROR] Could not start reporting: {e}")
+
+
+def stop_reporting():
+    """
+    Stops start_reporting() and writes a last snapshot.
+    """
+    global _reporter
+    if _reporter is not None:
+        _reporter.stop()
+        _reporter = None
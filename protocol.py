@@ -1,8 +1,19 @@
+import asyncio
+import binascii
 import re
 import socket
+import struct
+import time
+import zlib
 from typing import Literal
 
+try:
+    import zstandard
+except ImportError: # zstd is optional - without it only zlib is offered
+    zstandard = None
+
 import encryption_utils
+import metrics
 
 # --- Constants ---
 LENGTH_FIELD_SIZE = 6
@@ -10,8 +21,10 @@ PORT = 5555
 SERVER_ADDRESS = "127.0.0.1"
 ERROR_MESSAGE = "ERROR"
 SELECT_TIMEOUT = 0.5 # in seconds
+RECV_BUFFER_SIZE = 64 * 1024 # how much to read at once when feeding a FrameDecoder
 
 # response codes
+RESPONSE_TICKET = 0  # a session resumption ticket (with the "resume" feature)
 RESPONSE_HELLO = 1
 RESPONSE_OK = 2
 RECIPIENT_NOT_FOUND = 3
@@ -22,21 +35,105 @@ RESPONSE_USER_DOES_NOT_EXIST = 5
 RESPONSE_INCORRECT_PASSWORD = 6
 RESPONSE_CORRECT_PASSWORD = 7
 RESPONSE_CREATED_USER = 8
+RESPONSE_VOICE_CHUNK = 10  # a piece of a streamed voice message (v2 frames only)
 
 # message commands
 COMMAND_BROADCAST = 1
 COMMAND_PRIVATE = 2
+COMMAND_RESUME = 3  # resume a session with a ticket instead of a handshake and a login
 COMMAND_HELLO = 6
 COMMAND_SET_USERNAME = 7
 COMMAND_SET_PASSWORD = 8
 COMMAND_HANDSHAKE = 9
+COMMAND_VOICE_CHUNK = 10  # a piece of a streamed voice message (v2 frames only)
 
 # message types
 MESSAGE_TEXT = 0
 MESSAGE_VOICE = 1
 
+# protocol versions
+PROTOCOL_V1 = 1  # ASCII digits, LENGTH_FIELD_SIZE digit lengths and hex ciphertext
+PROTOCOL_V2 = 2  # binary lengths and raw ciphertext
+
+# every v2 frame starts with this byte. v1 frames start with an ASCII digit, so both can share a stream.
+# v2 frame: marker | command/code (1 byte) | message type (1 byte) | payload length (4 bytes) | payload
+# the payload is a sequence of fields, each one a 4 byte length followed by the raw bytes
+V2_MARKER = 0xF2
+MAX_V2_PAYLOAD_SIZE = 64 * 1024 * 1024
+_V2_HEADER = struct.Struct(">BBI")  # everything after the marker up to the payload
+_V2_FIELD_LENGTH = struct.Struct(">I")
+
+# optional features: the client offers the ones it supports with COMMAND_HELLO, the server answers with the ones to use
+FEATURE_BINARY_FRAMES = "v2"
+FEATURE_AEAD = "aead"  # AES-GCM session cipher instead of AES-CBC
+FEATURE_X25519 = "x25519"  # ephemeral X25519 key agreement instead of an RSA key pair per connection
+FEATURE_RESUME = "resume"  # session resumption tickets
+FEATURE_VOICE_STREAM = "voice-stream"  # voice messages as a stream of chunks (needs FEATURE_BINARY_FRAMES)
+FEATURE_ZLIB = "zlib"  # text frames may be compressed with zlib (needs FEATURE_BINARY_FRAMES)
+FEATURE_ZSTD = "zstd"  # text frames may be compressed with zstd (needs FEATURE_BINARY_FRAMES and zstandard)
+SUPPORTED_FEATURES = frozenset({FEATURE_BINARY_FRAMES, FEATURE_AEAD, FEATURE_X25519, FEATURE_RESUME,
+                                FEATURE_VOICE_STREAM, FEATURE_ZLIB} | ({FEATURE_ZSTD} if zstandard else set()))
+_V2_ONLY_FEATURES = (FEATURE_VOICE_STREAM, FEATURE_ZLIB, FEATURE_ZSTD)
+FEATURES_PREFIX = "FEATURES:"
+
+# what the key in a handshake message / response starts with
+SESSION_KEY_PREFIX = "SESSION_KEY:"  # RSA: the AES key encrypted with the client's public key
+X25519_PREFIX = "X25519:"  # X25519: the sender's public key
+
+# a streamed voice message is sent in chunks of at most this many bytes, so no frame has to hold a whole recording
+VOICE_CHUNK_SIZE = 16 * 1024
+
+# a compressed v2 payload has one of these bits set in the message type byte of its header.
+# the payload is compressed before it is encrypted - the ciphertext would not compress
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 0x40
+COMPRESSION_ZSTD = 0x80
+_COMPRESSION_BITS = COMPRESSION_ZLIB | COMPRESSION_ZSTD
+COMPRESSION_THRESHOLD = 128 # payloads smaller than this (in bytes) are not worth compressing
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# commands that are never encrypted - they happen before there is a key
+_PLAIN_COMMANDS = (COMMAND_HELLO, COMMAND_HANDSHAKE, COMMAND_RESUME)
+
+# the length-prefixed fields every client command carries, in order
+_CLIENT_MSG_FIELDS = {
+    COMMAND_HELLO: ("features",),
+    COMMAND_RESUME: ("ticket",),
+    COMMAND_HANDSHAKE: ("RSA_key",),  # the RSA PEM, or X25519_PREFIX + the X25519 public key
+    COMMAND_SET_USERNAME: ("username",),
+    COMMAND_SET_PASSWORD: ("username", "password"),
+    COMMAND_BROADCAST: ("username", "message"),
+    COMMAND_PRIVATE: ("username", "recipient", "message"),
+    COMMAND_VOICE_CHUNK: ("username", "recipient", "stream", "message"),  # recipient is empty for a broadcast
+}
+
+# server responses with more than the single "message" field
+_SERVER_MSG_FIELDS = {
+    RESPONSE_VOICE_CHUNK: ("prefix", "stream", "message"),  # prefix: who it is from, as in a voice message
+}
+
 # --- helper Functions ---
 
+def _recv_fixed_bytes(sock: socket.socket, size: int) -> bytearray:
+    """
+    Read exactly `size` bytes or raise ConnectionError if connection closes prematurely.
+    The bytes are received straight into one preallocated buffer, so a big frame is never copied around.
+    :param sock: the socket
+    :param size: the number of bytes to read from the socket
+    :return: the bytes that were read
+    """
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if not count:  # connection closed
+            raise ConnectionError("Connection closed while reading fixed size data")
+        received += count
+    return data
+
+
 def _recv_fixed(sock: socket.socket, size: int) -> str:
     """
     Read exactly `size` bytes or raise ConnectionError if connection closes prematurely.
@@ -44,135 +141,452 @@ def _recv_fixed(sock: socket.socket, size: int) -> str:
     :param size: the number of bytes (aka chars) to read from the socket
     :return: the string that was read
     """
-    data = b""
-    while len(data) < size:
-        chunk = sock.recv(size - len(data))
-        if not chunk:  # connection closed
-            raise ConnectionError("Connection closed while reading fixed size data")
-        data += chunk
+    return _recv_fixed_bytes(sock, size).decode()
+
+
+def _recv_hex(sock: socket.socket, size: int) -> bytes:
+    """
+    Read a hex encoded field of `size` chars and return the bytes it encodes, without building a str in between.
+    :param sock: the socket
+    :param size: the number of hex chars to read from the socket
+    :return: the decoded bytes
+    """
+    return binascii.unhexlify(_recv_fixed_bytes(sock, size))
+
+
+async def _async_recv_fixed(reader: asyncio.StreamReader, size: int) -> str:
+    """
+    Read exactly `size` bytes from an asyncio stream.
+    :param reader: the stream reader of the connection
+    :param size: the number of bytes (aka chars) to read from the stream
+    :return: the string that was read
+    """
+    data = await reader.readexactly(size)
     return data.decode()
 
 
+def _unpad_fields(padded_plain: str, names: tuple) -> dict:
+    """
+    Split a string made of consecutive _pad_with_length fields.
+    :param padded_plain: the (decrypted) padded string
+    :param names: the name of each field, in order
+    :return: a dict of field name -> value
+    """
+    fields = {}
+    position = 0
+    for name in names:
+        length = int(padded_plain[position:position + LENGTH_FIELD_SIZE])
+        position += LENGTH_FIELD_SIZE
+        fields[name] = padded_plain[position:position + length]
+        position += length
+    return fields
+
+
+def _encrypt(plain: str | bytes, key, associated_data: bytes = None) -> bytes:
+    """
+    Encrypt with whatever the connection uses.
+    :param plain: the plaintext
+    :param key: the raw AES key (AES-CBC), or an encryption_utils.SessionCipher (AES-GCM)
+    :param associated_data: authenticated along with the message (AES-GCM only)
+    :return: the ciphertext
+    """
+    if isinstance(key, encryption_utils.SessionCipher):
+        return key.encrypt(plain.encode() if isinstance(plain, str) else plain, associated_data)
+    return encryption_utils.encrypt_AES(plain, key)
+
+
+def _decrypt(cipher_bytes: bytes, key, raw=False, associated_data: bytes = None) -> str | bytes:
+    """
+    Decrypt with whatever the connection uses.
+    :param cipher_bytes: the ciphertext
+    :param key: the raw AES key (AES-CBC), or an encryption_utils.SessionCipher (AES-GCM)
+    :param raw: return the plaintext bytes instead of decoding them to a str
+    :param associated_data: has to match what the message was encrypted with (AES-GCM only)
+    :return: the plaintext
+    """
+    if isinstance(key, encryption_utils.SessionCipher):
+        plain = key.decrypt(cipher_bytes, associated_data)
+        return plain if raw else plain.decode()
+    return encryption_utils.decrypt_AES(cipher_bytes, key, raw)
+
+
 def _pad_with_length(data: str) -> str:
     """
     Attach length prefix to string (LENGTH_FIELD_SIZE digits).
     :param data: the data to be padded
     :return: the string with LENGTH_FIELD_SIZE bytes that represent the length of it at the start.
     """
+    if len(data) >= 10 ** LENGTH_FIELD_SIZE:
+        raise ValueError(f"data is too long for a v1 frame ({len(data)} chars)")
     return str(len(data)).zfill(LENGTH_FIELD_SIZE) + data
 
+
+def _pack_fields(*fields: str | bytes) -> bytes:
+    """
+    Build a v2 payload: every field as a 4 byte length followed by its bytes (str fields are UTF-8 encoded).
+    """
+    parts = []
+    for field in fields:
+        if isinstance(field, str):
+            field = field.encode()
+        parts.append(_V2_FIELD_LENGTH.pack(len(field)))
+        parts.append(field)
+    return b"".join(parts)
+
+
+def _unpack_fields(payload: bytes, names: tuple, message_type) -> dict:
+    """
+    Split a v2 payload into its fields. Everything is decoded to str except the content of a voice message.
+    :param payload: the (decrypted) payload
+    :param names: the name of each field, in order
+    :param message_type: the type of the message
+    :return: a dict of field name -> value
+    """
+    view = memoryview(payload)
+    fields = {}
+    position = 0
+    for name in names:
+        (length,) = _V2_FIELD_LENGTH.unpack_from(view, position)
+        position += _V2_FIELD_LENGTH.size
+        value = view[position:position + length]
+        if len(value) != length:
+            raise ValueError(f"field {name} is truncated")
+        position += length
+        fields[name] = bytes(value) if name == "message" and message_type == MESSAGE_VOICE else str(value, "utf-8")
+    return fields
+
+
+def _compress(payload: bytes, compression: int) -> bytes:
+    if compression == COMPRESSION_ZSTD:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(payload)
+    return zlib.compress(payload, ZLIB_LEVEL)
+
+
+def _decompress(payload: bytes | memoryview, compression: int) -> bytes:
+    # never more than a v2 payload may hold, whatever the compressed data claims
+    if compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ValueError("got a zstd payload without zstandard installed")
+        return zstandard.ZstdDecompressor().decompress(payload, max_output_size=MAX_V2_PAYLOAD_SIZE)
+    if compression != COMPRESSION_ZLIB:
+        raise ValueError(f"unknown compression {compression:#x}")
+    decompressor = zlib.decompressobj()
+    plain = decompressor.decompress(payload, MAX_V2_PAYLOAD_SIZE)
+    if decompressor.unconsumed_tail:
+        raise ValueError("decompressed v2 payload is over the limit")
+    return plain
+
+
+def pick_compression(features) -> int:
+    """
+    :param features: the negotiated features
+    :return: the compression to send text frames with (COMPRESSION_NONE if none was negotiated)
+    """
+    if FEATURE_ZSTD in features and zstandard is not None:
+        return COMPRESSION_ZSTD
+    if FEATURE_ZLIB in features:
+        return COMPRESSION_ZLIB
+    return COMPRESSION_NONE
+
+
+def discard_v2_only_features(features: set):
+    """
+    Removes the features that only work with v2 frames, when v2 frames were not picked.
+    """
+    if FEATURE_BINARY_FRAMES not in features:
+        features.difference_update(_V2_ONLY_FEATURES)
+
+
+def _create_v2_frame(command: int, message_type, fields: tuple, encryption_enabled=False, AES_key=None,
+                     compression=COMPRESSION_NONE) -> bytes:
+    """
+    Build a complete v2 frame.
+    :param command: the command (client) or response code (server)
+    :param message_type: the type of the message
+    :param fields: the fields of the payload, in order
+    :param encryption_enabled: A boolean controls whether the payload is encrypted or not.
+    :param AES_key: The key to encrypt the payload with
+    :param compression: Compress text payloads of COMPRESSION_THRESHOLD bytes or more with this
+                        (voice messages are mp3 - they do not compress)
+    :return: the bytes to send via the socket later on
+    """
+    payload = _pack_fields(*fields)
+    if compression and message_type == MESSAGE_TEXT and len(payload) >= COMPRESSION_THRESHOLD:
+        compressed = _compress(payload, compression)
+        if len(compressed) < len(payload):
+            payload = compressed
+            message_type |= compression
+    if encryption_enabled and AES_key:
+        # the header is authenticated too, so the command and message type cannot be swapped
+        payload = _encrypt(payload, AES_key, bytes((command, message_type)))
+    if len(payload) > MAX_V2_PAYLOAD_SIZE:
+        raise ValueError(f"payload is too large for a v2 frame ({len(payload)} bytes)")
+    return bytes((V2_MARKER,)) + _V2_HEADER.pack(command, message_type, len(payload)) + payload
+
+
+def _parse_v2_header(header: bytes) -> tuple[int, int, int, int]:
+    """
+    :param header: the _V2_HEADER.size bytes that follow the marker
+    :return: (command/code, message type, compression, payload length)
+    """
+    command, message_type, payload_length = _V2_HEADER.unpack(header)
+    if payload_length > MAX_V2_PAYLOAD_SIZE:
+        raise ValueError(f"v2 payload of {payload_length} bytes is over the limit")
+    return command, message_type & ~_COMPRESSION_BITS, message_type & _COMPRESSION_BITS, payload_length
+
+
+def _parse_v2_payload(command: int, message_type, payload: bytes | bytearray, names: tuple, from_client: bool,
+                      encryption_enabled=False, AES_key=None, compression=COMPRESSION_NONE) -> dict:
+    """
+    Decrypt and decompress (if needed) and split the payload of a v2 frame.
+    :param from_client: True for client → server frames (response codes share numbers with the plain commands)
+    """
+    if encryption_enabled and AES_key and not (from_client and command in _PLAIN_COMMANDS):
+        payload = _decrypt(memoryview(payload), AES_key, raw=True,
+                           associated_data=bytes((command, message_type | compression)))
+    if compression:
+        payload = _decompress(payload, compression)
+    return _unpack_fields(payload, names, message_type)
+
+
+def create_stream_field(stream_id: int, sequence: int, final: bool) -> str:
+    """
+    :param stream_id: identifies the voice message among the ones its sender is streaming
+    :param sequence: the number of the chunk in the stream, starting at 0
+    :param final: whether this is the last chunk
+    :return: the "stream" field of a voice chunk, e.g. "3:0:1"
+    """
+    return f"{stream_id}:{sequence}:{int(final)}"
+
+
+def parse_stream_field(stream: str) -> tuple[int, int, bool]:
+    """
+    :param stream: the "stream" field of a voice chunk
+    :return: (stream id, sequence, final)
+    """
+    stream_id, sequence, final = stream.split(":")
+    return int(stream_id), int(sequence), final == "1"
+
+
+def create_features_line(features) -> str:
+    """
+    :param features: the feature names
+    :return: the line advertising them, e.g. "FEATURES:v2"
+    """
+    return FEATURES_PREFIX + ",".join(sorted(features))
+
+
+def parse_features(data: str) -> set[str]:
+    """
+    Finds the features line in a COMMAND_HELLO or in the server's answer to it.
+    :param data: the message
+    :return: the features listed in it (an empty set if there is none)
+    """
+    for line in data.splitlines():
+        if line.startswith(FEATURES_PREFIX):
+            return {feature for feature in line[len(FEATURES_PREFIX):].split(",") if feature}
+    return set()
+
 # --- Protocol: Create Messages ---
 
-def create_user_msg_handshake(key: str) -> bytes:
+def create_user_msg_hello(features) -> bytes:
+    """
+    Client → Server. Offers the optional features, the server answers with RESPONSE_HELLO and the ones to use. Always
+    a v1 frame, since nothing is agreed on yet.
+    :param features: the features the client supports
+    :return: the bytes to send via the socket later on
+    """
+    return (str(COMMAND_HELLO) + str(MESSAGE_TEXT) + _pad_with_length(create_features_line(features))).encode()
+
+def create_user_msg_resume(ticket: str, version=PROTOCOL_V1) -> bytes:
+    """
+    Client → Server. Resumes a previous session, instead of the handshake and the login.
+    :param ticket: the ticket the server issued in the previous session (opaque to the client)
+    :param version: The protocol version to frame the message with
+    :return: the bytes to send via the socket later on
+    """
+    if version == PROTOCOL_V2:
+        return _create_v2_frame(COMMAND_RESUME, MESSAGE_TEXT, (ticket,))
+    return (str(COMMAND_RESUME) + str(MESSAGE_TEXT) + _pad_with_length(ticket)).encode()
+
+def create_user_msg_handshake(key: str, version=PROTOCOL_V1) -> bytes:
     """
     Client → Server. Handshake message.
     :param key: the key to send
+    :param version: The protocol version to frame the message with
     :return: the bytes to send via the socket later on
     """
+    if version == PROTOCOL_V2:
+        return _create_v2_frame(COMMAND_HANDSHAKE, MESSAGE_TEXT, (key,))
     return (str(COMMAND_HANDSHAKE) + str(MESSAGE_TEXT) + _pad_with_length(key)).encode()
 
-def create_user_msg_set_username(username: str, encryption_enabled=False, AES_key=None) -> bytes:
+def create_user_msg_set_username(username: str, encryption_enabled=False, AES_key=None, version=PROTOCOL_V1) -> bytes:
     """
     Client → Server. Set username message.
     :param username: the username
     :param encryption_enabled: A boolean controls whether there is encryption on the params or not.
     :param AES_key: The key to decrypt the client's message
+    :param version: The protocol version to frame the message with
     :return: the bytes to send via the socket later on
     """
+    if version == PROTOCOL_V2:
+        return _create_v2_frame(COMMAND_SET_USERNAME, MESSAGE_TEXT, (username,), encryption_enabled, AES_key)
     if not (encryption_enabled and AES_key):
         return (str(COMMAND_SET_USERNAME) + str(MESSAGE_TEXT) + _pad_with_length(username)).encode()
 
     # inner payload: pad(username)
     inner = _pad_with_length(username)
-    cipher_bytes = encryption_utils.encrypt_AES(inner, AES_key)
+    cipher_bytes = _encrypt(inner, AES_key)
     encrypted_hex = cipher_bytes.hex()
     outer = str(COMMAND_SET_USERNAME) + str(MESSAGE_TEXT) + _pad_with_length(encrypted_hex)
     return outer.encode()
 
-def create_user_msg_set_password(username: str, password: str, encryption_enabled=False, AES_key=None) -> bytes:
+def create_user_msg_set_password(username: str, password: str, encryption_enabled=False, AES_key=None,
+                                 version=PROTOCOL_V1) -> bytes:
     """
     Client → Server. Set username message.
     :param username: the username
     :param password: the password
     :param encryption_enabled: A boolean controls whether there is encryption on the params or not.
     :param AES_key: The key to decrypt the client's message
+    :param version: The protocol version to frame the message with
     :return: the bytes to send via the socket later on
     """
+    if version == PROTOCOL_V2:
+        return _create_v2_frame(COMMAND_SET_PASSWORD, MESSAGE_TEXT, (username, password), encryption_enabled, AES_key)
     if not (encryption_enabled and AES_key):
         return (str(COMMAND_SET_PASSWORD) + str(MESSAGE_TEXT) + _pad_with_length(username) + _pad_with_length(password)).encode()
 
     # inner payload: pad(username) + pad(password)
     inner = _pad_with_length(username) + _pad_with_length(password)
-    cipher_bytes = encryption_utils.encrypt_AES(inner, AES_key)
+    cipher_bytes = _encrypt(inner, AES_key)
     encrypted_hex = cipher_bytes.hex()
     outer = str(COMMAND_SET_PASSWORD) + str(MESSAGE_TEXT) + _pad_with_length(encrypted_hex)
     return outer.encode()
 
-def create_user_msg_broadcast(username: str, message_type: Literal[0, 1], data: str, encryption_enabled=False, AES_key=None) -> bytes:
+def create_user_msg_broadcast(username: str, message_type: Literal[0, 1], data: str | bytes, encryption_enabled=False,
+                              AES_key=None, version=PROTOCOL_V1, compression=COMPRESSION_NONE) -> bytes:
     """
     Client → Server. Broadcast message.
     :param username: the username
     :param message_type: The type of the message (0 = text message, 1 = voice message)
-    :param data: the data to send
+    :param data: the data to send (v1: voice as a hex string, v2: voice as the raw bytes)
     :param encryption_enabled: A boolean controls whether there is encryption on the params or not.
     :param AES_key: The key to decrypt the client's message
+    :param version: The protocol version to frame the message with
+    :param compression: The negotiated compression (v2 only, see pick_compression)
     :return: the bytes to send via the socket later on
     """
+    if version == PROTOCOL_V2:
+        return _create_v2_frame(COMMAND_BROADCAST, message_type, (username, data), encryption_enabled, AES_key,
+                                compression)
     if not (encryption_enabled and AES_key):
         return (str(COMMAND_BROADCAST) + str(message_type) + _pad_with_length(username) + _pad_with_length(data)).encode()
 
     # inner payload: pad(username) + pad(message)
     inner = _pad_with_length(username) + _pad_with_length(data)
-    cipher_bytes = encryption_utils.encrypt_AES(inner, AES_key)
+    cipher_bytes = _encrypt(inner, AES_key)
     encrypted_hex = cipher_bytes.hex()
     outer = str(COMMAND_BROADCAST) + str(message_type) + _pad_with_length(encrypted_hex)
     return outer.encode()
 
 
-def create_user_msg_private(username: str, recipient: str, message_type: Literal[0, 1], data: str,
-                            encryption_enabled=False, AES_key=None) -> bytes:
+def create_user_msg_private(username: str, recipient: str, message_type: Literal[0, 1], data: str | bytes,
+                            encryption_enabled=False, AES_key=None, version=PROTOCOL_V1,
+                            compression=COMPRESSION_NONE) -> bytes:
     """
     Client → Server. Private message.
     :param username: the sender username
     :param message_type: The type of the message (0 = text message, 1 = voice message)
     :param recipient: the recipient username
-    :param data: the data to send
+    :param data: the data to send (v1: voice as a hex string, v2: voice as the raw bytes)
     :param encryption_enabled: A boolean controls whether there is encryption on the params or not.
     :param AES_key: The key to decrypt the client's message
+    :param version: The protocol version to frame the message with
+    :param compression: The negotiated compression (v2 only, see pick_compression)
     :return: the bytes to send via the socket later on
     """
+    if version == PROTOCOL_V2:
+        return _create_v2_frame(COMMAND_PRIVATE, message_type, (username, recipient, data), encryption_enabled, AES_key,
+                                compression)
     if not (encryption_enabled and AES_key):
         return (str(COMMAND_PRIVATE) + str(message_type) + _pad_with_length(username) + _pad_with_length(recipient)
                 + _pad_with_length(data)).encode()
 
     inner = _pad_with_length(username) + _pad_with_length(recipient) + _pad_with_length(data)
-    cipher_bytes = encryption_utils.encrypt_AES(inner, AES_key)
+    cipher_bytes = _encrypt(inner, AES_key)
     encrypted_hex = cipher_bytes.hex()
     outer = str(COMMAND_PRIVATE) + str(message_type) + _pad_with_length(encrypted_hex)
     return outer.encode()
 
 
-def create_server_msg(code: int, message_type: Literal[0, 1], data: str,
-                      encryption_enabled=False, encryption_key=None) -> bytes:
+def create_server_msg(code: int, message_type: Literal[0, 1], data: str | bytes,
+                      encryption_enabled=False, encryption_key=None, version=PROTOCOL_V1,
+                      compression=COMPRESSION_NONE) -> bytes:
     """
     Server → Client. Private message to the client.
     :param code: The response code
     :param message_type: The type of the message.
-    :param data: the data to send
+    :param data: the data to send (v2 voice messages: bytes)
     :param encryption_enabled: A boolean controls whether there is encryption on the params or not.
     :param encryption_key: The key to decrypt the client's message
+    :param version: The protocol version to frame the message with
+    :param compression: The negotiated compression (v2 only, see pick_compression)
     :return: the bytes to send via the socket later on
     """
+    if version == PROTOCOL_V2:
+        return _create_v2_frame(code, message_type, (data,), encryption_enabled, encryption_key, compression)
     if not encryption_enabled:
         return (str(code) + str(message_type) + _pad_with_length(data)).encode()
 
     padded_message = _pad_with_length(data)
-    cipher_bytes = encryption_utils.encrypt_AES(padded_message, encryption_key)
+    cipher_bytes = _encrypt(padded_message, encryption_key)
     encrypted_hex = cipher_bytes.hex()
     return (str(code) + str(message_type) + _pad_with_length(encrypted_hex)).encode()
 
 
+def create_user_msg_voice_chunk(username: str, recipient: str, stream_id: int, sequence: int, final: bool, data: bytes,
+                                encryption_enabled=False, AES_key=None) -> bytes:
+    """
+    Client → Server. One chunk of a streamed voice message (FEATURE_VOICE_STREAM, always a v2 frame).
+    :param username: the sender username
+    :param recipient: the recipient username, or "" to broadcast
+    :param stream_id: identifies the voice message among the ones the client is streaming
+    :param sequence: the number of the chunk in the stream, starting at 0
+    :param final: whether this is the last chunk
+    :param data: the next bytes of the mp3 (at most VOICE_CHUNK_SIZE)
+    :param encryption_enabled: A boolean controls whether there is encryption on the params or not.
+    :param AES_key: The key to encrypt the message with
+    :return: the bytes to send via the socket later on
+    """
+    return _create_v2_frame(COMMAND_VOICE_CHUNK, MESSAGE_VOICE,
+                            (username, recipient, create_stream_field(stream_id, sequence, final), data),
+                            encryption_enabled, AES_key)
+
+
+def create_server_msg_voice_chunk(prefix: str, stream: str, data: bytes, encryption_enabled=False,
+                                  encryption_key=None) -> bytes:
+    """
+    Server → Client. Relays one chunk of a streamed voice message (FEATURE_VOICE_STREAM, always a v2 frame).
+    :param prefix: who the message is from, the same as the prefix of a voice message
+    :param stream: the "stream" field of the chunk, as the sender sent it
+    :param data: the bytes of the chunk
+    :param encryption_enabled: A boolean controls whether there is encryption on the params or not.
+    :param encryption_key: The key to encrypt the message with
+    :return: the bytes to send via the socket later on
+    """
+    return _create_v2_frame(RESPONSE_VOICE_CHUNK, MESSAGE_VOICE, (prefix, stream, data),
+                            encryption_enabled, encryption_key)
+
+
 # --- Protocol: Parse Messages ---
+# what was received (the code that writes the frames counts the bytes that are sent, in "protocol.bytes_out")
+_bytes_in = metrics.counter("protocol.bytes_in")
+_frames_in = metrics.counter("protocol.frames_in")
+_parse_time = metrics.timer("protocol.FrameDecoder._parse") # of the complete frames - not of the probes of a partial one
+_clock = time.perf_counter
+_errors = metrics.counter("protocol.errors") # frames that could not be parsed or decrypted
+
 def recv_client_msg(sock: socket.socket, encryption_enabled=False, encryption_key=None):
     """
     Read a message from a client.
@@ -182,10 +596,25 @@ def recv_client_msg(sock: socket.socket, encryption_enabled=False, encryption_ke
     :return: (success: bool, command: int | None, message_type: int, params: dict | None)
     """
     try:
-        command = int(_recv_fixed(sock, 1))  # one digit command
+        first = _recv_fixed_bytes(sock, 1)
+        if first[0] == V2_MARKER:
+            command, message_type, compression, payload_length = _parse_v2_header(_recv_fixed_bytes(sock, _V2_HEADER.size))
+            payload = _recv_fixed_bytes(sock, payload_length)
+            if command not in _CLIENT_MSG_FIELDS:
+                raise ValueError(f"Unknown command: {command}")
+            return True, command, message_type, _parse_v2_payload(command, message_type, payload,
+                                                                  _CLIENT_MSG_FIELDS[command], True,
+                                                                  encryption_enabled, encryption_key, compression)
+
+        command = int(first.decode())  # one digit command
         message_type = int(_recv_fixed(sock, 1))  # one digit command
 
-        if command == COMMAND_HANDSHAKE:
+        if command in (COMMAND_HELLO, COMMAND_RESUME):
+            (name,) = _CLIENT_MSG_FIELDS[command]
+            field_length = int(_recv_fixed(sock, LENGTH_FIELD_SIZE))
+            return True, command, message_type, {name: _recv_fixed(sock, field_length)}
+
+        elif command == COMMAND_HANDSHAKE:
             # RSA public key arrives as PEM string
             key_length = int(_recv_fixed(sock, LENGTH_FIELD_SIZE))
             RSA_key_pem = _recv_fixed(sock, key_length)
@@ -193,13 +622,11 @@ def recv_client_msg(sock: socket.socket, encryption_enabled=False, encryption_ke
 
         elif command == COMMAND_SET_USERNAME:
             payload_length = int(_recv_fixed(sock, LENGTH_FIELD_SIZE))
-            payload = _recv_fixed(sock, payload_length)
-
             if not encryption_enabled:
-                return True, command, message_type, {"username": payload}
+                return True, command, message_type, {"username": _recv_fixed(sock, payload_length)}
 
-            cipher_bytes = bytes.fromhex(payload)
-            padded_plain = encryption_utils.decrypt_AES(cipher_bytes, encryption_key)
+            cipher_bytes = _recv_hex(sock, payload_length)
+            padded_plain = _decrypt(cipher_bytes, encryption_key)
             username_length = int(padded_plain[:LENGTH_FIELD_SIZE])
             username = padded_plain[LENGTH_FIELD_SIZE:LENGTH_FIELD_SIZE + username_length]
             return True, command, message_type, {"username": username}
@@ -214,10 +641,8 @@ def recv_client_msg(sock: socket.socket, encryption_enabled=False, encryption_ke
                 return True, command, message_type, {"username": username, "password": password}
             else:
                 payload_length = int(_recv_fixed(sock, LENGTH_FIELD_SIZE))
-                payload = _recv_fixed(sock, payload_length)
-
-                cipher_bytes = bytes.fromhex(payload)
-                padded_plain = encryption_utils.decrypt_AES(cipher_bytes, encryption_key)
+                cipher_bytes = _recv_hex(sock, payload_length)
+                padded_plain = _decrypt(cipher_bytes, encryption_key)
 
                 username_length = int(padded_plain[:LENGTH_FIELD_SIZE])
                 username = padded_plain[LENGTH_FIELD_SIZE:LENGTH_FIELD_SIZE + username_length]
@@ -235,10 +660,8 @@ def recv_client_msg(sock: socket.socket, encryption_enabled=False, encryption_ke
                 return True, command, message_type, {"username": username, "message": message}
             else:
                 payload_length = int(_recv_fixed(sock, LENGTH_FIELD_SIZE))
-                payload = _recv_fixed(sock, payload_length)
-
-                cipher_bytes = bytes.fromhex(payload)
-                padded_plain = encryption_utils.decrypt_AES(cipher_bytes, encryption_key)
+                cipher_bytes = _recv_hex(sock, payload_length)
+                padded_plain = _decrypt(cipher_bytes, encryption_key)
 
                 username_length = int(padded_plain[:LENGTH_FIELD_SIZE])
                 username = padded_plain[LENGTH_FIELD_SIZE:LENGTH_FIELD_SIZE + username_length]
@@ -260,10 +683,8 @@ def recv_client_msg(sock: socket.socket, encryption_enabled=False, encryption_ke
                 return True, command, message_type, {"username": username, "recipient": recipient_name, "message": message}
             else:
                 payload_length = int(_recv_fixed(sock, LENGTH_FIELD_SIZE))
-                payload = _recv_fixed(sock, payload_length)
-
-                cipher_bytes = bytes.fromhex(payload)
-                padded_plain = encryption_utils.decrypt_AES(cipher_bytes, encryption_key)
+                cipher_bytes = _recv_hex(sock, payload_length)
+                padded_plain = _decrypt(cipher_bytes, encryption_key)
 
                 username_length = int(padded_plain[:LENGTH_FIELD_SIZE])
                 username = padded_plain[LENGTH_FIELD_SIZE:LENGTH_FIELD_SIZE + username_length]
@@ -279,6 +700,7 @@ def recv_client_msg(sock: socket.socket, encryption_enabled=False, encryption_ke
 
     except Exception as e:
         print(f"[Protocol ERROR] {e}. \n\t function: recv_client_msg")
+        _errors.inc()
         return False, None, None, None
 
 
@@ -288,23 +710,242 @@ def recv_server_msg(sock: socket.socket, encryption_enabled=False, AES_key=None)
     :param sock: the server's socket
     :param encryption_enabled: A boolean controls whether there is encryption on the params or not.
     :param AES_key: The key to decrypt the server's message
-    :return: (success: bool, code: int | None, message_type: int, message: str | None)
+    :return: (success: bool, code: int | None, message_type: int, message: str | bytes | dict | None),
+             the message is a dict of fields for the codes in _SERVER_MSG_FIELDS
     """
     try:
-        code = int(sock.recv(1).decode())  # read one digit - the response code
-        message_type = int(sock.recv(1).decode())  # read one digit - the response code
+        first = _recv_fixed_bytes(sock, 1)
+        if first[0] == V2_MARKER:
+            code, message_type, compression, payload_length = _parse_v2_header(_recv_fixed_bytes(sock, _V2_HEADER.size))
+            payload = _recv_fixed_bytes(sock, payload_length)
+            names = _SERVER_MSG_FIELDS.get(code, ("message",))
+            data = _parse_v2_payload(code, message_type, payload, names, False, encryption_enabled, AES_key,
+                                     compression)
+            return True, code, message_type, data if code in _SERVER_MSG_FIELDS else data["message"]
+
+        code = int(first.decode())  # read one digit - the response code
+        message_type = int(_recv_fixed(sock, 1))  # read one digit - the response code
 
         data_length = int(_recv_fixed(sock, LENGTH_FIELD_SIZE))
-        data = _recv_fixed(sock, data_length)
         if not (encryption_enabled and AES_key):
-            return True, code, message_type, data
+            return True, code, message_type, _recv_fixed(sock, data_length)
 
-        cipher_bytes = bytes.fromhex(data)
-        padded_plain = encryption_utils.decrypt_AES(cipher_bytes, AES_key)
+        cipher_bytes = _recv_hex(sock, data_length)
+        padded_plain = _decrypt(cipher_bytes, AES_key)
         length_field = padded_plain[:LENGTH_FIELD_SIZE]
         msg_len = int(length_field)
         data = padded_plain[LENGTH_FIELD_SIZE: LENGTH_FIELD_SIZE + msg_len]
         return True, code, message_type, data
     except Exception as e:
         print(f"[Protocol ERROR] {e}. \n\t function: recv_client_msg")
-        return False, None, None, None
\ No newline at end of file
+        _errors.inc()
+        return False, None, None, None
+
+
+# --- Protocol: Parse Messages (asyncio streams) ---
+async def recv_client_msg_async(reader: asyncio.StreamReader, encryption_enabled=False, encryption_key=None):
+    """
+    Read a message from a client over an asyncio stream. Same wire format as recv_client_msg.
+    :param reader: the client's stream reader
+    :param encryption_enabled: A boolean controls whether there is encryption on the params or not.
+    :param encryption_key: The key to decrypt the client's message
+    :return: (success: bool, command: int | None, message_type: int, params: dict | None)
+    """
+    try:
+        first = await reader.readexactly(1)
+        if first[0] == V2_MARKER:
+            command, message_type, compression, payload_length = _parse_v2_header(await reader.readexactly(_V2_HEADER.size))
+            payload = await reader.readexactly(payload_length)
+            if command not in _CLIENT_MSG_FIELDS:
+                raise ValueError(f"Unknown command: {command}")
+            return True, command, message_type, _parse_v2_payload(command, message_type, payload,
+                                                                  _CLIENT_MSG_FIELDS[command], True,
+                                                                  encryption_enabled, encryption_key, compression)
+
+        command = int(first.decode())  # one digit command
+        message_type = int(await _async_recv_fixed(reader, 1))  # one digit message type
+
+        if command not in _CLIENT_MSG_FIELDS:
+            raise ValueError(f"Unknown command: {command}")
+        names = _CLIENT_MSG_FIELDS[command]
+
+        # the hello and the handshake are never encrypted
+        if not encryption_enabled or command in _PLAIN_COMMANDS:
+            params = {}
+            for name in names:
+                length = int(await _async_recv_fixed(reader, LENGTH_FIELD_SIZE))
+                params[name] = await _async_recv_fixed(reader, length)
+            return True, command, message_type, params
+
+        payload_length = int(await _async_recv_fixed(reader, LENGTH_FIELD_SIZE))
+        cipher_bytes = binascii.unhexlify(await reader.readexactly(payload_length))
+        padded_plain = _decrypt(cipher_bytes, encryption_key)
+        return True, command, message_type, _unpad_fields(padded_plain, names)
+
+    except (asyncio.IncompleteReadError, ConnectionError):
+        # the client went away - not a protocol error
+        return False, None, None, None
+    except Exception as e:
+        print(f"[Protocol ERROR] {e}. \n\t function: recv_client_msg_async")
+        _errors.inc()
+        return False, None, None, None
+
+
+async def recv_server_msg_async(reader: asyncio.StreamReader, encryption_enabled=False, AES_key=None):
+    """
+    Read a message from the server over an asyncio stream. Same wire format as recv_server_msg.
+    :param reader: the server's stream reader
+    :param encryption_enabled: A boolean controls whether there is encryption on the params or not.
+    :param AES_key: The key to decrypt the server's message
+    :return: (success: bool, code: int | None, message_type: int, message: str | bytes | dict | None),
+             the message is a dict of fields for the codes in _SERVER_MSG_FIELDS
+    """
+    try:
+        first = await reader.readexactly(1)
+        if first[0] == V2_MARKER:
+            code, message_type, compression, payload_length = _parse_v2_header(await reader.readexactly(_V2_HEADER.size))
+            payload = await reader.readexactly(payload_length)
+            names = _SERVER_MSG_FIELDS.get(code, ("message",))
+            data = _parse_v2_payload(code, message_type, payload, names, False, encryption_enabled, AES_key,
+                                     compression)
+            return True, code, message_type, data if code in _SERVER_MSG_FIELDS else data["message"]
+
+        code = int(first.decode())
+        message_type = int(await _async_recv_fixed(reader, 1))
+
+        data_length = int(await _async_recv_fixed(reader, LENGTH_FIELD_SIZE))
+        if not (encryption_enabled and AES_key):
+            return True, code, message_type, await _async_recv_fixed(reader, data_length)
+
+        cipher_bytes = binascii.unhexlify(await reader.readexactly(data_length))
+        padded_plain = _decrypt(cipher_bytes, AES_key)
+        return True, code, message_type, _unpad_fields(padded_plain, ("message",))["message"]
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return False, None, None, None
+    except Exception as e:
+        print(f"[Protocol ERROR] {e}. \n\t function: recv_server_msg_async")
+        _errors.inc()
+        return False, None, None, None
+
+
+# --- Protocol: Incremental (sans-IO) decoding ---
+class FrameDecoder:
+    """
+    Parses frames out of a byte stream without doing any IO itself: feed() it whatever was received
+    (any chunk size, e.g. one big recv) and iterate it for the complete frames.
+    Works for v1 and v2 frames, in both directions, so a select loop, an asyncio server or a test can share it.
+    Frames are the same tuples recv_client_msg / recv_server_msg return.
+    """
+    def __init__(self, from_client: bool, encryption_enabled=False, AES_key=None):
+        """
+        :param from_client: True to decode client → server frames, False for server → client frames
+        :param encryption_enabled: A boolean controls whether there is encryption on the params or not.
+        :param AES_key: The key to decrypt the messages. Both can be changed between frames, e.g. after the handshake.
+        """
+        self.from_client = from_client
+        self.encryption_enabled = encryption_enabled
+        self.AES_key = AES_key
+
+        self._buffer = bytearray()
+        self._position = 0  # where the first unparsed frame starts
+
+    def feed(self, data: bytes):
+        """
+        Adds received bytes to the decoder.
+        """
+        # drop the parsed frames once they take most of the buffer, so it is not copied for every frame
+        if self._position and self._position * 2 >= len(self._buffer):
+            del self._buffer[:self._position]
+            self._position = 0
+        self._buffer += data
+        _bytes_in.inc(len(data))
+
+    def next_frame(self):
+        """
+        Parses the next complete frame.
+        :return: (success: bool, command/code: int | None, message_type: int, params: dict | message) or None if
+                 the frame has not fully arrived yet. A failed frame leaves the stream unusable, so the rest is dropped.
+        """
+        try:
+            # one frame in METRICS_SAMPLE_EVERY is timed, like metrics.timed() does
+            start = _clock() if _parse_time.calls % metrics.METRICS_SAMPLE_EVERY == 0 else None
+            with memoryview(self._buffer) as view:
+                result = self._parse(view[self._position:])
+            if result is None:
+                return None
+            length, frame = result
+            self._position += length
+            _frames_in.inc()
+            _parse_time.calls += 1
+            if start is not None:
+                _parse_time.observe(_clock() - start)
+            return frame
+        except Exception as e:
+            print(f"[Protocol ERROR] {e}. \n\t function: FrameDecoder.next_frame")
+            _errors.inc()
+            self._buffer = bytearray()
+            self._position = 0
+            return False, None, None, None
+
+    def __iter__(self):
+        while (frame := self.next_frame()) is not None:
+            yield frame
+
+    def _parse(self, view: memoryview):
+        """
+        :param view: the unparsed bytes
+        :return: (frame length, frame) or None if the frame is incomplete
+        """
+        if not view:
+            return None
+
+        if view[0] == V2_MARKER:
+            header_end = 1 + _V2_HEADER.size
+            if len(view) < header_end:
+                return None
+            command, message_type, compression, payload_length = _parse_v2_header(view[1:header_end])
+            if len(view) < header_end + payload_length:
+                return None
+            names = self._field_names(command)
+            params = _parse_v2_payload(command, message_type, view[header_end:header_end + payload_length], names,
+                                       self.from_client, self.encryption_enabled, self.AES_key, compression)
+            if not self.from_client and command not in _SERVER_MSG_FIELDS:
+                params = params["message"]
+            return header_end + payload_length, (True, command, message_type, params)
+
+        if len(view) < 2:
+            return None
+        command = int(str(view[0:1], "ascii"))  # one digit command/code
+        message_type = int(str(view[1:2], "ascii"))
+        names = self._field_names(command)
+        plain = not (self.encryption_enabled and self.AES_key) or (self.from_client and command in _PLAIN_COMMANDS)
+        # unencrypted client frames carry every field on its own, everything else is a single field
+        field_count = len(names) if plain and self.from_client else 1
+
+        fields = []
+        position = 2
+        for _ in range(field_count):
+            if len(view) < position + LENGTH_FIELD_SIZE:
+                return None
+            length = int(str(view[position:position + LENGTH_FIELD_SIZE], "ascii"))
+            position += LENGTH_FIELD_SIZE
+            if len(view) < position + length:
+                return None
+            fields.append(view[position:position + length])
+            position += length
+
+        if plain:
+            params = {name: str(field, "utf-8") for name, field in zip(names, fields)}
+        else:
+            padded_plain = _decrypt(binascii.unhexlify(fields[0]), self.AES_key)
+            params = _unpad_fields(padded_plain, names)
+        if not self.from_client:
+            params = params["message"]
+        return position, (True, command, message_type, params)
+
+    def _field_names(self, command: int) -> tuple:
+        if not self.from_client:
+            return _SERVER_MSG_FIELDS.get(command, ("message",))
+        if command not in _CLIENT_MSG_FIELDS:
+            raise ValueError(f"Unknown command: {command}")
+        return _CLIENT_MSG_FIELDS[command]
@@ -6,9 +6,9 @@ class ScrollableCanvasWithFrame:
 		self.canvas = tk.Canvas(parent, bg=gui_config.BG_COLOR)
 		self.canvas.pack(side="left", fill=tk.BOTH, expand=True)
 
-		scrollbar = tk.Scrollbar(parent, orient="vertical", command=self.canvas.yview)
-		self.canvas.configure(yscrollcommand=scrollbar.set)
-		scrollbar.pack(side="right", fill="y")
+		self.scrollbar = tk.Scrollbar(parent, orient="vertical", command=self.canvas.yview)
+		self.canvas.configure(yscrollcommand=self.scrollbar.set)
+		self.scrollbar.pack(side="right", fill="y")
 
 		self.scroll_frame = tk.Frame(self.canvas, bg=gui_config.BG_COLOR)
 		# place the frame on the canvas - the top left of the frame is 0,0
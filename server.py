@@ -0,0 +1,507 @@
+"""
+Single-process asyncio chat server that speaks the protocol in protocol.py.
+
+Every connection is a coroutine instead of a thread, so one process can hold thousands of clients.
+Throughput target: 20,000 delivered messages/sec on one core with 1,000 connected clients
+(see benchmarks.bench_server_throughput).
+"""
+import asyncio
+import hashlib
+import hmac
+import os
+import struct
+import time
+
+import encryption_utils
+import metrics
+import protocol
+
+PASSWORD_SALT_SIZE = 16
+PASSWORD_HASH_ITERATIONS = 100_000
+# a client whose unsent data grows past this is too slow to keep up and gets disconnected
+MAX_PENDING_BYTES = 4 * 1024 * 1024
+LISTEN_BACKLOG = 4096
+
+TICKET_LIFETIME = 60 * 60  # in seconds - how long a resumption ticket can be used
+TICKET_KEY_ROTATION = 60 * 60  # in seconds - how often a new ticket key is made
+TICKET_KEYS_KEPT = 2  # the current ticket key and the one before it, so fresh tickets survive a rotation
+TICKET_ID_SIZE = 16  # random bytes that tell tickets apart, so that each one is redeemed only once
+
+# streamed voice messages are relayed chunk by chunk. only clients without the "voice-stream" feature
+# need the whole message, so the server buffers it for them - up to this size, and this many streams per sender
+MAX_BUFFERED_VOICE_SIZE = 8 * 1024 * 1024
+MAX_BUFFERED_VOICE_STREAMS = 2
+
+# metrics (metrics.py): a snapshot is written to <METRICS_DIR>/metrics_server.jsonl every metrics.METRICS_INTERVAL
+# seconds, and served as JSON at http://127.0.0.1:<METRICS_PORT>/ if it is set
+METRICS_DIR = "metrics"
+METRICS_PORT = None
+
+_bytes_out = metrics.counter("protocol.bytes_out") # every frame is written by Session._write
+
+
+def _hash_password(password: str, salt: bytes) -> bytes:
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, PASSWORD_HASH_ITERATIONS)
+
+
+class TicketKeys:
+    """
+    Issues and redeems session resumption tickets.
+    A ticket is the username and the session's AES key, encrypted (AES-GCM) with a key only the server knows.
+    The ticket keys rotate every TICKET_KEY_ROTATION seconds, and tickets carry their own expiry time.
+    Every ticket has a random id and is redeemed only once - a ticket is sent in plaintext, so it can be replayed.
+    """
+    _KEY_ID = struct.Struct(">I")
+    _HEADER = struct.Struct(f">d{TICKET_ID_SIZE}s32s")  # expiry time, ticket id, AES key - followed by the username
+
+    def __init__(self):
+        self.keys: dict[int, encryption_utils.SessionCipher] = dict()  # { key id: cipher }, oldest first
+        self.current_id = -1
+        self.rotated_at = 0.0
+        self.redeemed: dict[bytes, float] = dict()  # { ticket id: expiry time } of the tickets already redeemed
+        self._rotate()
+
+    def _rotate(self):
+        self.current_id += 1
+        self.keys[self.current_id] = encryption_utils.SessionCipher(encryption_utils.generate_AES_key())
+        while len(self.keys) > TICKET_KEYS_KEPT:
+            del self.keys[next(iter(self.keys))]
+        self.rotated_at = time.monotonic()
+        # an expired ticket is refused anyway - no need to remember that it was redeemed
+        now = time.time()
+        self.redeemed = {ticket_id: expires_at for ticket_id, expires_at in self.redeemed.items() if expires_at > now}
+
+    def issue(self, username: str, AES_key: bytes) -> str:
+        """
+        :param username: the logged-in user
+        :param AES_key: the raw AES key of the session
+        :return: the ticket, as a hex string
+        """
+        if time.monotonic() - self.rotated_at >= TICKET_KEY_ROTATION:
+            self._rotate()
+        key_id = self._KEY_ID.pack(self.current_id)
+        ticket_id = os.urandom(TICKET_ID_SIZE)
+        plain = self._HEADER.pack(time.time() + TICKET_LIFETIME, ticket_id, AES_key) + username.encode()
+        return (key_id + self.keys[self.current_id].encrypt(plain, key_id)).hex()
+
+    def redeem(self, ticket: str):
+        """
+        :param ticket: a ticket made by issue()
+        :return: (username, AES key), or None if the ticket is invalid, expired, already redeemed or its key was
+                 rotated out
+        """
+        try:
+            raw = bytes.fromhex(ticket)
+            key_id = raw[:self._KEY_ID.size]
+            cipher = self.keys.get(self._KEY_ID.unpack(key_id)[0])
+            if cipher is None:
+                return None
+            plain = cipher.decrypt(raw[self._KEY_ID.size:], key_id)
+        except Exception:
+            return None
+
+        expires_at, ticket_id, AES_key = self._HEADER.unpack_from(plain)
+        if time.time() > expires_at or ticket_id in self.redeemed:
+            return None
+        self.redeemed[ticket_id] = expires_at
+        return plain[self._HEADER.size:].decode(), AES_key
+
+
+class ClientSession:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.AES_key = None  # the raw key, or a SessionCipher with the "aead" feature
+        self.session_key = None  # always the raw key - it goes into resumption tickets
+        self.encryption_ready = False
+        self.username = None  # the username the client asked for
+        self.logged_in = False
+        self.resuming = False  # a ticket was accepted, but the client has not proven yet that it has the key
+
+        # picked by the client's COMMAND_HELLO (old clients never send one)
+        self.features = set()
+        self.version = protocol.PROTOCOL_V1
+        self.compression = protocol.COMPRESSION_NONE # for the text frames to this client
+
+        # { stream id: the voice message so far } of the client's streams that someone needs as a whole message.
+        # None marks a stream that got too big to buffer.
+        self.voice_buffers: dict[int, bytearray | None] = dict()
+
+    def send(self, code: int, message_type, data: str | bytes):
+        """
+        Queues a message to the client (encrypted once the handshake is done).
+        :param code: The response code
+        :param message_type: The type of the message.
+        :param data: the data to send
+        :return: None
+        """
+        if self.writer.is_closing():
+            return
+        try:
+            raw = protocol.create_server_msg(code, message_type, data, self.encryption_ready, self.AES_key, self.version,
+                                             self.compression)
+        except ValueError as e:
+            # e.g. a big v2 voice message that does not fit in a v1 frame
+            print(f"[Server ERROR] Could not send to {self.username}: {e}")
+            return
+        self._write(raw)
+
+    def _write(self, raw: bytes):
+        self.writer.write(raw)
+        _bytes_out.inc(len(raw))
+        if self.writer.transport.get_write_buffer_size() > MAX_PENDING_BYTES:
+            print(f"[Server] Disconnecting slow client {self.username}.")
+            self.writer.transport.abort()
+
+    def send_chat(self, message_type, prefix: str, message: str | bytes):
+        """
+        Sends a chat message as "<prefix>: <message>", in the form this client's protocol version expects.
+        :param message_type: The type of the message.
+        :param prefix: who the message is from, e.g. "alice" or "[Private Message from alice]"
+        :param message: the text, or the mp3 bytes of a voice message
+        """
+        if message_type == protocol.MESSAGE_VOICE:
+            if self.version == protocol.PROTOCOL_V2:
+                data = f"{prefix}: ".encode() + message
+            else:
+                data = f"{prefix}: {message.hex()}"
+        else:
+            data = f"{prefix}: {message}"
+        self.send(protocol.RESPONSE_OK, message_type, data)
+
+    @property
+    def streams_voice(self) -> bool:
+        return protocol.FEATURE_VOICE_STREAM in self.features
+
+    def send_voice_chunk(self, prefix: str, stream: str, data: bytes):
+        """
+        Relays one chunk of a streamed voice message. Only for clients with the "voice-stream" feature.
+        :param prefix: who the message is from, e.g. "alice" or "[Private Message from alice]"
+        :param stream: the "stream" field of the chunk
+        :param data: the bytes of the chunk
+        """
+        if self.writer.is_closing():
+            return
+        self._write(protocol.create_server_msg_voice_chunk(prefix, stream, data, self.encryption_ready, self.AES_key))
+
+
+class ChatServer:
+    def __init__(self, host=protocol.SERVER_ADDRESS, port=protocol.PORT):
+        self.host = host
+        self.port = port
+        self.server = None
+
+        self.users: dict[str, tuple[bytes, bytes]] = dict()  # { username: (salt, password_hash) }
+        self.online: dict[str, ClientSession] = dict()  # { username: session } of logged-in clients
+        self.tickets = TicketKeys()
+        metrics.gauge("server.online", lambda: len(self.online))
+        metrics.gauge("server.users", lambda: len(self.users))
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port, backlog=LISTEN_BACKLOG)
+        # port 0 lets the OS pick one - remember which
+        self.port = self.server.sockets[0].getsockname()[1]
+        print(f"[Server] Listening on {self.host}:{self.port}")
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Runs a single connection from the hello message until it disconnects.
+        """
+        session = ClientSession(reader, writer)
+        session.send(protocol.RESPONSE_HELLO, protocol.MESSAGE_TEXT, "SERVER: Hello! Please enter your username.")
+        decoder = protocol.FrameDecoder(from_client=True)
+        try:
+            connected = True
+            while connected:
+                # one read usually holds many frames
+                data = await reader.read(protocol.RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                decoder.feed(data)
+                for success, command, message_type, params in decoder:
+                    if not success or not await self.handle_command(session, command, message_type, params):
+                        connected = False
+                        break
+                    # the handshake turns encryption on for the frames after it
+                    decoder.encryption_enabled = session.encryption_ready
+                    decoder.AES_key = session.AES_key
+                await writer.drain()
+        except ConnectionError:
+            pass
+        except (ValueError, TypeError) as e:
+            print(f"[Server ERROR] {e}. Dropping client {session.username}.")
+        finally:
+            if session.logged_in and self.online.get(session.username) is session:
+                del self.online[session.username]
+            writer.close()
+
+    async def handle_command(self, session: ClientSession, command: int, message_type, params: dict) -> bool:
+        """
+        Handles one parsed client message.
+        :return: False if the connection should be closed, True otherwise
+        """
+        if session.resuming:
+            return self._finish_resume(session, command, params)
+
+        elif command == protocol.COMMAND_HELLO:
+            # the features can only be picked before anything is encrypted
+            if session.encryption_ready:
+                return False
+            session.features = protocol.parse_features(params["features"]) & protocol.SUPPORTED_FEATURES
+            # voice chunks and compression only exist in v2 frames
+            protocol.discard_v2_only_features(session.features)
+            # the answer is the last v1 frame, so that the client can read it before switching
+            session.send(protocol.RESPONSE_HELLO, protocol.MESSAGE_TEXT,
+                         protocol.create_features_line(session.features))
+            if protocol.FEATURE_BINARY_FRAMES in session.features:
+                session.version = protocol.PROTOCOL_V2
+            session.compression = protocol.pick_compression(session.features)
+
+        elif command == protocol.COMMAND_HANDSHAKE:
+            self._handshake(session, params["RSA_key"])
+
+        elif command == protocol.COMMAND_RESUME:
+            if session.encryption_ready or protocol.FEATURE_RESUME not in session.features:
+                return False
+            self._resume(session, params["ticket"])
+
+        elif not session.encryption_ready:
+            # everything except the handshake has to be encrypted
+            return False
+
+        elif command == protocol.COMMAND_SET_USERNAME:
+            self._set_username(session, params["username"])
+
+        elif command == protocol.COMMAND_SET_PASSWORD:
+            await self._set_password(session, params["username"], params["password"])
+
+        elif not session.logged_in:
+            session.send(protocol.RESPONSE_USER_DOES_NOT_EXIST, protocol.MESSAGE_TEXT,
+                         "SERVER: Please log in before sending messages.")
+
+        elif command in (protocol.COMMAND_BROADCAST, protocol.COMMAND_PRIVATE):
+            message = params["message"]
+            # v1 clients send voice as hex - keep the raw bytes and let every recipient's version decide
+            if message_type == protocol.MESSAGE_VOICE and isinstance(message, str):
+                message = bytes.fromhex(message)
+
+            if command == protocol.COMMAND_BROADCAST:
+                self.broadcast(session, message_type, message)
+            else:
+                self.send_private(session, params["recipient"], message_type, message)
+
+        elif command == protocol.COMMAND_VOICE_CHUNK:
+            if not session.streams_voice:
+                return False
+            self.relay_voice_chunk(session, params["recipient"], params["stream"], params["message"])
+
+        return True
+
+    def _handshake(self, session: ClientSession, key: str):
+        """
+        Establishes the session's AES key. Either agrees on it with the client's X25519 public key,
+        or generates it and sends it encrypted with the client's public RSA key.
+        """
+        if key.startswith(protocol.X25519_PREFIX) and protocol.FEATURE_X25519 in session.features:
+            client_public_key = encryption_utils.deserialize_public_X25519_key(key[len(protocol.X25519_PREFIX):])
+            private_key, public_key = encryption_utils.generate_X25519_keys()
+            AES_key = encryption_utils.derive_AES_key(private_key, client_public_key)
+            session.send(protocol.RESPONSE_HANDSHAKE, protocol.MESSAGE_TEXT,
+                         protocol.X25519_PREFIX + encryption_utils.serialize_public_X25519_key(public_key))
+        else:
+            public_key = encryption_utils.deserialize_public_RSA_key(key)
+            AES_key = encryption_utils.generate_AES_key()
+            encrypted_AES = encryption_utils.encrypt_RSA(encryption_utils.serialize_AES_key(AES_key), public_key)
+            # the key itself travels inside RSA - the handshake response is not AES encrypted
+            session.send(protocol.RESPONSE_HANDSHAKE, protocol.MESSAGE_TEXT,
+                         protocol.SESSION_KEY_PREFIX + encrypted_AES.hex())
+        self._start_encryption(session, AES_key)
+
+    def _start_encryption(self, session: ClientSession, AES_key: bytes):
+        session.session_key = AES_key
+        if protocol.FEATURE_AEAD in session.features:
+            session.AES_key = encryption_utils.SessionCipher(AES_key)
+        else:
+            session.AES_key = AES_key
+        session.encryption_ready = True
+
+    def _resume(self, session: ClientSession, ticket: str):
+        """
+        Restores the AES key of a previous session from its ticket, in a single round trip. The login follows in
+        _finish_resume(), once the client proved that it has the key.
+        The answer is not encrypted, so a client whose ticket was rejected can go on with a normal handshake.
+        """
+        redeemed = self.tickets.redeem(ticket)
+        if redeemed is None or redeemed[0] not in self.users:
+            session.send(protocol.RESPONSE_INCORRECT_PASSWORD, protocol.MESSAGE_TEXT,
+                         "SERVER: The session could not be resumed.")
+            return
+        username, AES_key = redeemed
+
+        session.send(protocol.RESPONSE_CORRECT_PASSWORD, protocol.MESSAGE_TEXT, f"SERVER: Welcome back {username}!")
+        self._start_encryption(session, AES_key)
+        session.username = username
+        session.resuming = True
+
+    def _finish_resume(self, session: ClientSession, command: int, params: dict) -> bool:
+        """
+        Logs in a resumed session. The client's first frame after the ticket is its username, encrypted with the
+        restored key - so a captured ticket alone cannot take over the login (or log the user out).
+        :return: False if the frame is not that username, which closes the connection
+        """
+        if command != protocol.COMMAND_SET_USERNAME or params["username"] != session.username:
+            return False
+        session.resuming = False
+
+        # the old connection of a client that reconnects is often not noticed as dead yet - replace it
+        stale_session = self.online.pop(session.username, None)
+        if stale_session is not None:
+            stale_session.writer.transport.abort()
+        self._log_in(session)
+        return True
+
+    def _set_username(self, session: ClientSession, username: str):
+        username = username.strip()
+        if not username or ":" in username or " " in username or session.logged_in:
+            session.send(protocol.RESPONSE_INCORRECT_PASSWORD, protocol.MESSAGE_TEXT,
+                         "SERVER: This username is not valid.")
+            return
+
+        session.username = username
+        if username in self.users:
+            session.send(protocol.RESPONSE_USER_EXISTS, protocol.MESSAGE_TEXT,
+                         f"SERVER: Welcome back {username}! Please enter your password.")
+        else:
+            session.send(protocol.RESPONSE_USER_DOES_NOT_EXIST, protocol.MESSAGE_TEXT,
+                         f"SERVER: Hello {username}! Please choose a password.")
+
+    async def _set_password(self, session: ClientSession, username: str, password: str):
+        if session.logged_in or session.username is None or username != session.username:
+            session.send(protocol.RESPONSE_INCORRECT_PASSWORD, protocol.MESSAGE_TEXT,
+                         "SERVER: Please set a username first.")
+            return
+        if username in self.online:
+            session.send(protocol.RESPONSE_INCORRECT_PASSWORD, protocol.MESSAGE_TEXT,
+                         f"SERVER: {username} is already logged in.")
+            return
+
+        if username in self.users:
+            salt, password_hash = self.users[username]
+            # hashing is slow on purpose - keep it off the event loop
+            attempt_hash = await asyncio.to_thread(_hash_password, password, salt)
+            if not hmac.compare_digest(attempt_hash, password_hash):
+                session.send(protocol.RESPONSE_INCORRECT_PASSWORD, protocol.MESSAGE_TEXT,
+                             "SERVER: Incorrect password, please try again.")
+                return
+            code, text = protocol.RESPONSE_CORRECT_PASSWORD, f"SERVER: Logged in as {username}."
+        else:
+            salt = os.urandom(PASSWORD_SALT_SIZE)
+            self.users[username] = (salt, await asyncio.to_thread(_hash_password, password, salt))
+            code, text = protocol.RESPONSE_CREATED_USER, f"SERVER: Created the user {username}."
+
+        # another connection may have logged in while we were hashing
+        if username in self.online:
+            session.send(protocol.RESPONSE_INCORRECT_PASSWORD, protocol.MESSAGE_TEXT,
+                         f"SERVER: {username} is already logged in.")
+            return
+
+        session.send(code, protocol.MESSAGE_TEXT, text)
+        self._log_in(session)
+
+    def _log_in(self, session: ClientSession):
+        session.logged_in = True
+        self.online[session.username] = session
+        if protocol.FEATURE_RESUME in session.features:
+            session.send(protocol.RESPONSE_TICKET, protocol.MESSAGE_TEXT,
+                         self.tickets.issue(session.username, session.session_key))
+
+    def broadcast(self, sender: ClientSession, message_type, message: str | bytes):
+        """
+        Sends the message to every logged-in client except the sender.
+        """
+        for session in list(self.online.values()):
+            if session is not sender:
+                session.send_chat(message_type, sender.username, message)
+
+    def send_private(self, sender: ClientSession, recipient: str, message_type, message: str | bytes):
+        recipient_session = self.online.get(recipient)
+        if recipient_session is None:
+            sender.send(protocol.RECIPIENT_NOT_FOUND, protocol.MESSAGE_TEXT,
+                        f"SERVER: The user {recipient} was not found.")
+            return
+        recipient_session.send_chat(message_type, f"[Private Message from {sender.username}]", message)
+
+    def relay_voice_chunk(self, sender: ClientSession, recipient: str, stream: str, data: bytes):
+        """
+        Passes one chunk of a streamed voice message on as soon as it arrives.
+        Recipients that cannot take a stream get the whole message once its last chunk arrived.
+        :param recipient: the recipient username, or "" to broadcast
+        """
+        stream_id, sequence, final = protocol.parse_stream_field(stream)
+        if recipient:
+            recipient_session = self.online.get(recipient)
+            if recipient_session is None:
+                if sequence == 0:
+                    sender.send(protocol.RECIPIENT_NOT_FOUND, protocol.MESSAGE_TEXT,
+                                f"SERVER: The user {recipient} was not found.")
+                return
+            prefix = f"[Private Message from {sender.username}]"
+            recipients = [recipient_session]
+        else:
+            prefix = sender.username
+            recipients = [session for session in self.online.values() if session is not sender]
+
+        legacy_recipients = []
+        for session in recipients:
+            if session.streams_voice:
+                session.send_voice_chunk(prefix, stream, data)
+            else:
+                legacy_recipients.append(session)
+        if not legacy_recipients and sequence == 0:
+            return
+
+        # buffer the stream for the legacy recipients (a stream that started without any is never buffered)
+        if sequence == 0:
+            if len(sender.voice_buffers) >= MAX_BUFFERED_VOICE_STREAMS:
+                # a stream whose last chunk never came must not keep a slot for good - the oldest one makes room
+                del sender.voice_buffers[next(iter(sender.voice_buffers))]
+            sender.voice_buffers[stream_id] = bytearray()
+        buffer = sender.voice_buffers.get(stream_id)
+        if buffer is not None:
+            if len(buffer) + len(data) > MAX_BUFFERED_VOICE_SIZE:
+                print(f"[Server] Voice message from {sender.username} is too big to buffer.")
+                sender.voice_buffers[stream_id] = buffer = None
+            else:
+                buffer += data
+
+        if final:
+            sender.voice_buffers.pop(stream_id, None)
+            if buffer is not None:
+                message = bytes(buffer)
+                for session in legacy_recipients:
+                    session.send_chat(protocol.MESSAGE_VOICE, prefix, message)
+
+
+def main():
+    server = ChatServer()
+    metrics.start_reporting("server", METRICS_DIR, port=METRICS_PORT)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    metrics.stop_reporting()
+
+
+if __name__ == '__main__':
+    main()
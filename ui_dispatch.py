@@ -0,0 +1,101 @@
+"""
+Hands the messages that the network thread receives to the Tk thread, without polling.
+"""
+import queue
+import time
+import tkinter as tk
+from collections import deque
+from typing import Callable
+
+import gui_config
+import metrics
+
+WAKE_EVENT = "<<IncomingMessages>>"
+
+
+class UiDispatcher:
+    """
+    The network thread puts messages in the queue and calls wake(), which makes the Tk loop handle them as soon as it
+    is free. They are handled under a time budget per frame: a burst is spread over several frames instead of freezing
+    the window, and the messages of one frame are drawn (laid out and scrolled) together.
+    The items of the queue are tuples whose first value is the time.perf_counter() they were received at.
+    """
+    def __init__(self, root: tk.Tk, messages: queue.Queue, handle: Callable[[tuple], None],
+                 on_batch_start: Callable[[], None] = lambda: None, on_batch_end: Callable[[], None] = lambda: None,
+                 budget_ms=gui_config.UI_FRAME_BUDGET_MS):
+        """
+        :param root: The Tk root
+        :param messages: The queue the network thread puts the messages in
+        :param handle: Called with every message, in the Tk thread
+        :param on_batch_start: Called before the messages of a frame are handled
+        :param on_batch_end: Called after the messages of a frame were handled, e.g. to scroll once for all of them
+        :param budget_ms: How long the messages of one frame may take - the rest wait for the next frame
+        """
+        self.root = root
+        self.messages = messages
+        self.handle = handle
+        self.on_batch_start = on_batch_start
+        self.on_batch_end = on_batch_end
+        self.budget = budget_ms / 1000
+
+        # receive-to-render latencies of the last messages, in seconds
+        self.latencies = deque(maxlen=gui_config.UI_LATENCY_SAMPLES)
+        self.latency_histogram = metrics.histogram("ui_dispatch.receive_to_render") # of all of them
+
+        self._wake_pending = False
+        self.root.bind(WAKE_EVENT, lambda event: self.dispatch())
+
+    def wake(self):
+        """
+        Makes the Tk thread handle the queued messages. Can be called from any thread.
+        :return:
+        """
+        # one wake up is enough for everything that is queued until dispatch() starts
+        if self._wake_pending:
+            return
+        self._wake_pending = True
+        try:
+            self.root.event_generate(WAKE_EVENT, when="tail")
+        except (tk.TclError, RuntimeError): # the window is closing
+            pass
+
+    def dispatch(self):
+        """
+        Handles the queued messages until the queue is empty or the frame's budget is used up. Runs in the Tk thread.
+        :return:
+        """
+        self._wake_pending = False
+        deadline = time.perf_counter() + self.budget
+        received = []
+        self.on_batch_start()
+        try:
+            while time.perf_counter() < deadline:
+                try:
+                    item = self.messages.get_nowait()
+                except queue.Empty:
+                    break
+                received.append(item[0])
+                self.handle(item)
+        finally:
+            self.on_batch_end()
+
+        rendered = time.perf_counter()
+        for received_at in received:
+            self.latencies.append(rendered - received_at)
+            self.latency_histogram.observe(rendered - received_at)
+
+        if not self.messages.empty():
+            # let Tk draw and handle the user's input before the next part of the burst
+            self._wake_pending = True
+            self.root.after(1, self.dispatch)
+
+    def latency_percentiles(self) -> tuple[float, float] | None:
+        """
+        :return: the p50 and p99 receive-to-render latency of the last messages in milliseconds,
+                 or None if no message was handled yet
+        """
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return (latencies[len(latencies) // 2] * 1000,
+                latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000)
@@ -0,0 +1,142 @@
+"""
+Shrinks a recording before it is encoded: one channel, no silence at its ends, and a steady loudness.
+"""
+from collections import deque
+
+import numpy as np
+
+SPEECH_MIN_LEVEL = -55 # dBFS - quieter chunks are never speech
+SPEECH_MARGIN = 10 # dB above the noise floor that a chunk has to be to be speech
+NOISE_FLOOR_RISE = 3 # dB per second that the noise floor estimate rises (it falls to any quieter chunk at once)
+NOISE_FLOOR_MAX = -45 # dBFS - so a steady loud sound (e.g. music) is not taken for noise after a while
+SPEECH_HANGOVER = 0.4 # seconds of silence kept after speech
+SPEECH_PRE_ROLL = 0.3 # seconds of silence kept before speech - longer pauses are shortened to hangover + pre-roll
+TARGET_LEVEL = -20 # dBFS that speech is brought to
+MAX_GAIN = 20 # dB
+MIN_GAIN = -10 # dB
+LOUDNESS_WINDOW = 1.0 # seconds of speech the loudness is measured over
+PEAK_LIMIT = 0.99 # of full scale - the gain is lowered for a chunk that would clip
+
+
+def _level(samples: np.ndarray) -> float:
+    """
+    :return: the RMS level of the samples in dBFS
+    """
+    return 10 * np.log10(np.mean(np.square(samples / 32768, dtype=np.float64)) + 1e-10)
+
+
+class VoicePreprocessor:
+    """
+    Turns the microphone's PCM into what is worth encoding, a chunk at a time so it can run while recording:
+    - the channels are mixed down to mono
+    - silence is found by energy (against a noise floor that follows the quietest chunks) and dropped at the start
+      and end of the recording, and long pauses are shortened
+    - speech is brought to TARGET_LEVEL by a gain that follows its loudness and never clips
+    Silent chunks are held back until it is known whether speech follows them, so at most
+    SPEECH_PRE_ROLL seconds of audio are kept.
+    """
+    def __init__(self, channels: int, rate: int):
+        """
+        :param channels: The channels of the PCM (interleaved 16 bit samples)
+        :param rate: The sampling rate
+        """
+        self.channels = channels
+        self.rate = rate
+
+        self.noise_floor = SPEECH_MIN_LEVEL - SPEECH_MARGIN # dBFS
+        self.speech_level = None # dBFS, None until the first speech
+        self.gain = 1.0
+        self.speaking = False # whether the last chunk was speech, or within the hangover after it
+
+        self._silence = 0.0 # seconds since the last speech
+        self._held = deque() # mono chunks of silence that are kept only if speech follows
+        self._held_samples = 0
+        self._heard_speech = False
+
+        self.recorded_samples = 0 # per channel
+        self.kept_samples = 0
+
+    @property
+    def recorded_seconds(self) -> float:
+        return self.recorded_samples / self.rate
+
+    @property
+    def kept_seconds(self) -> float:
+        return self.kept_samples / self.rate
+
+    def process(self, pcm: bytes) -> bytes:
+        """
+        :param pcm: The next chunk of the recording
+        :return: mono PCM to encode - empty while silence is held back
+        """
+        samples = np.frombuffer(pcm, dtype=np.int16).reshape(-1, self.channels).mean(axis=1, dtype=np.float32)
+        self.recorded_samples += len(samples)
+        seconds = len(samples) / self.rate
+
+        level = _level(samples)
+        if level < self.noise_floor:
+            self.noise_floor = level
+        else:
+            self.noise_floor = min(self.noise_floor + NOISE_FLOOR_RISE * seconds, level, NOISE_FLOOR_MAX)
+
+        if level > max(self.noise_floor + SPEECH_MARGIN, SPEECH_MIN_LEVEL):
+            self._heard_speech = True
+            self.speaking = True
+            self._silence = 0.0
+            self._measure_loudness(level, seconds)
+            held = list(self._held)
+            self._held.clear()
+            self._held_samples = 0
+            return self._emit(held + [samples])
+
+        self._silence += seconds
+        self.speaking = self._heard_speech and self._silence <= SPEECH_HANGOVER
+        if self.speaking:
+            return self._emit([samples])
+        # silence: keep only the last SPEECH_PRE_ROLL seconds of it
+        self._held.append(samples)
+        self._held_samples += len(samples)
+        while self._held_samples - len(self._held[0]) >= SPEECH_PRE_ROLL * self.rate:
+            self._held_samples -= len(self._held.popleft())
+        return b""
+
+    def flush(self) -> bytes:
+        """
+        Ends the recording: the silence at its end is dropped.
+        :return: mono PCM to encode - the held back silence if there was no speech at all, so the clip is not empty
+        """
+        held = list(self._held)
+        self._held.clear()
+        self._held_samples = 0
+        if self._heard_speech:
+            return b""
+        return self._emit(held)
+
+    def _measure_loudness(self, level: float, seconds: float):
+        if self.speech_level is None:
+            self.speech_level = level
+        else:
+            self.speech_level += (level - self.speech_level) * min(seconds / LOUDNESS_WINDOW, 1.0)
+
+    def _emit(self, chunks: list[np.ndarray]) -> bytes:
+        """
+        Applies the gain to the chunks.
+        :return: their 16 bit PCM
+        """
+        if not chunks:
+            return b""
+        samples = np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+        self.kept_samples += len(samples)
+
+        gain = self.gain
+        if self.speech_level is not None:
+            gain_db = min(max(TARGET_LEVEL - self.speech_level, MIN_GAIN), MAX_GAIN)
+            gain = 10 ** (gain_db / 20)
+        peak = np.max(np.abs(samples)) if len(samples) else 0.0
+        if peak * gain > PEAK_LIMIT * 32767:
+            gain = PEAK_LIMIT * 32767 / peak
+
+        # ramp from the previous gain, so it does not jump in the middle of a word
+        gains = np.linspace(self.gain, gain, len(samples), dtype=np.float32)
+        self.gain = gain
+        return np.clip(samples * gains, -32768, 32767).astype(np.int16).tobytes()
@@ -0,0 +1,120 @@
+"""
+Voice messages that arrive as a stream of chunks (the "voice-stream" protocol feature).
+"""
+import threading
+from typing import Callable
+
+import protocol
+
+MAX_INCOMING_STREAMS = 16 # voice messages being received at once - the oldest unfinished one is dropped after that
+
+
+class VoiceStream:
+    """
+    A voice message that may still be arriving. The listening thread appends the chunks,
+    while the UI can already show it and play whatever arrived so far.
+    """
+    def __init__(self, prefix: str, stream_id: int):
+        """
+        :param prefix: who the message is from, e.g. "alice" or "[Private Message from alice]"
+        :param stream_id: the sender's id of the stream
+        """
+        self.prefix = prefix
+        self.stream_id = stream_id
+        self.next_sequence = 0
+        self.complete = False
+
+        # called by the UI thread (see notify_complete) once the last chunk arrived
+        self.on_complete: list[Callable] = []
+
+        self._data = bytearray()
+        self._lock = threading.Lock()
+
+    def append(self, sequence: int, data: bytes, final: bool) -> bool:
+        """
+        Adds the next chunk.
+        :return: False if the chunk is out of order (a chunk went missing) or the stream is already complete
+        """
+        if self.complete or sequence != self.next_sequence:
+            return False
+        with self._lock:
+            self._data += data
+        self.next_sequence += 1
+        self.complete = final
+        return True
+
+    def get_bytes(self) -> bytes:
+        """
+        :return: the mp3 bytes that arrived so far
+        """
+        with self._lock:
+            return bytes(self._data)
+
+    def notify_complete(self):
+        """
+        Runs the on_complete callbacks. Call it from the UI thread.
+        """
+        callbacks, self.on_complete = self.on_complete, []
+        for callback in callbacks:
+            callback()
+
+
+class VoiceStreamAssembler:
+    """
+    Matches incoming chunks to their streams. Only the unfinished streams are kept, and at most MAX_INCOMING_STREAMS.
+    """
+    def __init__(self, on_started: Callable[[VoiceStream], None], on_finished: Callable[[VoiceStream], None],
+                 max_streams=MAX_INCOMING_STREAMS):
+        """
+        :param on_started: called with every new stream, after its first chunk was added
+        :param on_finished: called with every stream that will not get any more chunks - because the last one arrived,
+                            or because it was dropped with what it had so far
+        :param max_streams: how many unfinished streams to keep
+        """
+        self.on_started = on_started
+        self.on_finished = on_finished
+        self.max_streams = max_streams
+        self.streams: dict[tuple[str, int], VoiceStream] = dict() # { (prefix, stream id): stream }, oldest first
+
+    def feed(self, prefix: str, stream: str, data: bytes):
+        """
+        Adds a received chunk to its stream.
+        :param prefix: the "prefix" field of the chunk
+        :param stream: the "stream" field of the chunk
+        :param data: the bytes of the chunk
+        :return: None
+        """
+        stream_id, sequence, final = protocol.parse_stream_field(stream)
+        key = (prefix, stream_id)
+
+        if sequence == 0:
+            if key in self.streams:
+                self._finish(key)
+            elif len(self.streams) >= self.max_streams:
+                # the oldest stream is probably from a sender that went away in the middle of it
+                self._finish(next(iter(self.streams)))
+            voice_stream = self.streams[key] = VoiceStream(prefix, stream_id)
+            voice_stream.append(sequence, data, final)
+            self.on_started(voice_stream)
+        else:
+            voice_stream = self.streams.get(key)
+            if voice_stream is None: # its start was dropped
+                return
+            if not voice_stream.append(sequence, data, final):
+                print(f"[Client ERROR] A chunk of the voice message from {prefix} went missing.")
+                voice_stream.complete = True
+
+        if voice_stream.complete:
+            self._finish(key)
+
+    def clear(self):
+        """
+        Drops the unfinished streams, e.g. after a reconnect.
+        """
+        for key in list(self.streams):
+            self._finish(key)
+
+    def _finish(self, key: tuple[str, int]):
+        voice_stream = self.streams.pop(key)
+        voice_stream.complete = True
+        self.on_finished(voice_stream)